@@ -33,22 +33,73 @@ command_type - the client looks at the command type to figure out what the serve
 is asking it to do.
 */
 
+/*
+If the connection to the server drops part way through the experiment (e.g. a blip in
+the participant's Wi-Fi), we don't give up straight away: the server keeps the
+participant's place for a while, and we try to reconnect, sending CLIENT_INFO again
+so the server knows who we are. The server then re-sends the last command it sent us,
+and our partner is asked to wait (with the PartnerReconnecting command) until we are
+back.
+
+A few variables keep track of this:
+- reconnect_attempts counts how many times in a row we have tried to reconnect, and
+  reconnect_started is when we started trying; after RECONNECT_TIMEOUT milliseconds we
+  give up and show the partner_dropout() screen
+- finished_with_server is set once the server has told us we are done (EndExperiment or
+  PartnerDropout), after which there is nothing to reconnect for
+- paired is set once we have been paired with a partner, so that when we reconnect the
+  server knows we were part way through (and tells us if it is too late to carry on)
+- last_command is the last command we received, and responded_to_last_command records
+  whether we have sent the server our response to it. If the server re-sends the same
+  command after we reconnect and we haven't responded yet, we are still working on it
+  (e.g. the director is still choosing a label), so we ignore the repeat
+  (expecting_repeat is set while we wait to see if it comes).
+- unsent_messages holds any responses we make while disconnected, which are sent as
+  soon as we are reconnected
+*/
+var RECONNECT_TIMEOUT = 60000;
+var reconnect_attempts = 0;
+var reconnect_started = null;
+var finished_with_server = false;
+var paired = false;
+var last_command = null;
+var responded_to_last_command = false;
+var expecting_repeat = false;
+var unsent_messages = [];
+
 function interaction_loop() {
   //pause the timeline to stop us progressing past this point - incoming commands
   //from the server will unpause us
   jsPsych.pauseExperiment();
+  connect_to_server();
+}
+
+function connect_to_server() {
   ws = new WebSocket("wss://jspsychlearning.ppls.ed.ac.uk" + my_port_number);
   //ws = new WebSocket("ws://localhost:9011")
-  //when establishing connection for first time, send over some info - in this case,
-  //the server needs to know participant_id, which is a unique identifier for this
-  //participant
+  //when establishing connection (for the first time, or again after it dropped), send
+  //over some info - in this case, the server needs to know participant_id, which is a
+  //unique identifier for this participant
   ws.onopen = function () {
     console.log("opening websocket");
     details = JSON.stringify({
       response_type: "CLIENT_INFO",
       client_info: participant_id,
+      resuming: paired,
     });
     ws.send(details); //send the encoded string to the server via the socket
+    if (reconnect_started !== null) {
+      hide_connection_message();
+      //if we hadn't responded to the last command before the connection dropped, the
+      //server will send it again - but we are still working on it
+      expecting_repeat = !responded_to_last_command;
+    }
+    reconnect_attempts = 0;
+    reconnect_started = null;
+    //send anything we tried to send while we were disconnected
+    while (unsent_messages.length > 0) {
+      ws.send(unsent_messages.shift());
+    }
   };
 
   //on receiving a message from the server...
@@ -57,26 +108,76 @@ function interaction_loop() {
     console.log("received message: " + e.data); //display in the console (for debugging!)
     var cmd = JSON.parse(e.data); //parse into a js object
     var cmd_code = cmd.command_type; //consult the command_type key
+    //PartnerReconnecting and PartnerReconnected just show and hide a message on top of
+    //whatever we are doing
+    if (cmd_code != "PartnerReconnecting" && cmd_code != "PartnerReconnected") {
+      var repeated = expecting_repeat && e.data == last_command;
+      expecting_repeat = false;
+      if (repeated) {
+        console.log("ignoring repeated command, still working on it");
+        return;
+      }
+      last_command = e.data;
+      responded_to_last_command = false;
+    }
     handle_server_command(cmd_code, cmd); //handle the command
   };
 
-  //when the server tells you to close the connection, simply log this in the
-  //console and close
+  //when the connection closes - because we closed it, or because it dropped - either
+  //we are done, or we try to reconnect after a short delay (longer each time we try), or
+  //if we have been trying for too long we call partner_dropout(), which is a function
+  //showing a screen telling the participant that something has gone wrong, which allows
+  //them to exit the experiment cleanly.
   ws.onclose = function () {
-    console.log("closing websocket");
-    ws.close();
+    console.log("websocket closed");
+    if (finished_with_server) {
+      return;
+    }
+    if (reconnect_started === null) {
+      reconnect_started = Date.now();
+      show_connection_message("Lost connection to the server, trying to reconnect...");
+    }
+    if (Date.now() - reconnect_started > RECONNECT_TIMEOUT) {
+      hide_connection_message();
+      finished_with_server = true;
+      partner_dropout();
+    } else {
+      reconnect_attempts += 1;
+      setTimeout(connect_to_server, Math.min(500 * Math.pow(2, reconnect_attempts - 1), 5000));
+    }
   };
 
-  //when there is an error from the socket (e.g. because the server crashes or is
-  //down), calls partner_dropout(), which is a function showing a screen telling the
-  //participant that something has gone wrong, which allows them to exit the experiment
-  //cleanly.
+  //errors from the socket (e.g. because the server crashes or is down) are followed by
+  //the connection closing, which is handled above
   ws.onerror = function (e) {
     console.log(e);
-    partner_dropout();
   };
 }
 
+/*
+show_connection_message displays a message over the top of whatever the participant is
+doing (without interrupting it), and hide_connection_message removes it again.
+*/
+function show_connection_message(message) {
+  var overlay = document.getElementById("connection-message");
+  if (overlay === null) {
+    overlay = document.createElement("div");
+    overlay.id = "connection-message";
+    overlay.style.cssText =
+      "position:fixed;top:0;left:0;width:100%;height:100%;z-index:1000;" +
+      "background:rgba(255,255,255,0.9);display:flex;align-items:center;justify-content:center;";
+    document.body.appendChild(overlay);
+  }
+  overlay.innerHTML = "<p>" + message + "</p>";
+}
+
+function hide_connection_message() {
+  var overlay = document.getElementById("connection-message");
+  if (overlay !== null) {
+    overlay.remove();
+  }
+}
+
 /*
 handle_server_command calls the appropriate function depending on the command
 the server sent - the different command types are given by command_code (which
@@ -92,6 +193,8 @@ command_code can be many different things:
     WaitForPartner: Waiting screen
     Matcher: Matcher trial
     Feedback: Feedback (for both Director and Matcher)
+    PartnerReconnecting: your partner has lost their connection, wait for them
+    PartnerReconnected: your partner is back, carry on
 
 For the Instructions, Director, Matcher and Feedback trial types, the client will
 send a response back to the server, indicating the client has completed that trial
@@ -112,6 +215,8 @@ function handle_server_command(command_code, command) {
     "WaitForPartner",
     "Matcher",
     "Feedback",
+    "PartnerReconnecting",
+    "PartnerReconnected",
   ];
   if (possible_commands.indexOf(command_code) == -1) {
     //this fires is the command is *not* in the list
@@ -121,9 +226,12 @@ function handle_server_command(command_code, command) {
   else {
     switch (command_code) {
       case "PartnerDropout": //PartnerDropout: your partner has dropped out
+        finished_with_server = true;
+        hide_connection_message();
         partner_dropout(); //direct client to a screen allowing them to exit the experiment cleanly
         break;
       case "EndExperiment": //EndExperiment: you have finished the experiment
+        finished_with_server = true;
         end_experiment(); //direct client to the final screen of the experiment
         break;
       case "WaitingRoom": //WaitingRoom: puts client in waiting room
@@ -134,6 +242,7 @@ function handle_server_command(command_code, command) {
         //so could potentially use this for different kinds of instructions screens -
         //but in this experiment the only instruction screen handled via the server
         //is the interaction instructions, so no need to do anything fancy
+        paired = true; //we only get these instructions once we have a partner
         show_interaction_instructions(); //direct client to the appropriate instruction screen
         //when show_interaction_instructions completes it will send a message back to the server,
         //JSON.stringify({response_type:"INTERACTION_INSTRUCTIONS_COMPLETE"})
@@ -167,6 +276,13 @@ function handle_server_command(command_code, command) {
         //when completed, display_feedback sends a response to the server,
         //JSON.stringify({response_type:'FINISHED_FEEDBACK'})
         break;
+      case "PartnerReconnecting": //PartnerReconnecting: partner's connection has dropped
+        //anything we do while they are away is held by the server until they are back
+        show_connection_message("Your partner has lost their connection - please wait for them to reconnect.");
+        break;
+      case "PartnerReconnected": //PartnerReconnected: partner is back
+        hide_connection_message();
+        break;
       default: //this only fires if none of the above fires, which shouldn't happen!
         console.log("oops, default fired");
         break;
@@ -175,16 +291,21 @@ function handle_server_command(command_code, command) {
 }
 
 /*
-Note that we check the connection isopen before sending, and use JSON.stringify
-to convert the message object to a JSON string - our python server can convert back
-from json to a python dictionary.
+Note that we check the connection is open before sending - if not (because it has dropped
+and we are trying to reconnect) the message is kept and sent once we have reconnected.
+We use JSON.stringify to convert the message object to a JSON string - our python server
+can convert back from json to a python dictionary.
 */
 function send_to_server(message_object) {
   if (ws.readyState === ws.OPEN) {
     ws.send(JSON.stringify(message_object));
+    responded_to_last_command = true;
+  } else {
+    unsent_messages.push(JSON.stringify(message_object));
   }
 }
 
 function close_socket() {
-  ws.onclose();
+  finished_with_server = true;
+  ws.close();
 }
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of permessage-deflate for the messages the dyadic interaction server
+# actually sends. For a simulated stream of messages to one client, prints the
+# bytes that go on the wire (payload plus frame header) with and without
+# compression, and the CPU time compressing (and the client decompressing) takes
+# per message. Run with
+# python deflate_benchmark.py
+
+import os
+import sys
+import json
+import random
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from websocket_server.permessage_deflate import PerMessageDeflate, DEFLATE_TAIL
+from websocket_server.websocket_server import make_frame_header
+
+import zlib
+
+# One interaction trial's worth of server commands, as sent by dyadic_interaction_server.py
+def trial_commands(trial_n):
+    target = random.choice(['object4', 'object5'])
+    label = random.choice(['wug', 'dax', 'blicket', 'toma'])
+    return [{"command_type": "Director", "target_object": target, "partner_id": "participant_%d" % trial_n},
+            {"command_type": "WaitForPartner"},
+            {"command_type": "WaitForPartner"},
+            {"command_type": "Matcher", "director_label": label,
+             "object_choices": ['object4', 'object5'], "partner_id": "participant_%d" % trial_n},
+            {"command_type": "Feedback", "score": 1, "target": target, "label": label, "guess": target}]
+
+# A larger message, like a whole experiment's trial data sent in one go
+def trial_data_dump(n_trials):
+    return [{"participant_id": "p%04d" % random.randint(0, 9999), "trial_index": i,
+             "role": random.choice(["Director", "Matcher"]), "target_object": "object4",
+             "response": random.choice(["wug", "dax"]), "rt": random.randint(300, 5000),
+             "time_elapsed": 1000 * i} for i in range(n_trials)]
+
+random.seed(1)
+streams = [('commands (40 trials)', [json.dumps(c) for t in range(40) for c in trial_commands(t)]),
+           ('trial data dumps (10 x 200 trials)', [json.dumps(trial_data_dump(200)) for _ in range(10)])]
+
+settings = [('context takeover', PerMessageDeflate()),
+            ('context takeover, threshold 128', PerMessageDeflate(threshold=128)),
+            ('no context takeover, threshold 0', PerMessageDeflate(threshold=0, server_no_context_takeover=True)),
+            ('no context takeover, threshold 128', PerMessageDeflate(server_no_context_takeover=True)),
+            ('context takeover, level 1', PerMessageDeflate(level=1))]
+
+def wire_bytes(payload):
+    return len(make_frame_header(0x1, len(payload))) + len(payload)
+
+for stream_name, messages in streams:
+    payloads = [m.encode('utf8') for m in messages]
+    raw = sum(wire_bytes(p) for p in payloads)
+    print('%s: %d messages, %d bytes on the wire uncompressed' % (stream_name, len(payloads), raw))
+    print('  %-36s %10s %8s %14s %14s' % ('settings', 'bytes', 'ratio', 'compress us', 'decompress us'))
+    for settings_name, deflate in settings:
+        context, _ = deflate.negotiate('permessage-deflate')
+        client = zlib.decompressobj(-15)
+        compressed = 0
+        compress_time = 0.0
+        decompress_time = 0.0
+        for payload in payloads:
+            if context.should_compress(payload):
+                start = time.perf_counter()
+                data = context.compress(payload)
+                compress_time += time.perf_counter() - start
+                start = time.perf_counter()
+                if context.server_no_context_takeover:
+                    client = zlib.decompressobj(-15)
+                assert client.decompress(data + DEFLATE_TAIL) == payload
+                decompress_time += time.perf_counter() - start
+            else:
+                data = payload
+            compressed += wire_bytes(data)
+        print('  %-36s %10d %8.2f %14.1f %14.1f' % (settings_name, compressed, raw / float(compressed),
+                                                     1e6 * compress_time / len(payloads),
+                                                     1e6 * decompress_time / len(payloads)))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of reading client frames off a socket: how many frames a second one
+# connection's thread can read and unmask, for messages the size of the responses
+# dyadic_interaction.js sends and for somewhat larger ones. A thread writes a stream of
+# masked frames into one end of a socket pair as fast as it can, and the other end reads
+# them
+# - as WebSocketHandler used to: a buffered file on the socket, with separate reads for
+#   the first two header bytes, the extended length, the mask and the payload
+# - with FrameParser, receiving straight into its buffer with recv_into (as
+#   WebSocketHandler does now)
+# - with FrameParser, given the data by recv
+# and the same for the asyncio engine, reading from an asyncio StreamReader
+# - as AsyncWebSocketHandler used to: an await of readexactly for each part of a frame
+# - with FrameParser, fed whatever the reader has each time (as AsyncWebSocketHandler
+#   does now)
+# Run with
+# python frame_parser_benchmark.py
+
+import os
+import sys
+import asyncio
+import json
+import socket
+import struct
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from websocket_server.websocket_server import FrameParser, unmask, RECEIVE_BUFFER_SIZE
+
+N_FRAMES = 100000
+REPEATS = 3
+
+messages = [('FINISHED_FEEDBACK (%d B)', json.dumps({'response_type': 'FINISHED_FEEDBACK'})),
+            ('RESPONSE (%d B)', json.dumps({'response_type': 'RESPONSE', 'participant': 'participant_1234',
+                                            'partner': 'participant_1235', 'role': 'Director',
+                                            'target_object': 'object4', 'response': 'blicket'})),
+            ('trial data (%d B)', json.dumps([{'trial_index': i, 'rt': 1234, 'response': 'wug'}
+                                             for i in range(60)]))]
+
+
+def masked_frame(payload):
+    # as a browser sends it: text, unfragmented, masked
+    masks = os.urandom(4)
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x81, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack('>BBH', 0x81, 0x80 | 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x81, 0x80 | 127, length)
+    return header + masks + bytes(unmask(payload, masks))
+
+
+def read_with_file(sock, n_frames):
+    # the reads WebSocketHandler.read_next_message used to make for each frame
+    rfile = sock.makefile('rb')
+    for _ in range(n_frames):
+        b1, b2 = rfile.read(2)
+        payload_length = b2 & 0x7f
+        if payload_length == 126:
+            payload_length = struct.unpack(">H", rfile.read(2))[0]
+        elif payload_length == 127:
+            payload_length = struct.unpack(">Q", rfile.read(8))[0]
+        masks = rfile.read(4)
+        unmask(rfile.read(payload_length), masks)
+
+
+def read_with_recv_into(sock, n_frames):
+    parser = FrameParser(lambda *header: True)
+    frames = 0
+    while frames < n_frames:
+        frame = parser.next_frame()
+        while frame is None:
+            parser.received(sock.recv_into(parser.receive_buffer()))
+            frame = parser.next_frame()
+        frames += 1
+
+
+def read_with_feed(sock, n_frames):
+    parser = FrameParser(lambda *header: True)
+    frames = 0
+    while frames < n_frames:
+        frame = parser.next_frame()
+        while frame is None:
+            parser.feed(sock.recv(RECEIVE_BUFFER_SIZE))
+            frame = parser.next_frame()
+        frames += 1
+
+
+async def read_with_readexactly(reader, n_frames):
+    # the awaits AsyncWebSocketHandler.read_next_message used to make for each frame
+    for _ in range(n_frames):
+        b1, b2 = await reader.readexactly(2)
+        payload_length = b2 & 0x7f
+        if payload_length == 126:
+            payload_length = struct.unpack(">H", await reader.readexactly(2))[0]
+        elif payload_length == 127:
+            payload_length = struct.unpack(">Q", await reader.readexactly(8))[0]
+        masks = await reader.readexactly(4)
+        unmask(await reader.readexactly(payload_length), masks)
+
+
+async def read_with_stream_feed(reader, n_frames):
+    parser = FrameParser(lambda *header: True)
+    frames = 0
+    while frames < n_frames:
+        frame = parser.next_frame()
+        while frame is None:
+            parser.feed(await reader.read(RECEIVE_BUFFER_SIZE))
+            frame = parser.next_frame()
+        frames += 1
+
+
+def run_in_event_loop(read):
+    # runs read(reader, n_frames) on a StreamReader for the socket
+    def run(sock, n_frames):
+        async def main():
+            reader, writer = await asyncio.open_connection(sock=sock)
+            await read(reader, n_frames)
+            writer.close()
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(main())
+        loop.close()
+    return run
+
+
+def frames_per_second(read, frame, n_frames):
+    best = None
+    for _ in range(REPEATS):
+        reader, writer = socket.socketpair()
+        # written in lumps of many frames, as they pile up when the reader falls behind
+        lump = frame * max(1, 64 * 1024 // len(frame))
+        frames_per_lump = len(lump) // len(frame)
+
+        def write():
+            for _ in range(n_frames // frames_per_lump):
+                writer.sendall(lump)
+            writer.sendall(frame * (n_frames % frames_per_lump))
+        thread = threading.Thread(target=write)
+        start = time.perf_counter()
+        thread.start()
+        read(reader, n_frames)
+        elapsed = time.perf_counter() - start
+        thread.join()
+        reader.close()
+        writer.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return n_frames / best
+
+
+methods = [('file reads (before)', read_with_file),
+           ('FrameParser, recv_into', read_with_recv_into),
+           ('FrameParser, feed', read_with_feed),
+           ('asyncio readexactly (before)', run_in_event_loop(read_with_readexactly)),
+           ('asyncio FrameParser', run_in_event_loop(read_with_stream_feed))]
+
+print('%-26s %-30s %14s' % ('message', 'method', 'frames/sec'))
+for label, message in messages:
+    payload = message.encode('utf-8')
+    frame = masked_frame(payload)
+    n_frames = N_FRAMES if len(payload) < 1000 else N_FRAMES // 10
+    baseline = None
+    for name, read in methods:
+        rate = frames_per_second(read, frame, n_frames)
+        if name.endswith('(before)'):
+            baseline = rate
+        print('%-26s %-30s %14.0f   (%.1fx)' % (label % len(payload), name, rate, rate / baseline))
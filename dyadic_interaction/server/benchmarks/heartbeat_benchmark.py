@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# Checks (and times) the websocket server's heartbeat finding dead connections.
+# Opens a few thousand real connections to a server with ping_interval set; most
+# of the clients answer pings, but some go silent - they never read or answer
+# anything, like a client whose network has disappeared without the connection
+# being closed. Reports how long after going silent each dead connection was
+# closed (which should be between ping_interval and ping_interval + ping_timeout,
+# plus up to a few ticks of the heartbeat thread), and checks that no live
+# connection was closed. Run with
+# python heartbeat_benchmark.py --clients 2000
+# or add --async to test the asyncio engine.
+
+import os
+import sys
+import time
+import socket
+import random
+import base64
+import argparse
+import selectors
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from websocket_server import WebsocketServer, AsyncWebsocketServer
+
+
+def open_connection(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall(('GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n' % key).encode())
+    response = b''
+    while b'\r\n\r\n' not in response:
+        response += sock.recv(1024)
+    return sock
+
+
+# a masked pong with an empty payload
+PONG = bytes([0x8A, 0x80]) + os.urandom(4)
+
+
+def answer_pings(sockets, stop):
+    # The live clients: read whatever the server sends (only pings, here, which
+    # have no payload) and answer each ping with a pong
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+    while not stop.is_set():
+        for key, _ in selector.select(timeout=0.1):
+            try:
+                data = key.fileobj.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                continue
+            if not data:
+                selector.unregister(key.fileobj)
+                continue
+            # pings are two bytes each: 0x89 0x00
+            key.fileobj.sendall(PONG * (data.count(b'\x89\x00')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the heartbeat closes dead connections.')
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--dead', type=float, default=0.25, help='fraction of clients that go silent')
+    parser.add_argument('--interval', type=float, default=2.0, help='ping_interval')
+    parser.add_argument('--timeout', type=float, default=2.0, help='ping_timeout')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='use AsyncWebsocketServer')
+    args = parser.parse_args()
+    random.seed(1)
+
+    engine = AsyncWebsocketServer if args.use_async else WebsocketServer
+    server = engine(0, ping_interval=args.interval, ping_timeout=args.timeout)
+    closed = {}
+    lock = threading.Lock()
+    def client_left(client, server):
+        with lock:
+            closed[client['address'][1]] = time.monotonic()
+    server.set_fn_client_left(client_left)
+    threading.Thread(target=server.run_forever, daemon=True).start()
+
+    sockets = [open_connection(server.port) for _ in range(args.clients)]
+    while len(server.registry) < args.clients:
+        time.sleep(0.01)
+    silent_from = time.monotonic()
+    dead = set(random.sample(range(args.clients), int(args.dead * args.clients)))
+    live = [sock for i, sock in enumerate(sockets) if i not in dead]
+    stop = threading.Event()
+    threading.Thread(target=answer_pings, args=(live, stop), daemon=True).start()
+    start_cpu = time.process_time()
+    # wait long enough for every silent client to be found, and then some
+    time.sleep(2 * (args.interval + args.timeout) + 2)
+    cpu = time.process_time() - start_cpu
+    stop.set()
+
+    dead_ports = set(sockets[i].getsockname()[1] for i in dead)
+    live_ports = set(sock.getsockname()[1] for sock in live)
+    found = sorted(closed[port] - silent_from for port in dead_ports if port in closed)
+    wrongly_closed = len(live_ports & set(closed))
+    print('%s, %d clients, %d silent, ping_interval %.1fs, ping_timeout %.1fs' %
+          (engine.__name__, args.clients, len(dead), args.interval, args.timeout))
+    print('heartbeat: ' + ', '.join('%s %s' % item for item in sorted(server.heartbeat.stats().items())))
+    if found:
+        print('silent clients closed after %.2fs (first) to %.2fs (last)' % (found[0], found[-1]))
+    print('process cpu time while waiting: %.2fs' % cpu)
+    problems = []
+    if len(found) != len(dead):
+        problems.append('%d silent clients were never closed' % (len(dead) - len(found)))
+    if wrongly_closed:
+        problems.append('%d live clients were closed' % wrongly_closed)
+    if found and found[-1] > args.interval + args.timeout + 3 * server.heartbeat.wheel.tick:
+        problems.append('silent clients took too long to close')
+    for problem in problems:
+        print('PROBLEM: ' + problem)
+    if not problems:
+        print('no problems found')
+    for sock in sockets:
+        sock.close()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
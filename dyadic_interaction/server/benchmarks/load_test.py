@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+
+# Load test for a running dyadic interaction server: how many dyads can it handle? Spawns
+# simulated participants which connect over real websockets and play the experiment just
+# as dyadic_interaction.js does - CLIENT_INFO, then INTERACTION_INSTRUCTIONS_COMPLETE once
+# paired, a RESPONSE for every Director and Matcher trial, FINISHED_FEEDBACK after every
+# feedback screen - taking a random think time (--think-time) before each response. A
+# fraction of them (--dropout) close their connection part way through instead, at a
+# random point. Reports:
+# - throughput: messages to and from the server, and dyads finished, per second
+# - pairing latency: from being sent to the waiting room to being sent the instructions
+# - round-trip latency for each kind of response: from sending it to the server's next
+#   command. The server answers most responses straight away, but only answers
+#   FINISHED_FEEDBACK once both partners have sent it, so for that one the time
+#   includes waiting for the partner
+# - how every participant's experiment ended, and errors (connections refused, lost, or
+#   closed by the server, unexpected commands, participants who never finished)
+
+# Start the server (e.g. python dyadic_interaction_server.py, or worker_server.py), then
+# python load_test.py --clients 2000 --spawn-rate 100 --think-time 0.5 2 --dropout 0.05
+# or have the load test start dyadic_interaction_server.py itself with --start-server, in a
+# temporary folder, so the trial data and saved state of all those simulated dyads end up
+# there rather than in server_data and server_state next to the server.
+# Thousands of clients need as many file descriptors, which the load test raises its own
+# limit for; on the server side you may need ulimit -n. With --dropout 0 every
+# participant should finish (one may be left in the waiting room if --clients is odd), so
+# anything else shows up as an error. Simulating clients takes CPU too: give it
+# --processes if the load test itself can't keep up.
+
+import os
+import sys
+import json
+import time
+import heapq
+import socket
+import random
+import struct
+import base64
+import signal
+import argparse
+import tempfile
+import subprocess
+import itertools
+import selectors
+import multiprocessing
+from collections import defaultdict, Counter
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# labels the simulated directors choose from
+LABELS = ['buv', 'cav', 'wug', 'zop', 'nif', 'gar']
+
+# the server --start-server starts
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'dyadic_interaction_server.py')
+
+
+def percentiles(values, ps=(50, 90, 99)):
+    # nearest-rank percentiles, as in matchmaking.py
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {}
+    for p in ps:
+        rank = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))
+        result[p] = ordered[rank]
+    return result
+
+
+def mask_payload(data, mask):
+    # XORs the whole payload with the repeated 4-byte mask in one go, as a big integer
+    n = len(data)
+    repeated = (mask * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(n, 'big')
+
+
+class Stats(object):
+    """
+    Everything counted and timed by one load-generating process; merged across
+    processes at the end.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.outcomes = Counter()  # how each participant's experiment ended
+        self.errors = Counter()
+        self.pairing = []  # seconds
+        self.round_trips = defaultdict(list)  # response label -> seconds
+
+    def error(self, kind):
+        self.errors[kind] += 1
+
+    def as_dict(self):
+        return {'sent': self.sent, 'received': self.received, 'outcomes': dict(self.outcomes),
+                'errors': dict(self.errors), 'pairing': self.pairing, 'round_trips': dict(self.round_trips)}
+
+    def merge(self, other):
+        # other: as_dict() of another process's Stats
+        self.sent += other['sent']
+        self.received += other['received']
+        self.outcomes.update(other['outcomes'])
+        self.errors.update(other['errors'])
+        self.pairing.extend(other['pairing'])
+        for label, times in other['round_trips'].items():
+            self.round_trips[label].extend(times)
+
+
+class SimulatedParticipant(object):
+    """
+    One participant's connection. Reacts to commands the way dyadic_interaction.js
+    does, after a think time drawn uniformly from think_time (seconds). If
+    dropout_after is given, closes the connection instead of sending response
+    number dropout_after + 1.
+    """
+
+    def __init__(self, loop, participant_id, think_time=(0, 0), dropout_after=None):
+        self.loop = loop
+        self.stats = loop.stats
+        self.participant_id = participant_id
+        self.think_time = think_time
+        self.dropout_after = dropout_after
+        self.sock = None
+        self.buffer = b''
+        self.handshake_done = False
+        self.finished = None
+        self.responses = 0
+        self.last_sent = None  # (label, time) of the last response, until the server's next command
+        self.waiting_since = None  # when they were sent to the waiting room
+
+    def start(self):
+        try:
+            self.sock = socket.create_connection((self.loop.host, self.loop.port), timeout=10)
+        except OSError:
+            self.stats.error('connect_failed')
+            self.finish('error')
+            return False
+        self.sock.setblocking(False)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall(('GET %s HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\n'
+                           'Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\n'
+                           'Sec-WebSocket-Version: 13\r\n\r\n'
+                           % (self.loop.path, self.loop.host, self.loop.port, key)).encode())
+        return True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    ######################
+    ##### Receiving
+    ######################
+
+    def readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.stats.error('connection_lost' if self.handshake_done else 'handshake_failed')
+            self.finish('error')
+            return
+        self.buffer += data
+        if not self.handshake_done:
+            if b'\r\n\r\n' not in self.buffer:
+                return
+            response, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+            if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+                self.stats.error('handshake_failed')
+                self.finish('error')
+                return
+            self.handshake_done = True
+            self.send({'response_type': 'CLIENT_INFO', 'client_info': self.participant_id}, 'CLIENT_INFO')
+        while self.finished is None and len(self.buffer) >= 2:
+            opcode = self.buffer[0] & 0x0F
+            length = self.buffer[1] & 0x7F
+            start = 2
+            if length == 126:
+                if len(self.buffer) < 4:
+                    return
+                length = struct.unpack('!H', self.buffer[2:4])[0]
+                start = 4
+            elif length == 127:
+                if len(self.buffer) < 10:
+                    return
+                length = struct.unpack('!Q', self.buffer[2:10])[0]
+                start = 10
+            if len(self.buffer) < start + length:
+                return
+            payload = self.buffer[start:start + length]
+            self.buffer = self.buffer[start + length:]
+            if opcode == 0x1:
+                self.stats.received += 1
+                try:
+                    command = json.loads(payload.decode('utf-8'))
+                except ValueError:
+                    self.stats.error('bad_message')
+                    continue
+                self.command(command)
+            elif opcode == 0x9:  # ping
+                self.send_frame(0xA, payload)
+            elif opcode == 0x8:
+                self.stats.error('closed_by_server')
+                self.finish('error')
+
+    def command(self, command):
+        now = time.time()
+        command_type = command.get('command_type')
+        # PartnerReconnecting/PartnerReconnected come whenever the partner's connection
+        # drops and comes back, so aren't an answer to anything
+        if command_type in ('PartnerReconnecting', 'PartnerReconnected'):
+            return
+        # nor is PartnerDropout, which comes once the server gives up on the partner
+        if self.last_sent is not None and command_type != 'PartnerDropout':
+            label, sent = self.last_sent
+            self.stats.round_trips[label].append(now - sent)
+            self.last_sent = None
+        if command_type == 'WaitingRoom':
+            self.waiting_since = now
+        elif command_type == 'Instructions':
+            if self.waiting_since is not None:
+                self.stats.pairing.append(now - self.waiting_since)
+                self.waiting_since = None
+            self.respond({'response_type': 'INTERACTION_INSTRUCTIONS_COMPLETE'},
+                         'INTERACTION_INSTRUCTIONS_COMPLETE')
+        elif command_type == 'Director':
+            self.respond({'response_type': 'RESPONSE', 'participant': self.participant_id,
+                          'partner': command.get('partner_id'), 'role': 'Director',
+                          'target_object': command.get('target_object'), 'response': random.choice(LABELS)},
+                         'RESPONSE (Director)')
+        elif command_type == 'Matcher':
+            self.respond({'response_type': 'RESPONSE', 'participant': self.participant_id,
+                          'partner': command.get('partner_id'), 'role': 'Matcher',
+                          'director_label': command.get('director_label'),
+                          'response': random.choice(command.get('object_choices') or ['object4', 'object5'])},
+                         'RESPONSE (Matcher)')
+        elif command_type == 'Feedback':
+            self.respond({'response_type': 'FINISHED_FEEDBACK'}, 'FINISHED_FEEDBACK')
+        elif command_type == 'EndExperiment':
+            self.finish('completed')
+        elif command_type == 'PartnerDropout':
+            # (also how the server tells someone nobody turned up for them)
+            self.finish('waiting_room_timeout' if self.waiting_since is not None else 'partner_dropped_out')
+        elif command_type != 'WaitForPartner':
+            self.stats.error('unexpected_command')
+
+    ######################
+    ##### Sending
+    ######################
+
+    def respond(self, response, label):
+        self.responses += 1
+        if self.dropout_after is not None and self.responses > self.dropout_after:
+            self.finish('dropped_out')
+            return
+        self.loop.call_later(random.uniform(*self.think_time), self.send, response, label)
+
+    def send(self, response, label):
+        if self.finished is not None:
+            return
+        if self.send_frame(0x1, json.dumps(response).encode('utf-8')):
+            self.stats.sent += 1
+            self.last_sent = (label, time.time())
+
+    def send_frame(self, opcode, payload):
+        mask = os.urandom(4)
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, len(payload))
+        try:
+            self.sock.sendall(header + mask + mask_payload(payload, mask))
+        except OSError:
+            self.stats.error('send_failed')
+            self.finish('error')
+            return False
+        return True
+
+    def finish(self, outcome):
+        if self.finished is not None:
+            return
+        self.finished = outcome
+        self.stats.outcomes[outcome] += 1
+        if self.sock is not None:
+            self.loop.remove(self)
+            self.sock.close()
+        self.loop.participant_finished(self)
+
+
+class ParticipantLoop(object):
+    """
+    Runs any number of simulated participants in one thread, with a selector
+    for their connections and a heap of timers for their think times.
+    on_finished(participant) is called whenever one finishes.
+    """
+
+    def __init__(self, host, port, path, on_finished=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.on_finished = on_finished
+        self.stats = Stats()
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.counter = itertools.count()
+        self.live = 0
+
+    def call_later(self, delay, fn, *args):
+        heapq.heappush(self.timers, (time.time() + delay, next(self.counter), fn, args))
+
+    def add(self, participant):
+        if participant.start():
+            self.selector.register(participant.sock, selectors.EVENT_READ, participant)
+            self.live += 1
+
+    def remove(self, participant):
+        self.selector.unregister(participant.sock)
+        self.live -= 1
+
+    def participant_finished(self, participant):
+        if self.on_finished is not None:
+            self.on_finished(participant)
+
+    def run(self, until):
+        # until(): checked after every round of events, stopping once it returns True
+        while not until():
+            timeout = 0.1
+            if self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+            for key, _ in self.selector.select(timeout):
+                key.data.readable()
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, fn, args = heapq.heappop(self.timers)
+                fn(*args)
+
+    def unfinished(self):
+        return [key.data for key in self.selector.get_map().values()]
+
+
+def raise_file_limit():
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+
+
+def generate_load(args, name, clients, spawn_rate, results):
+    # One load-generating process: spawns its share of the clients at its share of the
+    # spawn rate, and runs them until they have all finished or the time runs out
+    raise_file_limit()
+    loop = ParticipantLoop(args.host, args.port, args.path)
+    spawned = [0]
+
+    def spawn():
+        spawned[0] += 1
+        dropout_after = None
+        if random.random() < args.dropout:
+            # at some point between CLIENT_INFO and the end of the experiment
+            dropout_after = random.randint(0, args.dropout_window)
+        loop.add(SimulatedParticipant(loop, 'load_%s_%d' % (name, spawned[0]), args.think_time, dropout_after))
+        if spawned[0] < clients:
+            loop.call_later(1.0 / spawn_rate, spawn)
+
+    start = time.time()
+    if clients:
+        loop.call_later(0, spawn)
+    loop.run(lambda: (spawned[0] >= clients and loop.live == 0) or time.time() - start > args.timeout)
+    for participant in loop.unfinished():
+        loop.stats.error('unfinished_in_waiting_room' if participant.waiting_since is not None
+                         else 'unfinished_mid_experiment')
+        participant.finish('unfinished')
+    results.put((loop.stats.as_dict(), time.time() - start))
+
+
+def report(stats, elapsed, clients):
+    print('%d participants in %.1f s' % (clients, elapsed))
+    print('throughput: %.0f messages/s (%d sent, %d received), %.1f dyads finished/s'
+          % ((stats.sent + stats.received) / elapsed, stats.sent, stats.received,
+             stats.outcomes['completed'] / 2.0 / elapsed))
+    print('outcomes: ' + ', '.join('%s %d' % item for item in sorted(stats.outcomes.items())))
+    print('errors: ' + (', '.join('%s %d' % item for item in sorted(stats.errors.items())) or 'none'))
+    print('%-36s %8s %9s %9s %9s %9s' % ('latency (ms)', 'count', 'p50', 'p90', 'p99', 'max'))
+    rows = [('pairing (waiting room)', stats.pairing)] + sorted(stats.round_trips.items())
+    for label, times in rows:
+        if times:
+            p = percentiles(times)
+            print('%-36s %8d %9.1f %9.1f %9.1f %9.1f' % (label, len(times), p[50] * 1000, p[90] * 1000,
+                                                         p[99] * 1000, max(times) * 1000))
+
+
+def start_server(host, port, timeout=10):
+    # Runs SERVER_SCRIPT in a temporary folder, which is where it writes its files, and
+    # waits until it accepts connections
+    directory = tempfile.mkdtemp(prefix='load_test_')
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=directory)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((host, port)).close()
+            break
+        except OSError:
+            if server.poll() is not None or time.time() >= deadline:
+                server.kill()
+                raise RuntimeError('server did not start')
+            time.sleep(0.1)
+    print('Started the server, writing its files in %s' % directory)
+    return server
+
+
+def stop_server(server):
+    # Ctrl-C, so it writes out everything still waiting to be saved
+    server.send_signal(signal.SIGINT)
+    try:
+        server.wait(10)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a running dyadic interaction server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9001)
+    parser.add_argument('--path', default='/ws1/', help="the experiment's my_port_number")
+    parser.add_argument('--clients', type=int, default=1000, help='participants to simulate in all')
+    parser.add_argument('--spawn-rate', type=float, default=50, help='new participants per second')
+    parser.add_argument('--think-time', type=float, nargs=2, default=[0.5, 2.0], metavar=('MIN', 'MAX'),
+                        help='seconds each participant takes before each response')
+    parser.add_argument('--dropout', type=float, default=0.0,
+                        help='fraction of participants who close their connection part way through')
+    parser.add_argument('--dropout-window', type=int, default=17,
+                        help='responses after CLIENT_INFO in a whole experiment (1 + 2 per trial), '
+                             'dropouts happen at one of them')
+    parser.add_argument('--processes', type=int, default=1, help='load-generating processes')
+    parser.add_argument('--timeout', type=float, default=600, help='give up on unfinished participants after this')
+    parser.add_argument('--start-server', action='store_true',
+                        help='start dyadic_interaction_server.py (in a temporary folder) rather '
+                             'than testing one already running')
+    args = parser.parse_args()
+    server = start_server(args.host, args.port) if args.start_server else None
+    try:
+        run(args)
+    finally:
+        if server is not None:
+            stop_server(server)
+
+
+def run(args):
+    results = multiprocessing.Queue()
+    processes = []
+    for n in range(args.processes):
+        clients = args.clients // args.processes + (1 if n < args.clients % args.processes else 0)
+        processes.append(multiprocessing.Process(target=generate_load,
+                                                 args=(args, '%d_%d' % (os.getpid(), n), clients,
+                                                       args.spawn_rate / args.processes, results)))
+    for process in processes:
+        process.start()
+    stats = Stats()
+    elapsed = 0
+    for _ in processes:
+        process_stats, process_elapsed = results.get()
+        stats.merge(process_stats)
+        elapsed = max(elapsed, process_elapsed)
+    for process in processes:
+        process.join()
+    report(stats, elapsed, args.clients)
+
+
+if __name__ == '__main__':
+    main()
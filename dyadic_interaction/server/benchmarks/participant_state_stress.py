@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+
+# Stress test for the participant state handling in dyadic_interaction_server.py.
+# Thousands of simulated clients connect, pair up, play through the director/matcher
+# trials and (some of them) drop out - for good, or just for a moment before
+# reconnecting and carrying on - with their responses fired at the server
+# from a pool of threads, just as the threaded websocket server would. No sockets are
+# involved - the experiment's functions are called directly and the messages it sends
+# are captured - so this exercises only the experiment logic and its state.
+# At the end every dyad's message history is checked for corruption: partners that
+# don't agree who they are paired with, clients paired twice, roles that don't
+# alternate, lost or duplicated trials, and leftover state for disconnected clients.
+
+# python participant_state_stress.py --clients 10000
+# runs events through the StateActor, as the real server does, and should report no
+# problems. Adding --no-actor calls the functions straight from the worker threads,
+# which is how the server used to work, and every few runs shows the races that
+# caused (KeyErrors, dyads stuck waiting for each other).
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import argparse
+import threading
+import logging
+import contextlib
+import csv
+import shutil
+import tempfile
+from collections import defaultdict
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dyadic_interaction_server as experiment
+
+
+class SimulatedHandler(object):
+    # stands in for the websocket handler, which the experiment's encoder asks
+    # what the client speaks
+    subprotocol = None
+
+
+class SimulatedClient(object):
+    """
+    One participant. React to server commands the way dyadic_interaction.js
+    does, except that each reaction might instead be to drop out - and maybe
+    reconnect on a new connection.
+    """
+
+    def __init__(self, client_id, sim):
+        self.client = {'id': client_id, 'handler': SimulatedHandler(), 'address': ('simulated', client_id)}
+        self.id = client_id
+        self.participant_id = 'participant_%d' % client_id
+        self.sim = sim
+        self.received = []
+        # commands re-sent after reconnecting, which the client ignores as it is
+        # still working on them - and PartnerReconnecting/PartnerReconnected
+        self.resent = []
+        self.notices = []
+        self.last_command = None
+        self.reconnecting = False
+        self.reconnections = 0
+        self.connected = True
+        self.outcome = 'waiting'  # finished, stranded, dropped out, or still waiting
+
+    def connect(self, resuming=False):
+        self.sim.dispatch(experiment.new_client, self.client, None)
+        self.respond({'response_type': 'CLIENT_INFO', 'client_info': self.participant_id,
+                      'resuming': resuming})
+
+    def reconnect(self):
+        # the connection drops and the client reconnects - the server may or may not
+        # have noticed the old connection close by the time the new one arrives
+        old_client = self.client
+        client_id = self.sim.new_connection(self)
+        self.client = {'id': client_id, 'handler': SimulatedHandler(), 'address': ('simulated', client_id)}
+        self.reconnecting = True
+        self.reconnections += 1
+        if random.random() < 0.5:
+            self.sim.dispatch(experiment.client_left, old_client, None)
+            self.connect(resuming=True)
+        else:
+            self.connect(resuming=True)
+            self.sim.dispatch(experiment.client_left, old_client, None)
+
+    def respond(self, response):
+        self.sim.dispatch(experiment.message_received, self.client, None, json.dumps(response))
+
+    def disconnect(self, outcome):
+        if self.connected:
+            self.connected = False
+            self.outcome = outcome
+            self.sim.dispatch(experiment.client_left, self.client, None)
+
+    def react(self, command):
+        if not self.connected:
+            return
+        command_type = command['command_type']
+        if command_type in ('Instructions', 'Director', 'Matcher', 'Feedback') \
+                and random.random() < self.sim.dropout_rate:
+            if random.random() < self.sim.reconnect_rate:
+                self.reconnect()
+            else:
+                self.disconnect('dropped out')
+        elif command_type in ('PartnerReconnecting', 'PartnerReconnected'):
+            pass
+        elif command_type == 'Instructions':
+            self.respond({'response_type': 'INTERACTION_INSTRUCTIONS_COMPLETE'})
+        elif command_type == 'Director':
+            self.respond({'response_type': 'RESPONSE', 'role': 'Director',
+                          'target_object': command['target_object'],
+                          'response': random.choice(['wug', 'dax', 'blicket'])})
+        elif command_type == 'Matcher':
+            self.respond({'response_type': 'RESPONSE', 'role': 'Matcher',
+                          'director_label': command['director_label'],
+                          'response': random.choice(command['object_choices'])})
+        elif command_type == 'Feedback':
+            self.respond({'response_type': 'FINISHED_FEEDBACK'})
+        elif command_type == 'EndExperiment':
+            self.disconnect('finished')
+        elif command_type == 'PartnerDropout':
+            self.disconnect('stranded')
+
+
+class Simulation(object):
+
+    def __init__(self, n_clients, n_threads, dropout_rate, reconnect_rate, use_actor):
+        self.dropout_rate = dropout_rate
+        self.reconnect_rate = reconnect_rate
+        self.use_actor = use_actor
+        self.clients = {}
+        # client ID -> SimulatedClient, for every connection including reconnections
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        self.tasks = queue.Queue()
+        self.errors = []
+        self.messages_sent = 0
+        self.events = 0
+        self.events_lock = threading.Lock()
+        self.actor = experiment.StateActor()
+        for client_id in range(1, n_clients + 1):
+            self.clients[client_id] = self.connections[client_id] = SimulatedClient(client_id, self)
+        self.workers = [threading.Thread(target=self.work) for _ in range(n_threads)]
+        for worker in self.workers:
+            worker.daemon = True
+
+    def new_connection(self, sim_client):
+        with self.connections_lock:
+            client_id = len(self.connections) + 1
+            self.connections[client_id] = sim_client
+        return client_id
+
+    # stand in for server.send_prepared_message and server.send_message
+    def send_prepared_message(self, client, prepared):
+        self.send_message(client, prepared.payload)
+
+    def send_message(self, client, message):
+        self.messages_sent += 1
+        sim_client = self.connections[client['id']]
+        command = json.loads(message)
+        if command['command_type'] in ('PartnerReconnecting', 'PartnerReconnected'):
+            sim_client.notices.append(command)
+        elif sim_client.reconnecting and command == sim_client.last_command:
+            sim_client.resent.append(command)
+            sim_client.reconnecting = False
+        else:
+            sim_client.received.append(command)
+            sim_client.last_command = command
+            sim_client.reconnecting = False
+        self.tasks.put((sim_client.react, (command,)))
+
+    def dispatch(self, fn, *args):
+        with self.events_lock:
+            self.events += 1
+        if self.use_actor:
+            self.actor.submit(fn, *args)
+        else:
+            try:
+                fn(*args)
+            except Exception as e:
+                self.errors.append('%s in %s: %r' % (type(e).__name__, fn.__name__, e))
+
+    def work(self):
+        while True:
+            fn, args = self.tasks.get()
+            try:
+                fn(*args)
+            finally:
+                self.tasks.task_done()
+
+    def wait_until_quiet(self):
+        # done when neither the worker threads nor the actor have anything left to do
+        while True:
+            self.tasks.join()
+            self.actor.wait_until_idle()
+            if self.tasks.unfinished_tasks == 0:
+                return
+
+    def run(self):
+        experiment.server = self
+        # the StateActor logs (rather than raises) errors, so collect them from the log
+        sim = self
+        class ErrorCollector(logging.Handler):
+            def emit(self, record):
+                sim.errors.append(record.getMessage() + ': ' + repr(record.exc_info[1]))
+        logging.getLogger('participant_state').addHandler(ErrorCollector())
+        logging.getLogger('participant_state').propagate = False
+        # and the experiment's own warnings (e.g. participants not reconnecting) are expected
+        logging.getLogger('dyadic').propagate = False
+        logging.getLogger('dyadic').addHandler(logging.NullHandler())
+        # trial data goes to a temporary directory, checked and then deleted by check()
+        self.trial_data_directory = tempfile.mkdtemp()
+        experiment.trial_data.directory = self.trial_data_directory
+        experiment.trial_data.start()
+        experiment.journal.directory = os.path.join(self.trial_data_directory, 'server_state')
+        experiment.journal.start()
+        self.actor.start()
+        for worker in self.workers:
+            worker.start()
+        start = time.time()
+        # the server prints a lot, which we don't want to see
+        with contextlib.redirect_stdout(io.StringIO()):
+            # clients arrive from all the worker threads at once
+            for sim_client in self.clients.values():
+                self.tasks.put((sim_client.connect, ()))
+            self.wait_until_quiet()
+            # rather than waiting RECONNECT_GRACE_PERIOD, give up on anyone who dropped
+            # out and hasn't come back, which strands their partners
+            self.dispatch(give_up_on_absent_participants)
+            self.wait_until_quiet()
+            # anyone left in the waiting room gives up
+            for sim_client in self.clients.values():
+                if sim_client.connected:
+                    self.tasks.put((sim_client.disconnect, ('still waiting',)))
+            self.wait_until_quiet()
+        self.elapsed = time.time() - start
+        self.actor.stop()
+        experiment.trial_data.close()
+        experiment.journal.close()
+
+
+def give_up_on_absent_participants():
+    for participant_id in experiment.reconnect_deadlines:
+        experiment.reconnect_deadlines[participant_id] = 0
+    experiment.check_absent_participants()
+
+
+def check(sim):
+    problems = list(sim.errors)
+    n_trials = len(experiment.target_list)
+    by_participant_id = dict((c.participant_id, c) for c in sim.clients.values())
+    # who each client was told their partner is, in Director and Matcher commands
+    partners = {}
+    for c in sim.clients.values():
+        told = set(cmd['partner_id'] for cmd in c.received if 'partner_id' in cmd)
+        if len(told) > 1:
+            problems.append('client %d was given %d different partners' % (c.id, len(told)))
+        if told:
+            partners[c.participant_id] = told.pop()
+    for participant_id, partner_id in partners.items():
+        if partner_id == participant_id:
+            problems.append('%s was paired with themselves' % participant_id)
+        elif partners.get(partner_id, participant_id) != participant_id:
+            problems.append('%s thinks their partner is %s, who disagrees' % (participant_id, partner_id))
+    for c in sim.clients.values():
+        commands = [cmd['command_type'] for cmd in c.received]
+        if commands.count('WaitingRoom') != 1:
+            problems.append('client %d entered the waiting room %d times' % (c.id, commands.count('WaitingRoom')))
+        if commands.count('EndExperiment') > 1 or commands.count('Instructions') > 1:
+            problems.append('client %d was sent duplicate commands' % c.id)
+        roles = [cmd for cmd in commands if cmd in ('Director', 'Matcher')]
+        if any(a == b for a, b in zip(roles, roles[1:])):
+            problems.append('client %d did not alternate roles: %s' % (c.id, roles))
+        if c.outcome == 'finished':
+            if commands.count('Feedback') != n_trials or len(roles) != n_trials:
+                problems.append('client %d finished after %d trials (%d roles), not %d' %
+                                (c.id, commands.count('Feedback'), len(roles), n_trials))
+            partner = by_participant_id.get(partners.get(c.participant_id))
+            if partner is None:
+                problems.append('client %d finished without a partner' % c.id)
+            else:
+                mine = [(f['target'], f['label'], f['guess']) for f in c.received if f['command_type'] == 'Feedback']
+                theirs = [(f['target'], f['label'], f['guess']) for f in partner.received if f['command_type'] == 'Feedback']
+                if mine != theirs:
+                    problems.append('clients %d and %d got different feedback' % (c.id, partner.id))
+        if c.outcome == 'waiting':
+            problems.append('client %d was never disconnected' % c.id)
+    # at most one client can legitimately be left over, waiting for a partner
+    stuck = [c.id for c in sim.clients.values() if c.outcome == 'still waiting']
+    if len(stuck) > 1:
+        problems.append('%d clients stuck (never finished or got PartnerDropout): %s' % (len(stuck), stuck[:10]))
+    if experiment.global_participant_data:
+        problems.append('%d disconnected clients left in global_participant_data' % len(experiment.global_participant_data))
+    if experiment.absent_participants or experiment.reconnect_deadlines:
+        problems.append('%d participants still waited for after everyone left' % len(experiment.absent_participants))
+    if experiment.matchmaker.waiting_count():
+        problems.append('%d disconnected clients left in the waiting room' % experiment.matchmaker.waiting_count())
+    # every trial of every dyad that finished should have been saved exactly once
+    saved = defaultdict(list)
+    for filename in os.listdir(sim.trial_data_directory):
+        if not filename.endswith('.csv'):
+            continue
+        with open(os.path.join(sim.trial_data_directory, filename)) as f:
+            for row in csv.DictReader(f):
+                saved[row['director_id']].append(row)
+                saved[row['matcher_id']].append(row)
+    # everyone has left, so there should be no saved state to restore
+    leftover_state = experiment.StateJournal(experiment.journal.directory).restore()
+    if leftover_state:
+        problems.append('%d participants left in the state journal' % len(leftover_state))
+    shutil.rmtree(sim.trial_data_directory)
+    for c in sim.clients.values():
+        if c.outcome == 'finished' and len(saved[c.participant_id]) != n_trials:
+            problems.append('client %d finished but %d trials were saved, not %d' %
+                            (c.id, len(saved[c.participant_id]), n_trials))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stress test the dyadic server participant state.')
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--dropout', type=float, default=0.002,
+                        help='probability of dropping out instead of responding to each command')
+    parser.add_argument('--reconnect', type=float, default=0.5,
+                        help='probability that a client dropping out reconnects')
+    parser.add_argument('--no-actor', action='store_true',
+                        help='call the experiment functions directly from the worker threads')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    # switch between threads far more often than python normally does, so that
+    # any unprotected read-modify-write of the state is likely to be interrupted
+    sys.setswitchinterval(1e-6)
+
+    sim = Simulation(args.clients, args.threads, args.dropout, args.reconnect, not args.no_actor)
+    sim.run()
+    outcomes = defaultdict(int)
+    for c in sim.clients.values():
+        outcomes[c.outcome] += 1
+    print('%d clients, %d events, %d messages sent in %.2fs (%.0f events/s)' %
+          (args.clients, sim.events, sim.messages_sent, sim.elapsed, sim.events / sim.elapsed))
+    print('outcomes: ' + ', '.join('%s %d' % item for item in sorted(outcomes.items())))
+    print('reconnections: %d, commands re-sent %d' % (sum(c.reconnections for c in sim.clients.values()),
+                                                      sum(len(c.resent) for c in sim.clients.values())))
+    print('matchmaking: ' + ', '.join('%s %s' % item for item in sorted(experiment.matchmaker.stats().items())))
+    print('trial data: ' + ', '.join('%s %s' % item for item in sorted(experiment.trial_data.stats().items())))
+    print('journal: ' + ', '.join('%s %s' % item for item in sorted(experiment.journal.stats().items())))
+    timings = experiment.phases.stats()
+    for kind in ('enter', 'response'):
+        print('%s handlers: ' % kind + ', '.join('%s %.1fus' % (key, 1e6 * timing['mean'])
+                                                for key, timing in sorted(timings[kind].items())))
+    problems = check(sim)
+    if problems:
+        print('%d PROBLEMS, e.g.:' % len(problems))
+        for problem in problems[:20]:
+            print('  ' + problem)
+        sys.exit(1)
+    print('no problems found')
+
+
+if __name__ == '__main__':
+    main()
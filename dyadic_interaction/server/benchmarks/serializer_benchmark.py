@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of encoding messages for clients, and decoding their responses, with each
+# of the serializers in serializers.py. Sends a whole experiment's worth of the commands
+# dyadic_interaction_server.py sends (through a websocket handler whose socket is
+# replaced by a no-op, so only encoding and framing are timed) and decodes the responses
+# clients send back. Compares
+# - the way messages used to be sent: json.dumps, then server.send_message
+# - each serializer with PreparedMessage, without and with commands that are the same
+#   for everyone (WaitForPartner etc) being encoded and framed only once
+# Serializers that aren't installed (orjson, msgpack) are left out. Run with
+# python serializer_benchmark.py
+
+import os
+import sys
+import json
+import random
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from websocket_server.websocket_server import FrameHandlingMixin, PreparedMessage, DEFAULT_MAX_FRAME_SIZE
+from serializers import (MessageEncoder, JsonSerializer, OrjsonSerializer, MsgpackSerializer,
+                         orjson, msgpack)
+
+N_PARTICIPANTS = 200
+N_TRIALS = 40
+REPEATS = 5
+
+
+class Server(object):
+    max_frame_size = DEFAULT_MAX_FRAME_SIZE
+
+
+class Handler(FrameHandlingMixin):
+    # Frames messages as for a real connection, and throws them away
+
+    def __init__(self, subprotocol=None):
+        self.server = Server()
+        self.send_lock = threading.Lock()
+        self.subprotocol = subprotocol
+
+    def _write_frames_(self, frames):
+        pass
+
+
+# One participant's commands for a whole experiment, as sent by dyadic_interaction_server.py
+def experiment_commands(participant):
+    commands = [{"command_type": "WaitingRoom"},
+                {"command_type": "Instructions", "instruction_type": "Interaction"}]
+    for trial_n in range(N_TRIALS):
+        target = random.choice(['object4', 'object5'])
+        label = random.choice(['wug', 'dax', 'blicket', 'toma'])
+        if trial_n % 2 == participant % 2:
+            commands += [{"command_type": "Director", "target_object": target,
+                          "partner_id": "participant_%d" % (participant ^ 1)},
+                         {"command_type": "WaitForPartner"}]
+        else:
+            commands += [{"command_type": "WaitForPartner"},
+                         {"command_type": "Matcher", "director_label": label,
+                          "object_choices": ['object4', 'object5'], "partner_id": "participant_%d" % (participant ^ 1)}]
+        commands.append({"command_type": "Feedback", "score": 1, "target": target, "label": label, "guess": target})
+    return commands + [{"command_type": "EndExperiment"}]
+
+# And their responses
+def experiment_responses(participant):
+    responses = [{'response_type': 'CLIENT_INFO', 'client_info': 'participant_%d' % participant},
+                 {'response_type': 'INTERACTION_INSTRUCTIONS_COMPLETE'}]
+    for trial_n in range(N_TRIALS):
+        responses += [{'response_type': 'RESPONSE', 'participant': 'participant_%d' % participant,
+                       'partner': 'participant_%d' % (participant ^ 1), 'role': 'Director',
+                       'target_object': 'object4', 'response': random.choice(['wug', 'dax'])},
+                      {'response_type': 'FINISHED_FEEDBACK'}]
+    return responses
+
+
+class Uncached(MessageEncoder):
+    # A MessageEncoder encoding every message afresh
+    def encode(self, message, client):
+        serializer = self.serializer_for(client)
+        return PreparedMessage(serializer.dumps(message), serializer.binary)
+
+
+def best_of(fn):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+random.seed(1)
+commands = [(p, c) for p in range(N_PARTICIPANTS) for c in experiment_commands(p)]
+responses = [r for p in range(N_PARTICIPANTS) for r in experiment_responses(p)]
+print('%d commands to and %d responses from %d participants' % (len(commands), len(responses), N_PARTICIPANTS))
+
+serializers = [JsonSerializer()]
+if orjson is not None:
+    serializers.append(OrjsonSerializer())
+if msgpack is not None:
+    serializers.append(MsgpackSerializer())
+else:
+    print('(msgpack not installed, leaving it out)')
+
+def send_as_before():
+    client = {'handler': Handler()}
+    for _, command in commands:
+        client['handler'].send_text(json.dumps(command))
+
+print('%-36s %14s %14s %12s' % ('', 'encode+frame us', 'decode us', 'bytes/msg'))
+baseline = best_of(send_as_before)
+encoded = [json.dumps(r) for r in responses]
+decode_baseline = best_of(lambda: [json.loads(r) for r in encoded])
+size = sum(len(json.dumps(c).encode('utf-8')) for _, c in commands) / float(len(commands))
+print('%-36s %14.2f %14.2f %12.1f' % ('json.dumps + send_message', 1e6 * baseline / len(commands),
+                                      1e6 * decode_baseline / len(responses), size))
+
+for serializer in serializers:
+    subprotocol = serializer.name if serializer.binary else None
+    client = {'handler': Handler(subprotocol)}
+    for name, encoder in [('', Uncached(default=serializer, subprotocols=[serializer])),
+                          (', constants cached', MessageEncoder(default=serializer, subprotocols=[serializer]))]:
+        def send():
+            for _, command in commands:
+                client['handler'].send_prepared(encoder.encode(command, client))
+        elapsed = best_of(send)
+        # (text messages reach the experiment as str, binary ones as bytes)
+        encoded = [serializer.dumps(r) if serializer.binary else serializer.dumps(r).decode('utf-8')
+                   for r in responses]
+        decode = best_of(lambda: [encoder.decode(r, client) for r in encoded])
+        size = sum(len(serializer.dumps(c)) for _, c in commands) / float(len(commands))
+        print('%-36s %14.2f %14.2f %12.1f   (%.1fx)' % (type(serializer).__name__ + name,
+                                                       1e6 * elapsed / len(commands), 1e6 * decode / len(responses),
+                                                       size, baseline / elapsed))
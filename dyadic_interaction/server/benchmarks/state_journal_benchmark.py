@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark of the StateJournal the dyadic interaction server uses to survive restarts.
+# Records a day's worth of participant state changes (as the server saves them: the
+# whole of a participant's saved state, every time it changes), then times restoring
+# the state as a restarted server would - with and without snapshots along the way.
+# Run with
+# python state_journal_benchmark.py --participants 5000
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from state_journal import StateJournal
+
+
+def participant_state(participant_id, trial_n):
+    return {'phase': 'Interaction', 'role': random.choice(['Director', 'Matcher']),
+            'partner_participantID': 'partner_of_' + participant_id,
+            'trial_list': ['object4', 'object4', 'object4', 'object5'] * 2,
+            'shared_trial_counter': trial_n, 'dyad_id': participant_id + '_partner',
+            'last_command': {'command_type': 'Director', 'target_object': 'object4',
+                             'partner_id': 'partner_of_' + participant_id}}
+
+
+def run(participants, updates, still_active, snapshot_every):
+    directory = tempfile.mkdtemp()
+    try:
+        journal = StateJournal(directory, snapshot_every=snapshot_every)
+        journal.start()
+        start = time.time()
+        ids = ['participant_%d' % p for p in range(participants)]
+        for update in range(updates):
+            for participant_id in ids:
+                journal.record(participant_id, participant_state(participant_id, update))
+        # most participants have finished and left by the time of the restart
+        for participant_id in ids[still_active:]:
+            journal.remove(participant_id)
+        journal.close()
+        write_time = time.time() - start
+        journal_size = os.path.getsize(os.path.join(directory, 'journal.jsonl'))
+        restored = StateJournal(directory)
+        state = restored.restore()
+        assert len(state) == still_active
+        return journal.entries_written, write_time, journal.snapshots, journal_size, restored.restore_seconds
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the state journal.')
+    parser.add_argument('--participants', type=int, default=5000)
+    parser.add_argument('--updates', type=int, default=40, help='state changes per participant')
+    parser.add_argument('--active', type=int, default=200, help='participants still mid-experiment at the restart')
+    args = parser.parse_args()
+    random.seed(1)
+    print('%-28s %10s %12s %10s %14s %12s' % ('', 'entries', 'entries/s', 'snapshots', 'journal bytes', 'restore ms'))
+    for name, snapshot_every in [('no snapshots', 10 ** 9), ('snapshot every 10000', 10000)]:
+        entries, write_time, snapshots, size, restore_time = run(args.participants, args.updates,
+                                                                 args.active, snapshot_every)
+        print('%-28s %10d %12.0f %10d %14d %12.1f' % (name, entries, entries / write_time, snapshots,
+                                                       size, 1000 * restore_time))
+
+
+if __name__ == '__main__':
+    main()
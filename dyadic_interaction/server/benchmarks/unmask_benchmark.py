@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+# Micro-benchmark of the ways websocket_server can unmask a client frame payload.
+# Run from anywhere with
+# python unmask_benchmark.py
+# and it prints throughput in MB/s for each method at each frame size.
+
+import os
+import sys
+import timeit
+
+# websocket_server lives in the directory above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from websocket_server import websocket_server as ws
+
+frame_sizes = [('100 B', 100), ('10 KB', 10 * 1024), ('1 MB', 1024 * 1024)]
+
+methods = [('bytewise', ws.unmask_bytewise), ('int.from_bytes', ws.unmask_int)]
+if ws.numpy is not None:
+    methods.append(('numpy', ws.unmask_numpy))
+else:
+    print('(numpy not installed, skipping the numpy method)')
+
+# Runs fn on payload repeatedly for at least 0.2 seconds, returns MB/s
+def throughput(fn, payload, masks):
+    timer = timeit.Timer(lambda: fn(payload, masks))
+    number, elapsed = timer.autorange()
+    # autorange stops at >=0.2s, so repeat a couple of times and keep the best
+    best = min([elapsed] + timer.repeat(repeat=2, number=number))
+    return len(payload) * number / best / (1024 * 1024)
+
+masks = os.urandom(4)
+print('%-8s %-16s %12s' % ('frame', 'method', 'MB/s'))
+for label, size in frame_sizes:
+    payload = os.urandom(size)
+    expected = ws.unmask_bytewise(payload, masks)
+    for name, fn in methods:
+        # sanity check that every method agrees with the original loop
+        assert fn(payload, masks) == expected
+        print('%-8s %-16s %12.1f' % (label, name, throughput(fn, payload, masks)))
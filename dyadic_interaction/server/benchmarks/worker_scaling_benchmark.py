@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Load test of worker_server.py: how many messages a second the dyadic interaction
+# server handles when run as 1, 2, 4... worker processes. For each number of workers,
+# starts the server (in a temporary folder, logging to a file there), then has several
+# load-generating processes connect simulated participants over real sockets (see
+# load_test.py). Each participant plays the experiment as fast as it can, with no think
+# time, and as soon as one finishes another connects in its place. Reports
+# messages per second (to and from the server together) over the measuring period, how
+# many dyads finished, and how many participants ended up with a partner on another
+# worker (and so were handed over). Needs Linux. Run with
+# python worker_scaling_benchmark.py --workers 1 2 4 --participants 400
+# The load generators need cores too, so expect messages/sec to stop growing once the
+# server workers and load generators together use up all the cores.
+
+import os
+import sys
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+from load_test import SimulatedParticipant, ParticipantLoop, raise_file_limit
+
+SERVER_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate_load(port, participants, warmup, duration, name, results):
+    # Keeps participants connected, replacing each one that finishes, and counts the
+    # messages sent and received, and the participants who finish, between the end of
+    # the warm-up and the end
+    raise_file_limit()
+    count = [0]
+
+    def connect(finished=None):
+        if finished is not None and finished.sock is None:
+            return  # couldn't connect at all, so don't keep trying
+        count[0] += 1
+        loop.add(SimulatedParticipant(loop, '%s_%d' % (name, count[0])))
+
+    loop = ParticipantLoop('127.0.0.1', port, '/ws1/', on_finished=connect)
+    for _ in range(participants):
+        connect()
+    stats = loop.stats
+    measure_from = time.time() + warmup
+    loop.run(lambda: time.time() >= measure_from)
+    messages_at_start = stats.sent + stats.received
+    outcomes_at_start = stats.outcomes.copy()
+    loop.run(lambda: time.time() >= measure_from + duration)
+    outcomes = stats.outcomes - outcomes_at_start
+    results.put((stats.sent + stats.received - messages_at_start, outcomes['completed'],
+                 outcomes['partner_dropped_out']))
+
+
+def run_server(workers, port, directory):
+    code = ('import sys; sys.path.insert(0, %r); import worker_server as w; '
+            'w.WORKERS = %d; w.PORT = %d; w.STATE_DIRECTORY = %r; w.LOG_FILE = %r; '
+            'w.COORDINATOR_SOCKET = %r; w.run()'
+            % (SERVER_DIRECTORY, workers, port, os.path.join(directory, 'server_state'),
+               os.path.join(directory, 'server_log.jsonl'), os.path.join(directory, 'coordinator.sock')))
+    return subprocess.Popen([sys.executable, '-c', code], cwd=directory)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+
+def handovers(directory):
+    # counted from the server log
+    count = 0
+    with open(os.path.join(directory, 'server_log.jsonl')) as f:
+        for line in f:
+            if 'over from another worker' in line:
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the dyadic server run as several workers.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--participants', type=int, default=400, help='connected at any one time')
+    parser.add_argument('--generators', type=int, default=4, help='load-generating processes')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds before measuring')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to measure for')
+    parser.add_argument('--port', type=int, default=9301)
+    args = parser.parse_args()
+    print('%d cores; %d participants from %d load generators' % (os.cpu_count(), args.participants, args.generators))
+    print('%8s %14s %14s %10s %12s' % ('workers', 'messages/sec', 'dyads/sec', 'dropouts', 'handed over'))
+    for workers in args.workers:
+        directory = tempfile.mkdtemp()
+        port = args.port
+        server = run_server(workers, port, directory)
+        try:
+            wait_for_port(port)
+            time.sleep(0.5)  # for every worker to be listening
+            results = multiprocessing.Queue()
+            generators = [multiprocessing.Process(target=generate_load,
+                                                  args=(port, args.participants // args.generators,
+                                                        args.warmup, args.duration, 'g%d' % g, results))
+                          for g in range(args.generators)]
+            for generator in generators:
+                generator.start()
+            totals = [results.get() for _ in generators]
+            for generator in generators:
+                generator.join()
+            messages = sum(t[0] for t in totals)
+            finished = sum(t[1] for t in totals)
+            dropouts = sum(t[2] for t in totals)
+        finally:
+            server.terminate()
+            server.wait()
+        print('%8d %14.0f %14.1f %10d %12d' % (workers, messages / args.duration, finished / 2.0 / args.duration,
+                                               dropouts, handovers(directory)))
+        shutil.rmtree(directory)
+        args.port += 1
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,905 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### The dyadic interaction experiment, shared by every version of it
+##############
+
+# See dyadic_interaction.js for a summary of the communication channel - we are using
+# json-encoded dictionaries to send messages back and forth between server and client.
+
+# Each message from the server to the client includes a key command_type which
+# lets the client know what action to take.
+
+# Each message from the client to the server includes a key response_type, which
+# indicates the kind of response the client is providing.
+
+# This file isn't run or imported by itself. Each version of the experiment has a file
+# of its own - dyadic_interaction_server.py, dyadic_interaction_server_extended.py -
+# setting what differs between them:
+# - target_list, the target objects the director is shown, one per trial
+# - object_choices, the objects the matcher chooses between
+# - TRIAL_DATA_PREFIX, the start of the name of each dyad's trial data file
+# - PORT and METRICS_PORT, the ports it is served on
+# which then runs this file in its own namespace (see the end of dyadic_interaction_server.py).
+# So each version gets its own copy of everything here - global_participant_data,
+# matchmaker etc - just as if it were all in the experiment file, and running the
+# experiment file (python dyadic_interaction_server.py) starts the server as usual.
+
+
+##############
+##### Libraries
+##############
+
+# NB this loads the code from the websocket_server folder, which needs to be in the
+# same directory as this file.
+from websocket_server import WebsocketServer
+from websocket_server.heartbeat import TimerWheel
+# participant_state.py also needs to be in the same directory as this file
+from participant_state import StateActor
+# as does matchmaking.py
+from matchmaking import Matchmaker
+# and phase_machine.py
+from phase_machine import PhaseMachine
+# and experiment_logging.py
+from experiment_logging import setup_logging
+# and trial_data.py
+from trial_data import TrialDataSink
+# and state_journal.py
+from state_journal import StateJournal
+# and metrics.py
+from metrics import MetricsRegistry, MetricsServer, add_server_metrics, render, COLLECT_TIMEOUT
+
+from serializers import MessageEncoder
+import logging
+import random
+import time
+import csv
+from copy import deepcopy
+
+
+
+######################
+##### Globals to manage experiment progress
+######################
+
+# We use several global variables to keep track of important information on
+# connected clients, which stage of the experiment they are at etc - then when
+# we receive a response from a client we can consult this information to see
+# where they are in the experiment and what they should do next.
+
+# The main global variable is a dictionary, global_participant_data
+# Each connected client has an entry in here, indexed by their ID (an integer assigned
+# when they connect). Stored alongside their entry is all the information we need to guide
+# them through the experiment, including their client_info (details of the socket etc
+# that is required for message passing), the ID of their partner, their current role (e.g.
+# director or matcher), their list of trials, the trial counter showing where they are in
+# the experiment.
+# Keys are client_info, partner, role, trial_list, shared_trial_counter
+global_participant_data = {}
+
+# Clients who are in the waiting room waiting to be paired are held by the matchmaker
+# (see matchmaking.py), which hands back a pair as soon as two compatible clients are
+# waiting. group_size could be larger for experiments with triads etc, but the trials
+# below are written for pairs. Clients are never paired with another connection from
+# the same participant ID, or with someone they have already been paired with, and are
+# released from the waiting room if nobody turns up for them within the timeout (in
+# seconds).
+matchmaker = Matchmaker(group_size=2,timeout=10*60,avoid_repeat_partners=True)
+
+# The websocket server calls new_client, client_left and message_received from a separate
+# thread for each client, so two clients' messages can be handled at the same moment. To
+# stop them tripping over each other while changing the globals above, these functions
+# are run by state_actor, which handles events one at a time on a single thread - see
+# participant_state.py. Everything below can therefore assume nothing else is changing
+# global_participant_data or matchmaker while it runs.
+state_actor = StateActor()
+
+# The list of phases in the experiment - clients progress through this list
+# ***NB phases have to be uniquely named***, because phases (see phase_machine.py)
+# looks them up by name to identify where in the experiment the client is.
+phase_sequence = ['Start','PairParticipants','Interaction','End']
+phases = PhaseMachine(phase_sequence,global_participant_data)
+
+# Rather than printing, we log what happens (see experiment_logging.py): experiment
+# progress to the dyadic logger, and every message clients send us to dyadic.messages,
+# which is much higher volume so is only logged at DEBUG level
+logger = logging.getLogger('dyadic')
+message_logger = logging.getLogger('dyadic.messages')
+
+# How the experiment is doing - messages in and out, how long handling them takes, people
+# dropping out, and (see "Metrics" below) how many clients are in each phase, how long the
+# waiting room is etc - is kept in metrics (see metrics.py) and served over HTTP on
+# METRICS_PORT, for monitoring the server while it runs. Counting is cheap enough to do for
+# every message; anything that means looking through all the clients is only worked out
+# when the metrics are collected.
+metrics = MetricsRegistry()
+messages_received = metrics.counter('dyadic_messages_received_total','Messages received from clients',
+                                    'response_type')
+messages_sent = metrics.counter('dyadic_messages_sent_total','Messages sent to clients','command_type')
+handler_seconds = metrics.histogram('dyadic_handler_seconds','Time handling a message from a client',
+                                    'response_type')
+dropouts = metrics.counter('dyadic_dropouts_total','Participants leaving part way through the experiment',
+                           'reason')
+reconnects = metrics.counter('dyadic_reconnects_total','Participants carrying on after reconnecting')
+
+# Messages to and from clients are encoded and decoded by encoder (see serializers.py):
+# JSON, unless a client asks for MessagePack when connecting. Commands that are the same
+# for everyone, like {"command_type":"WaitingRoom"}, are only encoded once and then sent
+# as they are to everyone who gets them.
+encoder = MessageEncoder()
+
+# The outcome of every interaction trial is saved by the server, one file per dyad, in
+# the server_data folder (see trial_data.py). Records are written out in batches in the
+# background; the file is flushed to disk when one of the dyad disconnects.
+trial_data = TrialDataSink('server_data',
+                           fields=['dyad_id','trial_n','director_id','matcher_id',
+                                   'target','label','guess','score','time'],
+                           file_format='csv',prefix=TRIAL_DATA_PREFIX)
+
+# A copy of the state of every participant in a dyad is kept on disk in the server_state
+# folder (see state_journal.py), so that if the server is restarted dyads can carry on
+# where they left off once their clients reconnect. JOURNAL_KEYS are the parts of their
+# entry in global_participant_data that are saved, indexed by participant ID (client IDs
+# start again from 1 when the server restarts).
+journal = StateJournal('server_state')
+JOURNAL_KEYS = ['phase','role','partner_participantID','trial_list','shared_trial_counter',
+                'dyad_id','last_command']
+# Participant ID -> client ID, for clients currently connected
+client_by_participant_id = {}
+# Participants part way through the experiment who aren't connected at the moment - their
+# connection dropped, or the server restarted - but might yet come back (see "Reconnecting"
+# below). Indexed by participant ID, absent_participants holds their saved state and
+# reconnect_deadlines the time at which we give up waiting for them.
+absent_participants = {}
+reconnect_deadlines = {}
+
+# A client who stops responding part way through (they have walked away, or their browser
+# has hung) would leave their partner waiting forever. So whenever we send a client one of
+# the COMMANDS_NEEDING_RESPONSE we note the time, and if they haven't responded within the
+# timeout for the phase they are in (PHASE_INACTIVITY_TIMEOUTS, below) they are dropped. The
+# times are filed in a timer wheel (see websocket_server/heartbeat.py), which is checked
+# once a second, rather than having a timer per client.
+COMMANDS_NEEDING_RESPONSE = ['Instructions','Director','Matcher','Feedback']
+inactivity_timers = TimerWheel(tick=1,clock=time.time)
+
+# In this experiment the director is prompted with a target object (from target_list, set by
+# the experiment file) and asked to provide a label for the matcher, who then guesses what
+# the target object was from object_choices.
+
+
+
+##############
+##### Utility functions
+##############
+
+# Returns randomised copy of l, i.e. does not shuffle in place
+def shuffle(l):
+    return random.sample(l, len(l))
+
+# Encodes message (see encoder above) and sends it to client_id.
+# See below for explanation of how client_id indexes into global_participant_data
+# The message is remembered as the client's last_command (which is what they are doing now)
+# and saved with the rest of their state, unless remember is False - for messages that
+# don't move the client on in the experiment
+def send_message_by_id(client_id,message,remember=True):
+    client = global_participant_data[client_id]['client_info']
+    server.send_prepared_message(client,encoder.encode(message,client))
+    messages_sent.inc(message['command_type'])
+    if remember:
+        global_participant_data[client_id]['last_command'] = message
+        save_participant_state(client_id)
+        if message['command_type'] in COMMANDS_NEEDING_RESPONSE:
+            expect_response(client_id)
+
+# Saves the parts of a paired participant's state needed to carry on after a restart to
+# the journal. Called whenever it changes - sending a message covers most changes, since
+# the server tells the client what to do next, but anything changing the state without
+# sending the client a message needs to call this itself.
+def save_participant_state(client_id):
+    data = global_participant_data[client_id]
+    if 'partner_participantID' in data:
+        journal.record(data['participantID'],dict((k,data[k]) for k in JOURNAL_KEYS if k in data))
+
+# Checks that all clients listed in list_of_ids are still connected to the server -
+# if so, clients will be in global_participant_data
+def all_connected(list_of_ids):
+    connected_status = [id in global_participant_data for id in list_of_ids]
+    if sum(connected_status)==len(list_of_ids):
+        return True
+    else:
+        return False
+
+# Called when a client drops out, used to notify any clients who are still connected
+# that this leaves them stranded.
+def notify_stranded(list_of_ids):
+    for id in list_of_ids:
+        if id in global_participant_data:
+            #this will notify the participant and cause them to disconnect
+            send_message_by_id(id,{"command_type":"PartnerDropout"})
+            leave_dyad(id)
+
+# Called once a client's dyad is over, whether they finished or were stranded: makes sure
+# the dyad's trial data is safely on disk, and forgets the client's saved state, so that
+# when they disconnect there is nothing to wait for
+def leave_dyad(client_id):
+    data = global_participant_data[client_id]
+    if 'partner_participantID' in data:
+        trial_data.finish(data['dyad_id'])
+        journal.remove(data['participantID'])
+        del data['partner_participantID']
+    data.pop('awaiting_response',None)
+
+
+
+######################
+##### Handling clients connecting, disconnecting, sending messages
+######################
+
+# Called for every client connecting (after handshake)
+# Initialiases that client in global_participant_data, then sends them to the
+# "Start" phase of the experiment
+# client objects passed over from the websocket behave like dictionaries including an id
+# key (the client's integer identifier) and a client_info key, which contains
+# technical details needed to communicate with this client via the socket
+def new_client(client, server):
+    client_id = client['id']
+    logger.info("New client connected and was given id %d", client_id, extra={'client_id':client_id})
+    global_participant_data[client_id] = {'client_info':client}
+    #give them the instructions for the first phase
+    enter_phase(client_id,"Start")
+
+
+# Called for every client disconnecting
+# Remove the client from the waiting room if appropriate
+# If they are part way through the experiment with a partner, this may just be a blip in
+# their connection, so their state is kept for RECONNECT_GRACE_PERIOD seconds in case they
+# come back, and their partner is asked to wait for them (see set_aside_participant below)
+# Otherwise their dyad (if any) is over
+# Remove the client from global_participant_data
+def client_left(client, server):
+    client_id = client['id']
+    logger.info("Client(%d) disconnected", client_id, extra={'client_id':client_id})
+    matchmaker.remove(client_id)
+    data = global_participant_data[client_id]
+    if 'partner_participantID' in data and data['phase']!='End':
+        dropouts.inc('disconnected')
+        set_aside_participant(client_id,RECONNECT_GRACE_PERIOD)
+    else:
+        leave_dyad(client_id)
+    participant_id = data.get('participantID')
+    if client_by_participant_id.get(participant_id)==client_id:
+        del client_by_participant_id[participant_id]
+    del global_participant_data[client_id]
+
+
+# Called when the server receives a message from the client.
+# Simply parses the message to a dictionary using encoder.decode, reads off
+# the response_type, and passes to handle_client_response
+def message_received(client, server, message):
+	start = time.time()
+	message_logger.debug("Client(%d) said: %s", client['id'], message)
+	#OK, now we have to handle the various possible responses
+	response = encoder.decode(message,client)
+	response_code =  response['response_type']
+	messages_received.inc(response_code)
+	handle_client_response(client['id'],response_code,response)
+	handler_seconds.observe(time.time()-start,response_code)
+
+
+##########################
+### Management of phases
+##########################
+
+# We use a list of named phases to manage client progression through the experiment -
+# when one phase ends they move onto the next, which determines what messages they
+# will receive from the server.
+# The phases object (see phase_machine.py) keeps track of which phase each client is
+# in and runs the function registered with @phases.on_enter when a client enters a
+# phase. Phases without a registered function (none in this experiment) do nothing.
+
+# Simply looks up the client's current phase and moves them to the next phase
+progress_phase = phases.progress_phase
+
+# enter_phase updates the client's phase and triggers actions associated with that phase.
+enter_phase = phases.enter_phase
+
+# Start: wait for the client to send their participant ID (CLIENT_INFO, which the
+# client sends as soon as it connects) - handle_client_info then progresses them to
+# the next phase. In some experiments we will need to set stuff up when the participant
+# starts the experiment
+@phases.on_enter('Start')
+def enter_start(client_id):
+    expect_response(client_id)
+
+# PairParticipants: attempt to pair immediately with anyone in the waiting room,
+# otherwise send to the waiting room
+@phases.on_enter('PairParticipants')
+def enter_pair_participants(client_id):
+    #send message to the client sending them to waiting room
+    send_message_by_id(client_id,{"command_type":"WaitingRoom"})
+    #add to the waiting room - if that makes a pair, they are taken out of the waiting
+    #room and returned, otherwise pair is None
+    pair = matchmaker.add(client_id,worker_id=global_participant_data[client_id]['participantID'])
+    # If they can be immediately paired, do so and progress to next phase
+    if pair:
+        pair_participants(*pair)
+
+# Links two clients from the waiting room as partners and moves them on to the next phase
+def pair_participants(unpaired_one,unpaired_two):
+    # (how long people wait is in the metrics, worked out only when they are collected)
+    logger.info("Paired clients %d and %d", unpaired_one, unpaired_two)
+    # Link them - mark them as each others' partner in global_participant_data
+    global_participant_data[unpaired_one]['partner']=unpaired_two
+    global_participant_data[unpaired_two]['partner']=unpaired_one
+    # The dyad's trial data will be saved under an ID made from both participant IDs
+    dyad_id = '%s_%s' % (global_participant_data[unpaired_one]['participantID'],
+                         global_participant_data[unpaired_two]['participantID'])
+
+    # Both participants will work through a shared target list, so store that info
+    # with both clients, then move them to the next phase
+    shuffled_targets = shuffle(target_list)
+    for c in [unpaired_one,unpaired_two]:
+        global_participant_data[c]['trial_list'] = shuffled_targets
+        global_participant_data[c]['shared_trial_counter'] = 0
+        global_participant_data[c]['dyad_id'] = dyad_id
+        global_participant_data[c]['partner_participantID'] = \
+            global_participant_data[global_participant_data[c]['partner']]['participantID']
+        progress_phase(c)
+
+# Interaction: once paired with a partner clients will end up here; Interaction phase
+# starts with instructions, so just send those instructions to the client
+@phases.on_enter('Interaction')
+def enter_interaction(client_id):
+    logger.debug('Initalising for interaction', extra={'client_id':client_id})
+    send_instructions(client_id,'Interaction')
+
+# End: the EndExperiment command will instruct the clients to end the experiment.
+@phases.on_enter('End')
+def enter_end(client_id):
+    send_message_by_id(client_id,{"command_type":"EndExperiment"})
+
+
+
+#################
+### Client loop, handling various client responses
+#################
+
+# Each response_type is handled by the function registered for it with
+# @phases.on_response - for RESPONSE there is one function for each role.
+# Response_code can be
+# CLIENT_INFO: the client passing over some info, in this case just a unique identifier
+# INTERACTION_INSTRUCTIONS_COMPLETE: client has finished reading the pre-interaction instructions
+# RESPONSE: if the client is in the Director role, this means they have produced a label which
+# can now be passed to the matcher (handle_director_response, below). If the client is the Matcher,
+# they have made their selection based on the clue provided by the director (handle_matcher_response).
+# FINISHED_FEEDBACK: the client has finished looking at the feedback screen indicating their
+# success in the interaction.
+# NONRESPONSIVE_PARTNER: the client is indicating that their partner has become non-responsive (NB this is
+# not implemented in the client)
+
+# Responses are not handled straight away in two cases: anything still arriving on the old
+# connection of a participant who has reconnected is ignored, and responses from a client
+# whose partner is away are held until their partner is back (see resume_participant)
+def handle_client_response(client_id,response_code,full_response):
+    data = global_participant_data[client_id]
+    if data.get('replaced'):
+        return
+    data.pop('awaiting_response',None)
+    if data.get('awaiting_partner') and response_code!='CLIENT_INFO':
+        data.setdefault('held_responses',[]).append(full_response)
+        return
+    phases.handle_response(client_id,response_code,full_response)
+
+# client is passing in a unique ID, simply associate that with this client - and if they
+# were part way through the experiment when they lost their connection (or the server
+# restarted), carry on from there
+@phases.on_response('CLIENT_INFO')
+def handle_client_info(client_id,full_response):
+    participant_id = full_response['client_info']
+    global_participant_data[client_id]['participantID']=participant_id
+    previous_id = client_by_participant_id.get(participant_id)
+    client_by_participant_id[participant_id]=client_id
+    #they have reconnected before we noticed their old connection had gone
+    if previous_id is not None and previous_id!=client_id and previous_id in global_participant_data:
+        replace_connection(previous_id)
+    if participant_id in absent_participants:
+        del reconnect_deadlines[participant_id]
+        resume_participant(client_id,absent_participants.pop(participant_id))
+    #the client says it was part way through with a partner, but we have given up on them
+    elif full_response.get('resuming'):
+        send_message_by_id(client_id,{"command_type":"PartnerDropout"})
+    elif global_participant_data[client_id]['phase']=='Start':
+        progress_phase(client_id)
+
+#interaction, instructions complete, can initiate actual interaction
+@phases.on_response('INTERACTION_INSTRUCTIONS_COMPLETE')
+def handle_instructions_complete(client_id,full_response):
+    initiate_interaction(client_id)
+
+#interaction feedback complete, next trial please
+@phases.on_response('FINISHED_FEEDBACK')
+def handle_finished_feedback(client_id,full_response):
+    swap_roles_and_progress(client_id)
+
+#client reporting a non-responsive partner - if we have been waiting for their partner to
+#respond for at least NONRESPONSIVE_REPORT_MIN seconds, the partner is dropped just as if
+#they had timed out, otherwise the report is ignored
+@phases.on_response('NONRESPONSIVE_PARTNER')
+def handle_nonresponsive_partner(client_id,full_response):
+    partner_id = global_participant_data[client_id].get('partner')
+    if partner_id is None or partner_id not in global_participant_data:
+        return
+    awaiting_response = global_participant_data[partner_id].get('awaiting_response')
+    if awaiting_response is not None and time.time()-awaiting_response[1]>=NONRESPONSIVE_REPORT_MIN:
+        drop_inactive_client(partner_id)
+    else:
+        logger.info("Client(%d) reported client %d as non-responsive, ignored", client_id, partner_id,
+                    extra={'client_id':client_id})
+
+
+
+#################
+### Interaction, handles trial progression etc
+#################
+
+# Runs when participants complete instructions.
+# Need to waits until both participants are ready to progress - use the role key for this,
+# mark participants as ReadyToInteract when they indicate they have finished reading the instructions.
+# Then when both participants are ready we randomly assigns roles of Director and Matcher and
+# start the first interaction trial.
+def initiate_interaction(client_id):
+    partner_id = global_participant_data[client_id]['partner']
+    list_of_participants = [client_id,partner_id]
+    #checking both players are still connected, to avoid one being left hanging
+    if not(all_connected(list_of_participants)):
+        notify_stranded(list_of_participants)
+    else:
+        send_message_by_id(client_id,{"command_type":"WaitForPartner"})
+        partner_role = global_participant_data[partner_id]['role']
+        #if your partnetr is ready to go, let's go!
+        if partner_role=='ReadyToInteract':
+            logger.info('Starting interaction for clients %d and %d', client_id, partner_id)
+            #allocate random director and matcher, and run start_interaction_trial for both clients
+            for client, role in zip(list_of_participants,shuffle(["Director", "Matcher"])):
+                global_participant_data[client]['role'] = role
+            start_interaction_trial(list_of_participants)
+        else: #else mark you as ready to go, so you will wait for partner
+            global_participant_data[client_id]['role']='ReadyToInteract'
+            save_participant_state(client_id)
+
+
+
+
+
+# Interaction trial - sends director trial instruction to director and wait instruction to matcher
+# For director, we need to send the D command_type, with the prompt_word and also the partner_id
+# (the partner_id is just sent so that the client can record this in the data file it produces).
+def start_interaction_trial(list_of_participants):
+    #check everyone is still connected!
+    if not(all_connected(list_of_participants)):
+        notify_stranded(list_of_participants)
+    else:
+        #figure out who is the director
+        director_id = [id for id in list_of_participants if global_participant_data[id]['role']=='Director'][0]
+        #retrieve their trial list and trial counter
+        trial_counter = global_participant_data[director_id]['shared_trial_counter']
+        trial_list = global_participant_data[director_id]['trial_list']
+        ntrials = len(trial_list)
+        #check that the director has more trials to run - if not, move to next phase
+        if trial_counter>=ntrials:
+            for c in list_of_participants:
+                progress_phase(c)
+        else: #otherwise, if there are still trials to run
+            #retrieve the info we need from global_participant_data
+            matcher_id = global_participant_data[director_id]['partner']
+            matcher_participant_id = global_participant_data[matcher_id]['participantID']
+            target = trial_list[trial_counter]
+            for c in list_of_participants:
+                this_role = global_participant_data[c]['role']
+                if this_role=='Director': #send the appropriate instruction to the Director
+                    instruction_string = {"command_type":"Director",
+                                            "target_object":target,
+                                            "partner_id":matcher_participant_id}
+                else: #and tell the matcher to wait
+                    instruction_string = {"command_type":"WaitForPartner"}
+                send_message_by_id(c,instruction_string)
+
+
+# When director responds, all we need to do is relay the clue word to the matcher. Matcher needs
+# command_type M, the prompt_word is the director's response value, and we also send over the
+# matcher's array of options (hard-wired to object 4 and object 5) and the director's participant ID
+#so the matcher can record this in their data file for us.
+@phases.on_response('RESPONSE',role='Director')
+def handle_director_response(director_id,director_response):
+    matcher_id = global_participant_data[director_id]['partner']
+    if not(all_connected([matcher_id])): #the usual check that everyone is still connected
+        notify_stranded([director_id])
+    else:
+        #note that director_response['response'] is the clue word the director sent us
+        director_participant_id=global_participant_data[director_id]['participantID']
+        send_message_by_id(director_id,{"command_type":"WaitForPartner"})
+        send_message_by_id(matcher_id,
+                            {"command_type":"Matcher",
+                                "director_label":director_response['response'],
+                                "object_choices":object_choices,
+                                "partner_id":director_participant_id})
+
+# When the matcher responds with their guess, we need to send feedback to matcher + director.
+# In this experiment the feedback includes information on success/failure, but also some more
+# detailed info on what common guesses and the best possible clue word would have been - these
+# are just set to ??? here, since the code for that is still to be written!
+# Both clients are sent a feedback command: command_type F, then multiple pieces of info including
+# score, the intended target, the clue provided, etc etc
+@phases.on_response('RESPONSE',role='Matcher')
+def handle_matcher_response(matcher_id,matcher_response):
+    director_id = global_participant_data[matcher_id]['partner']
+    if not(all_connected([director_id,matcher_id])):
+        notify_stranded([director_id,matcher_id])
+    else:
+        #easiest way to access what the target was is to look it up in the director's trial list
+        trial_n = global_participant_data[director_id]['shared_trial_counter']
+        target = global_participant_data[director_id]['trial_list'][trial_n]
+        #info on the clue the director provided and the matcher's guess are included in the matcher's response
+        label = matcher_response['director_label']
+        guess = matcher_response['response']
+        if target==guess:
+            score=1
+        else:
+            score=0
+        feedback = {"command_type":"Feedback","score":score,
+                    "target":target,"label":label,"guess":guess}
+        for c in [matcher_id,director_id]: #send to both clients
+            send_message_by_id(c,feedback)
+        #and save the outcome of the trial
+        trial_data.record(global_participant_data[director_id]['dyad_id'],
+                          {'dyad_id':global_participant_data[director_id]['dyad_id'],
+                           'trial_n':trial_n,
+                           'director_id':global_participant_data[director_id]['participantID'],
+                           'matcher_id':global_participant_data[matcher_id]['participantID'],
+                           'target':target,'label':label,'guess':guess,'score':score,
+                           'time':time.time()})
+
+
+
+# Each client comes here when they signals they are done with feedback from an interaction trial.
+# The first client who returns will set their role to 'WaitingToSwitch'.
+# The second client to return will then trigger the next trial, then we can use the role of that
+# second client to figure out who will be director and matcher at the next trial.
+def swap_roles_and_progress(client_id):
+    logger.debug('swap roles', extra={'client_id':client_id})
+    partner_id = global_participant_data[client_id]['partner']
+    if not(all_connected([client_id,partner_id])):
+        notify_stranded([client_id,partner_id])
+    else:
+        #increment global counter - both participants will do this independently when they reach this point
+        global_participant_data[client_id]['shared_trial_counter']+=1
+
+        this_client_role = global_participant_data[client_id]['role']
+        partner_role = global_participant_data[partner_id]['role']
+        #If your partner is already ready, then switch roles and progress
+        if partner_role=='WaitingToSwitch':
+            if this_client_role=='Director': #if you were director for this trial then
+                global_participant_data[client_id]['role'] = "Matcher" #next time you will be Matcher...
+                global_participant_data[partner_id]['role'] = "Director" #..and your partner will be Director
+            else:
+                global_participant_data[client_id]['role'] = "Director" #otherwise the opposite
+                global_participant_data[partner_id]['role'] = "Matcher"
+            #next trial
+            start_interaction_trial([client_id,partner_id])
+        #Otherwise your partner is not yet ready, so just flag up that you are
+        else:
+            global_participant_data[client_id]['role'] = "WaitingToSwitch"
+            save_participant_state(client_id)
+
+
+
+# Run every WAITING_ROOM_CHECK_INTERVAL seconds: anyone who has been in the waiting room
+# longer than the matchmaker's timeout is told there is no partner for them, using the
+# PartnerDropout command which ends the experiment for them
+def check_waiting_room():
+    for client_id in matchmaker.expire():
+        logger.warning("Client(%d) timed out in the waiting room", client_id, extra={'client_id':client_id})
+        send_message_by_id(client_id,{"command_type":"PartnerDropout"})
+
+
+
+####################
+### Clients who stop responding
+####################
+
+# Notes that we are waiting for client_id to respond, if there is a time limit on that in
+# their current phase
+def expect_response(client_id):
+    data = global_participant_data[client_id]
+    timeout = PHASE_INACTIVITY_TIMEOUTS.get(data['phase'])
+    if timeout is not None:
+        data['awaiting_response'] = (client_id,time.time())
+        inactivity_timers.schedule(timeout,data['awaiting_response'])
+
+# Run every second: drops anyone whose time limit has come up without them responding.
+# Entries in the timer wheel for clients who have responded since (or left) are no longer
+# their awaiting_response, so are simply skipped. Someone whose partner is away can't be
+# expected to get on without them, so they are given more time.
+def check_inactive_clients():
+    for entry in inactivity_timers.advance():
+        client_id = entry[0]
+        data = global_participant_data.get(client_id)
+        if data is None or data.get('awaiting_response') is not entry:
+            continue
+        if data.get('awaiting_partner'):
+            inactivity_timers.schedule(PHASE_INACTIVITY_TIMEOUTS[data['phase']],entry)
+        else:
+            drop_inactive_client(client_id)
+
+# A client who never got as far as telling us who they are just has their connection
+# closed; otherwise they and their partner are told there is a problem (PartnerDropout),
+# which ends the experiment for them both
+def drop_inactive_client(client_id):
+    data = global_participant_data[client_id]
+    logger.warning("Client(%d) stopped responding in phase %s", client_id, data['phase'],
+                   extra={'client_id':client_id})
+    data.pop('awaiting_response',None)
+    dropouts.inc('inactive')
+    if data['phase']=='Start':
+        data['client_info']['handler'].close_connection()
+    else:
+        stranded = [client_id]
+        if 'partner' in data:
+            stranded.append(data['partner'])
+        notify_stranded(stranded)
+
+
+
+####################
+### Reconnecting
+####################
+
+# A participant can be away part way through the experiment for two reasons: their
+# connection dropped (a Wi-Fi blip, a laptop going to sleep...), in which case their client
+# will try to reconnect, or the server was restarted, in which case both of the dyad will.
+# Either way they connect again as a new client, sending CLIENT_INFO with the same participant
+# ID, and carry on from where they were.
+
+# Keeps the state of a client who has gone away part way through the experiment, so they
+# can carry on if they are back within grace_period seconds. If their partner is still
+# connected, the partner is told to wait (PartnerReconnecting, which the client shows on top
+# of whatever they are doing, rather than moving them on), and anything they send in the
+# meantime is held until their partner is back.
+def set_aside_participant(client_id,grace_period):
+    data = global_participant_data[client_id]
+    participant_id = data['participantID']
+    logger.info("Holding %s's place for %ds", participant_id, grace_period, extra={'client_id':client_id})
+    absent_participants[participant_id] = dict((k,data[k]) for k in JOURNAL_KEYS if k in data)
+    reconnect_deadlines[participant_id] = time.time()+grace_period
+    trial_data.finish(data['dyad_id'])
+    partner_id = data.pop('partner',None)
+    if partner_id is not None and partner_id in global_participant_data:
+        del global_participant_data[partner_id]['partner']
+        global_participant_data[partner_id]['awaiting_partner']=True
+        send_message_by_id(partner_id,{"command_type":"PartnerReconnecting"},remember=False)
+
+# Called when a participant reconnects while their old connection is (as far as we know)
+# still open: the old client is set aside as if it had disconnected, and left as an empty
+# entry until its connection does close
+def replace_connection(old_client_id):
+    data = global_participant_data[old_client_id]
+    matchmaker.remove(old_client_id)
+    if 'partner_participantID' in data and data['phase']!='End':
+        set_aside_participant(old_client_id,RECONNECT_GRACE_PERIOD)
+    global_participant_data[old_client_id] = {'client_info':data['client_info'],'replaced':True}
+
+# Called when a client connects with the participant ID of someone who is away. Their state
+# is put back, but they can only carry on once their partner is here too - until then they
+# are told to wait for their partner.
+def resume_participant(client_id,saved_state):
+    data = global_participant_data[client_id]
+    data.update(saved_state)
+    logger.info("Client(%d) resumed as %s", client_id, data['participantID'], extra={'client_id':client_id})
+    reconnects.inc()
+    partner_participant_id = data['partner_participantID']
+    partner_id = client_by_participant_id.get(partner_participant_id)
+    #partner is here and waiting for us - link them up again and carry on
+    if partner_id is not None and global_participant_data[partner_id].get('awaiting_partner'):
+        partner_data = global_participant_data[partner_id]
+        del partner_data['awaiting_partner']
+        data['partner']=partner_id
+        partner_data['partner']=client_id
+        send_message_by_id(client_id,resume_command(client_id))
+        #a partner who reconnected themselves needs telling what to do, one who never
+        #left just needs to know we are back
+        if partner_data.pop('resumed',False):
+            send_message_by_id(partner_id,resume_command(partner_id))
+        else:
+            send_message_by_id(partner_id,{"command_type":"PartnerReconnected"},remember=False)
+        for response in partner_data.pop('held_responses',[]):
+            handle_client_response(partner_id,response['response_type'],response)
+    #partner is away too
+    elif partner_participant_id in absent_participants:
+        data['awaiting_partner']=True
+        data['resumed']=True
+        send_message_by_id(client_id,{"command_type":"PartnerReconnecting"},remember=False)
+    #partner has been and gone
+    else:
+        notify_stranded([client_id])
+
+# The command to send a client carrying on: the last thing they were sent (their client
+# ignores it if they are still doing it), except that someone who has finished looking at
+# their feedback (and told us so) should wait for their partner to do the same
+def resume_command(client_id):
+    if global_participant_data[client_id].get('role')=='WaitingToSwitch':
+        return {"command_type":"WaitForPartner"}
+    return global_participant_data[client_id]['last_command']
+
+# Run every WAITING_ROOM_CHECK_INTERVAL seconds: participants who haven't come back in time
+# are given up on, and their partner (if they are here) told they have dropped out
+def check_absent_participants():
+    now = time.time()
+    for participant_id in [p for p, deadline in reconnect_deadlines.items() if deadline<=now]:
+        del reconnect_deadlines[participant_id]
+        saved_state = absent_participants.pop(participant_id)
+        trial_data.finish(saved_state['dyad_id'])
+        journal.remove(participant_id)
+        logger.warning("%s did not reconnect in time", participant_id)
+        dropouts.inc('did_not_reconnect')
+        partner_id = client_by_participant_id.get(saved_state['partner_participantID'])
+        if partner_id is not None and global_participant_data[partner_id].get('awaiting_partner'):
+            notify_stranded([partner_id])
+
+
+
+####################
+### Moving clients between worker processes
+####################
+
+# When the experiment runs as several worker processes (see worker_server.py), a client
+# can be handed over from one worker to another, connection and all: two participants who
+# are waiting to be paired on different workers are brought together on one of them, and
+# a participant who reconnects to the wrong worker is sent on to the one with their saved
+# state. export_client takes the client out of this worker's state, and import_client puts
+# them into the other worker's. Only clients in the Start or PairParticipants phases are
+# moved, so there is nothing to move but their entry in global_participant_data.
+def export_client(client_id):
+    data = global_participant_data.pop(client_id)
+    participant_id = data.get('participantID')
+    if client_by_participant_id.get(participant_id)==client_id:
+        del client_by_participant_id[participant_id]
+    return dict((k,v) for k,v in data.items() if k not in ['client_info','awaiting_response'])
+
+def import_client(client,state):
+    global_participant_data[client['id']] = dict(state,client_info=client)
+    if 'participantID' in state:
+        client_by_participant_id[state['participantID']] = client['id']
+
+
+
+####################
+### Instructions between blocks
+####################
+
+# Fairly simple, just send over a command_typ I message to the client, with instructon_type set to "Interaction"
+def send_instructions(client_id,phase):
+    if phase=='Interaction':
+        #set role
+        global_participant_data[client_id]['role'] = "ReadingInstructions"
+        send_message_by_id(client_id,{"command_type":"Instructions","instruction_type":"Interaction"})
+
+####################
+### Metrics
+####################
+
+# Worked out from the state above whenever the metrics are collected (on state_actor, so
+# they see the state in one piece). A dyad is counted in the phase of the partner with the
+# lower client ID, or of whichever partner is here if the other is away.
+def participants_by_phase():
+    counts = dict((phase,0) for phase in phase_sequence)
+    for data in global_participant_data.values():
+        if 'phase' in data:
+            counts[data['phase']] += 1
+    return counts
+
+def dyads_by_phase():
+    counts = dict((phase,0) for phase in phase_sequence)
+    for client_id, data in global_participant_data.items():
+        partner_id = data.get('partner')
+        if 'partner_participantID' in data and (partner_id is None or client_id<partner_id):
+            counts[data['phase']] += 1
+    return counts
+
+def waiting_time_quantiles():
+    return dict(('%g' % (p/100.0),wait) for p, wait in matchmaker.wait_time_percentiles().items())
+
+metrics.gauge('dyadic_clients','Clients connected to the experiment',lambda: len(global_participant_data))
+metrics.gauge('dyadic_participants','Participants in each phase',participants_by_phase,'phase')
+metrics.gauge('dyadic_dyads','Dyads in each phase',dyads_by_phase,'phase')
+metrics.gauge('dyadic_absent_participants','Participants whose place is being held while they reconnect',
+              lambda: len(absent_participants))
+metrics.gauge('dyadic_waiting_room','Clients in the waiting room',lambda: matchmaker.waiting_count())
+metrics.gauge('dyadic_waiting_room_wait_seconds','Time recent pairs waited in the waiting room',
+              waiting_time_quantiles,'quantile')
+metrics.counter('dyadic_waiting_room_timeouts_total','Clients nobody turned up for in the waiting room',
+                fn=lambda: matchmaker.stats().get('timed_out'))
+metrics.gauge('dyadic_state_actor_queue','Events waiting to be handled by the state actor',
+              lambda: state_actor.queue.qsize())
+
+
+
+#######################
+### Start up server
+#######################
+
+WAITING_ROOM_CHECK_INTERVAL=5 #seconds
+
+# Seconds a client can take to respond to a command in each phase before they are dropped -
+# phases not listed have no limit (the waiting room has its own timeout, see matchmaker)
+PHASE_INACTIVITY_TIMEOUTS={'Start':60,'Interaction':5*60}
+NONRESPONSIVE_REPORT_MIN=60 #seconds a partner must have kept a client waiting to be reported
+
+# The server pings any client it hasn't heard from for PING_INTERVAL seconds, and closes
+# the connection if there is no answer within PING_TIMEOUT seconds - this finds clients whose
+# network has gone without their connection closing properly
+PING_INTERVAL=20
+PING_TIMEOUT=10
+
+LOG_FILE=None #None logs to the terminal, or give a file name e.g. 'server_log.jsonl'
+MESSAGE_LOG_SAMPLE=10
+
+RECONNECT_GRACE_PERIOD=60 #seconds to wait for a participant whose connection drops to reconnect
+RESUME_TIMEOUT=2*60 #seconds to wait for participants to reconnect after a restart
+
+# Starts everything the experiment needs apart from the websocket server: reads back the
+# state of dyads who were part way through when the server last stopped, starts saving
+# changes to it, and has state_actor run the regular checks (so must be called before
+# state_actor.start()). Called below, or by experiment_host.py when this experiment is
+# hosted in one server along with others.
+def start_experiment():
+    absent_participants.update(journal.restore())
+    for participant_id in absent_participants:
+        reconnect_deadlines[participant_id] = time.time()+RESUME_TIMEOUT
+    logger.info('Restored the state of %d participants in %.3fs', len(absent_participants),
+                journal.stats()['restore_seconds'])
+    journal.start()
+    state_actor.every(WAITING_ROOM_CHECK_INTERVAL,check_waiting_room)
+    state_actor.every(WAITING_ROOM_CHECK_INTERVAL,check_absent_participants)
+    state_actor.every(1,check_inactive_clients)
+
+# Writes out any changes to participants' state still waiting to be saved
+def stop_experiment():
+    journal.close()
+
+#standard stuff here from the websocket_server code, except that the functions handling
+#clients are run by state_actor rather than directly by the server
+if __name__ == '__main__':
+    # Log to LOG_FILE (or the terminal), keeping 1 in every MESSAGE_LOG_SAMPLE of the messages
+    # clients send - set it to 1 to log them all while debugging
+    log_listener = setup_logging(LOG_FILE,levels={'dyadic.messages':logging.DEBUG},
+                                 sample_every={'dyadic.messages':MESSAGE_LOG_SAMPLE})
+    logger.info('starting up')
+    # compression=True compresses messages (permessage-deflate) for browsers that support it,
+    # which is all modern ones
+    server = WebsocketServer(PORT,'0.0.0.0',compression=True,
+                             ping_interval=PING_INTERVAL,ping_timeout=PING_TIMEOUT,
+                             subprotocols=encoder.subprotocols)
+    # WebsocketServer gives every client its own thread. For large numbers of clients you
+    # can instead serve all of them from a single asyncio event loop - the rest of this file
+    # works unchanged, just import AsyncWebsocketServer from websocket_server and use
+    #server = AsyncWebsocketServer(PORT,'0.0.0.0',compression=True,
+    #                              ping_interval=PING_INTERVAL,ping_timeout=PING_TIMEOUT,
+    #                              subprotocols=encoder.subprotocols)
+    server.set_fn_new_client(state_actor.wrap(new_client))
+    server.set_fn_client_left(state_actor.wrap(client_left))
+    server.set_fn_message_received(state_actor.wrap(message_received))
+    #clients using MessagePack send binary messages
+    server.set_fn_binary_message_received(state_actor.wrap(message_received))
+    start_experiment()
+    state_actor.start()
+    trial_data.start()
+    if METRICS_PORT is not None:
+        add_server_metrics(metrics,server)
+        #collected on state_actor, like everything else touching the experiment's state
+        MetricsServer(METRICS_PORT,lambda: state_actor.call(render,[metrics],timeout=COLLECT_TIMEOUT)).start()
+    try:
+        server.run_forever()
+    finally:
+        trial_data.close() #writes out any trial data still waiting to be saved
+        stop_experiment() #and any changes to participants' state
+        log_listener.stop() #writes out anything still waiting to be logged
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Hosting several experiments in one server process
+##############
+
+# dyadic_interaction_server.py and dyadic_interaction_server_extended.py each run as a
+# process of their own, on their own port. This runs any number of experiments like them
+# in a single process instead. Clients all connect to the one port, and each client is
+# handed to an experiment according to the path it connected to - the my_port_number in
+# the experiment's javascript, e.g. /ws1/ (so if you run this behind a proxy, it needs to
+# pass the path on). The experiments share:
+# - one websocket server, serving every client from one asyncio event loop
+# - one state_actor, which handles every experiment's events one at a time
+# - one matchmaker, in which each experiment's waiting room is a pool of its own (see
+#   matchmaking.py), so people are only paired with others doing the same experiment
+# - one trial data sink, writing every experiment's files to server_data, named just as
+#   they would be if the experiment ran on its own (see trial_data.py)
+# So rather than one process per experiment you can run one process per core.
+
+# The experiment files themselves don't change. Each is loaded as a module of its own
+# (with importlib, so it can live in any folder), which gets it its own copy of
+# global_participant_data, phases etc; the host then swaps the server, state_actor,
+# matchmaker and trial_data it made for itself for the shared ones, and gives it a journal
+# in a folder of its own, before starting it.
+
+
+##############
+##### Libraries
+##############
+
+# The experiment files import websocket_server, participant_state.py etc from this folder
+from websocket_server import AsyncWebsocketServer
+from participant_state import StateActor
+from matchmaking import Matchmaker, MatchmakingPool
+from experiment_logging import setup_logging
+from trial_data import TrialDataSink, TrialDataView
+from state_journal import StateJournal
+from metrics import MetricsRegistry, MetricsServer, add_server_metrics, render, COLLECT_TIMEOUT
+from serializers import available_subprotocols
+import importlib.util
+import logging
+import os
+
+
+
+######################
+##### Globals shared by all the experiments
+######################
+
+state_actor = StateActor()
+matchmaker = Matchmaker(group_size=2,timeout=10*60,avoid_repeat_partners=True)
+trial_data = TrialDataSink('server_data',
+                           fields=['dyad_id','trial_n','director_id','matcher_id',
+                                   'target','label','guess','score','time'],
+                           file_format='csv',prefix='trials')
+
+# Metrics on the server itself; each experiment has its own, labelled with its name (see
+# metrics.py), and they are all served together
+metrics = MetricsRegistry()
+
+# Path -> experiment module, for every experiment being hosted
+experiments = {}
+# Client ID -> the experiment module the client is taking part in
+experiment_by_client = {}
+
+logger = logging.getLogger('dyadic')
+
+
+
+######################
+##### Loading experiments
+######################
+
+# Paths are matched without any query string or trailing slash, so /ws1, /ws1/ and
+# /ws1/?id=123 all go to the same experiment
+def route(path):
+    return path.split('?')[0].rstrip('/') or '/'
+
+# Loads the experiment in filename to serve clients connecting to path, and swaps its
+# own server components for the shared ones. Experiments written for a different group
+# size, or saving different trial data, can't share them, so are refused.
+def load_experiment(path,filename):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    spec = importlib.util.spec_from_file_location(name,filename)
+    experiment = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(experiment)
+    own_matchmaker = experiment.matchmaker
+    if (own_matchmaker.group_size,own_matchmaker.timeout,own_matchmaker.avoid_repeat_partners) != \
+            (matchmaker.group_size,matchmaker.timeout,matchmaker.avoid_repeat_partners):
+        raise ValueError('%s uses different matchmaking settings from the host' % filename)
+    if (experiment.trial_data.fields,experiment.trial_data.file_format) != \
+            (trial_data.fields,trial_data.file_format):
+        raise ValueError('%s saves different trial data from the host' % filename)
+    experiment.state_actor = state_actor
+    experiment.matchmaker = MatchmakingPool(matchmaker,name)
+    experiment.trial_data = TrialDataView(trial_data,experiment.trial_data.prefix)
+    experiment.journal = StateJournal(os.path.join(STATE_DIRECTORY,name))
+    experiment.metrics.const_labels['experiment'] = name
+    experiments[route(path)] = experiment
+    logger.info('Serving %s at %s', name, path)
+    return experiment
+
+
+
+######################
+##### Handing clients to their experiment
+######################
+
+# A client connecting to a path with no experiment is disconnected straight away
+def new_client(client, server):
+    experiment = experiments.get(route(client['path']))
+    if experiment is None:
+        logger.warning("Client(%d) connected to %s, which has no experiment", client['id'], client['path'],
+                       extra={'client_id':client['id']})
+        client['handler'].close_connection()
+        return
+    experiment_by_client[client['id']] = experiment
+    experiment.new_client(client, server)
+
+def client_left(client, server):
+    experiment = experiment_by_client.pop(client['id'],None)
+    if experiment is not None:
+        experiment.client_left(client, server)
+
+def message_received(client, server, message):
+    experiment = experiment_by_client.get(client['id'])
+    if experiment is not None:
+        experiment.message_received(client, server, message)
+
+
+
+#######################
+### Start up server
+#######################
+
+PORT=9001
+
+# Path clients connect to -> experiment file (relative to this folder)
+EXPERIMENTS=[('/ws1/','dyadic_interaction_server.py'),
+             ('/ws2/','../../dyadic_interaction_extended/dyadic_interaction_server_extended.py')]
+
+# Each experiment's journal (see state_journal.py) goes in a folder of its own in here
+STATE_DIRECTORY='server_state'
+
+PING_INTERVAL=20
+PING_TIMEOUT=10
+
+LOG_FILE=None #None logs to the terminal, or give a file name e.g. 'server_log.jsonl'
+MESSAGE_LOG_SAMPLE=10
+
+METRICS_PORT=9101 #None turns off serving metrics
+
+if __name__ == '__main__':
+    log_listener = setup_logging(LOG_FILE,levels={'dyadic.messages':logging.DEBUG},
+                                 sample_every={'dyadic.messages':MESSAGE_LOG_SAMPLE})
+    logger.info('starting up')
+    # every experiment's encoder (see serializers.py) speaks all the subprotocols installed
+    server = AsyncWebsocketServer(PORT,'0.0.0.0',compression=True,
+                                  ping_interval=PING_INTERVAL,ping_timeout=PING_TIMEOUT,
+                                  subprotocols=[s.name for s in available_subprotocols()])
+    server.set_fn_new_client(state_actor.wrap(new_client))
+    server.set_fn_client_left(state_actor.wrap(client_left))
+    server.set_fn_message_received(state_actor.wrap(message_received))
+    server.set_fn_binary_message_received(state_actor.wrap(message_received))
+    here = os.path.dirname(os.path.abspath(__file__))
+    for path, filename in EXPERIMENTS:
+        experiment = load_experiment(path,os.path.normpath(os.path.join(here,filename)))
+        experiment.server = server
+        experiment.start_experiment()
+    state_actor.start()
+    trial_data.start()
+    if METRICS_PORT is not None:
+        add_server_metrics(metrics,server)
+        registries = [metrics]+[experiment.metrics for experiment in experiments.values()]
+        MetricsServer(METRICS_PORT,lambda: state_actor.call(render,registries,timeout=COLLECT_TIMEOUT)).start()
+    try:
+        server.run_forever()
+    finally:
+        trial_data.close() #writes out any trial data still waiting to be saved
+        for experiment in experiments.values():
+            experiment.stop_experiment() #and any changes to participants' state
+        log_listener.stop() #writes out anything still waiting to be logged
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Logging for the experiment server, written out on a background thread
+##############
+
+# The server used to print() every message it received (twice - once raw, once
+# parsed), which means formatting and writing to the terminal on the thread handling
+# the message, for every single message. Instead the server logs through python's
+# logging module, and setup_logging() arranges for log records to be put on a queue
+# and written out by a separate thread (a QueueListener), so logging a message only
+# costs the time to put it on the queue.
+
+# Records are written as JSON lines - one JSON dictionary per line, with the time,
+# level, logger name and message, plus any extra fields passed with the record, e.g.
+#   logger.info('Client connected', extra={'client_id': client_id})
+# gives
+#   {"time": 1700000000.123, "level": "INFO", "logger": "dyadic", "message": "Client connected", "client_id": 7}
+# which is easy to load for analysis (e.g. pandas.read_json(path, lines=True)).
+
+# Each part of the server logs to its own logger, so it can be given its own level:
+# dyadic (experiment progress - connections, pairing, phases), dyadic.messages (every
+# message received, high volume), participant_state (errors in event handlers) and
+# websocket_server (connections and frames). For very high volume loggers you can also
+# keep just a sample of records, e.g. 1 in every 100 messages received.
+
+import sys
+import copy
+import json
+import logging
+import logging.handlers
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+# Attributes every LogRecord has - anything else on a record was passed in extra
+STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'time': round(record.created, 3),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        # default=str so that a value json can't encode doesn't lose the record
+        return json.dumps(entry, default=str)
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+
+    # Does as little as possible on the thread doing the logging: the message's %
+    # arguments are filled in (so that later changes to them can't change the log)
+    # and any exception turned into text, but JSON encoding and writing are left
+    # to the listener thread
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through 1 in every `every` records, and adds a sampled_every field to
+    them so that counts can be scaled back up.
+    """
+
+    def __init__(self, every):
+        logging.Filter.__init__(self)
+        self.every = every
+        self.count = 0
+
+    def filter(self, record):
+        self.count += 1
+        if self.count % self.every:
+            return False
+        record.sampled_every = self.every
+        return True
+
+
+def setup_logging(path=None, level=logging.INFO, levels=None, sample_every=None):
+    """
+    Sends all logging through a queue to a background thread writing JSON lines.
+
+    Args:
+        path(str): File to append the log to, or None for stderr.
+        level: Level for everything not listed in levels.
+        levels(dict): Logger name -> level, e.g. {'dyadic.messages': logging.DEBUG}.
+        sample_every(dict): Logger name -> n, to keep only 1 in every n records
+            logged directly to that logger.
+
+    Returns the QueueListener writing the log - call its stop() method when
+    shutting down, to write out anything still queued.
+    """
+    if path is None:
+        output = logging.StreamHandler(sys.stderr)
+    else:
+        output = logging.FileHandler(path, encoding='utf-8')
+    output.setFormatter(JsonLinesFormatter())
+    log_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(log_queue, output)
+
+    root = logging.getLogger()
+    # replace any handlers already set up, e.g. by logging.basicConfig()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(BackgroundQueueHandler(log_queue))
+    root.setLevel(level)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+    for name, every in (sample_every or {}).items():
+        logging.getLogger(name).addFilter(SamplingFilter(every))
+
+    listener.start()
+    return listener
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Matchmaking: forming dyads (or larger groups) from the waiting room
+##############
+
+# Clients who are ready to be paired are added to a Matchmaker; as soon as enough
+# compatible clients are waiting, add() hands back a group of them (oldest first),
+# which the experiment then links up as partners. Clients who leave the waiting
+# room (because they disconnected or gave up) are removed with remove().
+
+# Waiting clients are kept in a first-in-first-out queue (a deque), one queue per
+# pool if clients are split into pools (e.g. by experimental condition), plus a
+# dictionary from client ID to their place in the queue. Adding a client, forming a
+# group from the front of the queue and removing a client who leaves therefore all
+# take constant time however many people are waiting: a removed client is just
+# marked as gone, and skipped over when they reach the front.
+
+# Optional constraints:
+# - pool_key: only clients with the same key are grouped together
+# - worker_id: two connections with the same worker ID (e.g. one participant in two
+#   browser tabs) are never put in the same group, and with avoid_repeat_partners
+#   workers who have already been grouped together once are not grouped again
+# - timeout: clients waiting longer than this many seconds are returned by
+#   expire(), so the experiment can release them
+# Constraints mean skipping over incompatible clients at the front of the queue, so
+# they make matching slower when many incompatible people are waiting.
+
+# Several experiments hosted in one server (see experiment_host.py) share a single
+# Matchmaker, each using it through a MatchmakingPool: that behaves like a Matchmaker
+# of its own, but keeps its clients in separate pools, so people are only ever
+# grouped with others doing the same experiment.
+
+import time
+from collections import deque
+
+# How many recent wait times to keep for reporting percentiles
+WAIT_TIME_HISTORY = 10000
+
+
+class WaitingClient(object):
+
+    __slots__ = ('client_id', 'worker_id', 'pool', 'arrived', 'active')
+
+    def __init__(self, client_id, worker_id, pool, arrived):
+        self.client_id = client_id
+        self.worker_id = worker_id
+        self.pool = pool
+        self.arrived = arrived
+        # False once the client has been grouped or removed
+        self.active = True
+
+
+class Matchmaker(object):
+    """
+    Args:
+        group_size(int): 2 for dyads, 3 for triads etc.
+        timeout(float): Seconds a client may wait before expire() releases
+            them, or None to wait forever.
+        avoid_repeat_partners(bool): Never group workers who have already been
+            in a group together.
+        clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, group_size=2, timeout=None, avoid_repeat_partners=False, clock=time.time):
+        self.group_size = group_size
+        self.timeout = timeout
+        self.avoid_repeat_partners = avoid_repeat_partners
+        self.clock = clock
+        self.pools = {}      # pool key -> deque of WaitingClient, oldest first
+        self.waiting = {}    # client ID -> WaitingClient
+        self.previous_partners = set()  # frozensets of worker ID pairs already grouped
+        self.wait_times = deque(maxlen=WAIT_TIME_HISTORY)
+        self.groups_formed = 0
+        self.cancelled = 0
+        self.timed_out = 0
+
+    def add(self, client_id, worker_id=None, pool_key=None):
+        """
+        Puts a client in the waiting room. If that completes a group, the group
+        (a list of client IDs, longest-waiting first) is taken out of the
+        waiting room and returned; otherwise returns None.
+        """
+        if client_id in self.waiting:
+            raise ValueError('client %r is already waiting' % (client_id,))
+        entry = WaitingClient(client_id, worker_id, pool_key, self.clock())
+        self.waiting[client_id] = entry
+        self.pools.setdefault(pool_key, deque()).append(entry)
+        return self.form_group(pool_key)
+
+    def remove(self, client_id):
+        # Returns True if the client was waiting
+        entry = self.waiting.pop(client_id, None)
+        if entry is None:
+            return False
+        entry.active = False
+        self.cancelled += 1
+        self.discard_inactive(entry.pool)
+        return True
+
+    def expire(self, pool_filter=None):
+        """
+        Removes and returns the IDs of clients who have waited longer than the
+        timeout - only from the pools whose key pool_filter returns True for,
+        if given. Since the oldest clients are at the front of each queue, this
+        only looks at clients who have actually timed out.
+        """
+        if self.timeout is None:
+            return []
+        cutoff = self.clock() - self.timeout
+        expired = []
+        for pool_key, pool in list(self.pools.items()):
+            if pool_filter is not None and not pool_filter(pool_key):
+                continue
+            while pool and (not pool[0].active or pool[0].arrived < cutoff):
+                entry = pool.popleft()
+                if entry.active:
+                    entry.active = False
+                    del self.waiting[entry.client_id]
+                    self.timed_out += 1
+                    expired.append(entry.client_id)
+            if not pool:
+                del self.pools[pool_key]
+        return expired
+
+    def form_group(self, pool_key):
+        if len(self.waiting) < self.group_size:
+            return None
+        self.discard_inactive(pool_key)
+        pool = self.pools[pool_key]
+        group = []
+        # Walk from the front (oldest) taking everyone compatible with the group so
+        # far; without constraints these are simply the first group_size clients
+        for entry in pool:
+            if entry.active and self.compatible(group, entry):
+                group.append(entry)
+                if len(group) == self.group_size:
+                    break
+        if len(group) < self.group_size:
+            return None
+        now = self.clock()
+        for entry in group:
+            entry.active = False
+            del self.waiting[entry.client_id]
+            self.wait_times.append(now - entry.arrived)
+        self.discard_inactive(pool_key)
+        if self.avoid_repeat_partners:
+            worker_ids = [entry.worker_id for entry in group if entry.worker_id is not None]
+            for i, a in enumerate(worker_ids):
+                for b in worker_ids[i + 1:]:
+                    self.previous_partners.add(frozenset((a, b)))
+        self.groups_formed += 1
+        return [entry.client_id for entry in group]
+
+    def compatible(self, group, entry):
+        if entry.worker_id is None:
+            return True
+        for member in group:
+            if member.worker_id == entry.worker_id:
+                return False
+            if self.avoid_repeat_partners and \
+                    frozenset((member.worker_id, entry.worker_id)) in self.previous_partners:
+                return False
+        return True
+
+    def discard_inactive(self, pool_key):
+        # Drops grouped/removed clients from the front of the queue; any further
+        # back are dropped when they get to the front. If they make up most of
+        # the queue (lots of people skipped by constraints and then leaving),
+        # rebuild it so walking the queue stays cheap.
+        pool = self.pools.get(pool_key)
+        if pool is None:
+            return
+        while pool and not pool[0].active:
+            pool.popleft()
+        if len(pool) > 32 and len(pool) > 2 * self.waiting_count():
+            self.pools[pool_key] = pool = deque(entry for entry in pool if entry.active)
+        if not pool:
+            del self.pools[pool_key]
+
+    def waiting_count(self):
+        return len(self.waiting)
+
+    def is_waiting(self, client_id):
+        return client_id in self.waiting
+
+    def wait_time_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Wait times (in seconds, from joining the waiting room to being grouped)
+        at the given percentiles, over the most recent groups formed. Returns a
+        dictionary from percentile to wait time, empty if nobody has been
+        grouped yet.
+        """
+        if not self.wait_times:
+            return {}
+        ordered = sorted(self.wait_times)
+        result = {}
+        for p in percentiles:
+            # nearest-rank percentile
+            rank = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))
+            result[p] = ordered[rank]
+        return result
+
+    def stats(self):
+        stats = {'waiting': self.waiting_count(),
+                 'groups_formed': self.groups_formed,
+                 'cancelled': self.cancelled,
+                 'timed_out': self.timed_out}
+        for p, wait in self.wait_time_percentiles().items():
+            stats['wait_p%d' % p] = wait
+        return stats
+
+
+class MatchmakingPool(object):
+    """
+    One experiment's share of a Matchmaker used by several experiments, with
+    the methods the experiment uses on a Matchmaker of its own. Pool keys and
+    worker IDs are paired with name, so clients (and previous partners) of
+    different experiments are never mixed up.
+
+    Args:
+        matchmaker(Matchmaker): The shared matchmaker.
+        name(str): Name of the experiment.
+    """
+
+    def __init__(self, matchmaker, name):
+        self.matchmaker = matchmaker
+        self.name = name
+
+    def add(self, client_id, worker_id=None, pool_key=None):
+        if worker_id is not None:
+            worker_id = (self.name, worker_id)
+        return self.matchmaker.add(client_id, worker_id, (self.name, pool_key))
+
+    def remove(self, client_id):
+        # client IDs are unique across experiments, as they all share one server
+        return self.matchmaker.remove(client_id)
+
+    def expire(self):
+        return self.matchmaker.expire(lambda pool_key: pool_key[0] == self.name)
+
+    def is_waiting(self, client_id):
+        return self.matchmaker.is_waiting(client_id)
+
+    def waiting_count(self):
+        # (just this experiment's clients)
+        return sum(1 for entry in self.matchmaker.waiting.values() if entry.pool[0] == self.name)
+
+    def wait_time_percentiles(self, percentiles=(50, 90, 99)):
+        # (over all experiments)
+        return self.matchmaker.wait_time_percentiles(percentiles)
+
+    def stats(self):
+        return self.matchmaker.stats()
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Matchmaking across worker processes
+##############
+
+# When the server runs as several worker processes (see worker_server.py), each
+# participant's connection lands on whichever worker the kernel hands it to, so the two
+# people who should be paired next are often on different workers. A single
+# MatchmakingCoordinator, in a process of its own, therefore keeps the one waiting room
+# (an ordinary Matchmaker, see matchmaking.py) for all of them. Workers tell it who has
+# joined and left the waiting room; when it forms a group it picks the worker of the
+# longest-waiting member to look after the dyad, and asks the other members' workers to
+# hand their connections over to that worker (see AsyncWebSocketHandler.detach). From
+# then on the whole dyad is on one worker, so playing the experiment never involves the
+# coordinator or any other process.
+
+# The coordinator also keeps track of which worker is looking after each participant in
+# a dyad (which worker has their saved state, see state_journal.py), and tells every
+# worker, so a participant who reconnects to a different worker can be handed over to
+# the right one.
+
+# Workers talk to the coordinator over a local Unix socket (SOCK_SEQPACKET, so each
+# message arrives whole), one json-encoded message at a time. Connections being handed
+# over travel as file descriptors attached to a message (SCM_RIGHTS). All of this needs
+# Linux.
+
+import os
+import json
+import time
+import signal
+import socket
+import logging
+import selectors
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Largest message (bytes) - plenty for the state of a participant being handed over
+# (send_message refuses anything bigger, rather than have it arrive cut short)
+MAX_MESSAGE_SIZE = 65536
+# Most entries in one message telling a newly started worker about the participants
+# other workers are looking after
+HOMES_PER_MESSAGE = 500
+
+
+def send_message(sock, message, fd=None):
+    # Raises ValueError, without sending anything, if the message is too big to arrive whole
+    data = json.dumps(message).encode('utf-8')
+    if len(data) > MAX_MESSAGE_SIZE:
+        raise ValueError('Message of %d bytes is over the %d byte limit' % (len(data), MAX_MESSAGE_SIZE))
+    if fd is None:
+        sock.send(data)
+    else:
+        socket.send_fds(sock, [data], [fd])
+
+
+def receive_message(sock):
+    # Returns (message, file descriptor or None), or (None, None) once the other end has gone.
+    # Raises ValueError for a message that can't be read (cut short, or not json), which
+    # leaves the connection fine for the next one
+    data, fds, flags, _ = socket.recv_fds(sock, MAX_MESSAGE_SIZE, 1)
+    if not data or flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+        for fd in fds:
+            os.close(fd)
+        if data:
+            raise ValueError('Message cut short at %d bytes' % len(data))
+        return None, None
+    return json.loads(data.decode('utf-8')), (fds[0] if fds else None)
+
+
+class MatchmakingCoordinator(object):
+    """
+    The waiting room shared by all the workers.
+
+    Args:
+        path(str): Where to create the Unix socket workers connect to.
+        matchmaker(Matchmaker): The waiting room.
+        check_interval(float): How often (seconds) to release clients who have
+            waited longer than the matchmaker's timeout.
+    """
+
+    def __init__(self, path, matchmaker, check_interval=5.0):
+        self.path = path
+        self.matchmaker = matchmaker
+        self.check_interval = check_interval
+        # Listen straight away (before any workers are forked), so workers can connect
+        # however soon they start
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        self.selector = selectors.DefaultSelector()
+        self.workers = {}         # worker index -> socket
+        self.worker_of = {}       # socket -> worker index
+        self.waiting_worker = {}  # client ID -> index of the worker they are waiting on
+        self.homes = {}           # participant ID -> index of the worker looking after them
+        self.pid = None
+        # metrics
+        self.handovers = 0
+
+    def start_process(self):
+        # Runs the coordinator in a process of its own; returns its pid
+        self.pid = os.fork()
+        if self.pid == 0:
+            code = 0
+            try:
+                # stopped by stop_process(), rather than by Ctrl-C
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.run()
+            except BaseException:
+                logger.exception('Matchmaking coordinator failed')
+                code = 1
+            finally:
+                os._exit(code)
+        self.listener.close()
+        return self.pid
+
+    def stop_process(self):
+        if self.pid:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+            self.pid = None
+
+    def start_thread(self):
+        # Runs the coordinator on a thread in this process instead (handy for testing)
+        thread = threading.Thread(target=self.run, name='matchmaking-coordinator')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    ######################
+    ##### Main loop
+    ######################
+
+    def run(self):
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        next_check = time.time() + self.check_interval
+        while True:
+            for key, _ in self.selector.select(timeout=max(0, next_check - time.time())):
+                if key.fileobj is self.listener:
+                    sock, _ = self.listener.accept()
+                    self.selector.register(sock, selectors.EVENT_READ)
+                    continue
+                try:
+                    message, fd = receive_message(key.fileobj)
+                except ValueError:
+                    # (just this message is lost)
+                    logger.exception('Bad message from worker %s', self.worker_of.get(key.fileobj))
+                    continue
+                except OSError:
+                    logger.exception('Lost the connection to worker %s', self.worker_of.get(key.fileobj))
+                    message, fd = None, None
+                if message is None:
+                    self.worker_gone(key.fileobj)
+                    continue
+                try:
+                    self.handle(key.fileobj, message, fd)
+                except Exception:
+                    logger.exception('Error handling %r', message)
+            if time.time() >= next_check:
+                self.release_expired()
+                next_check = time.time() + self.check_interval
+
+    def send(self, worker, message, fd=None):
+        sock = self.workers.get(worker)
+        if sock is None:
+            return False
+        try:
+            send_message(sock, message, fd)
+        except (OSError, ValueError) as e:
+            # (the worker has just exited, and worker_gone will follow, or the message is too big)
+            logger.warning('Could not send to worker %d: %s', worker, e)
+            return False
+        return True
+
+    def handle(self, sock, message, fd):
+        op = message['op']
+        if op == 'hello':
+            self.worker_started(sock, message['worker'])
+            return
+        worker = self.worker_of[sock]
+        if op == 'add':
+            self.waiting_worker[message['client_id']] = worker
+            group = self.matchmaker.add(message['client_id'], message['worker_id'], message['pool_key'])
+            if group:
+                self.form_group(group)
+        elif op == 'remove':
+            if self.waiting_worker.pop(message['client_id'], None) is not None:
+                self.matchmaker.remove(message['client_id'])
+        elif op == 'hand_over':
+            # pass the connection on to the worker it is going to
+            if fd is None:
+                logger.warning('Client %d handed over without their connection', message['client_id'])
+                self.send(message['to'], {'op': 'hand_over_failed', 'client_id': message['client_id'],
+                                          'to': message['to']})
+                return
+            self.handovers += 1
+            message['op'] = 'adopt'
+            if not self.send(message['to'], message, fd):
+                logger.warning('Worker %d is not running, dropping client %d', message['to'], message['client_id'])
+            os.close(fd)
+        elif op == 'hand_over_failed':
+            self.send(message['to'], message)
+        elif op == 'home':
+            if message['worker'] is None:
+                if self.homes.get(message['participant']) == worker:
+                    del self.homes[message['participant']]
+            else:
+                self.homes[message['participant']] = worker
+            for other in self.workers:
+                if other != worker:
+                    self.send(other, message)
+
+    ######################
+    ##### Workers
+    ######################
+
+    def worker_started(self, sock, worker):
+        # A worker restarted after dying has lost all its clients
+        old_sock = self.workers.get(worker)
+        if old_sock is not None:
+            self.worker_gone(old_sock)
+        self.workers[worker] = sock
+        self.worker_of[sock] = worker
+        logger.info('Worker %d connected', worker)
+        homes = list(self.homes.items())
+        for start in range(0, len(homes), HOMES_PER_MESSAGE):
+            self.send(worker, {'op': 'homes', 'homes': dict(homes[start:start + HOMES_PER_MESSAGE])})
+
+    def worker_gone(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+        worker = self.worker_of.pop(sock, None)
+        if worker is None:
+            return
+        if self.workers.get(worker) is sock:
+            del self.workers[worker]
+        logger.warning('Worker %d disconnected', worker)
+        for client_id in [c for c, w in self.waiting_worker.items() if w == worker]:
+            del self.waiting_worker[client_id]
+            self.matchmaker.remove(client_id)
+        for participant_id in [p for p, w in self.homes.items() if w == worker]:
+            del self.homes[participant_id]
+
+    ######################
+    ##### Waiting room
+    ######################
+
+    def form_group(self, group):
+        # The group goes to the worker of its longest-waiting member, and everyone
+        # waiting on another worker is handed over to that one
+        workers = [self.waiting_worker.pop(client_id) for client_id in group]
+        owner = workers[0]
+        self.send(owner, {'op': 'group', 'clients': group})
+        for client_id, worker in zip(group, workers):
+            if worker != owner:
+                if not self.send(worker, {'op': 'hand_over', 'client_id': client_id, 'to': owner}):
+                    self.send(owner, {'op': 'hand_over_failed', 'client_id': client_id, 'to': owner})
+
+    def release_expired(self):
+        for client_id in self.matchmaker.expire():
+            worker = self.waiting_worker.pop(client_id, None)
+            if worker is not None:
+                self.send(worker, {'op': 'expired', 'client_id': client_id})
+
+
+class CoordinatorLink(object):
+    """
+    A worker's connection to the coordinator.
+
+    Args:
+        path(str): The coordinator's Unix socket.
+        worker(int): This worker's index.
+    """
+
+    def __init__(self, path, worker):
+        self.worker = worker
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.connect(path)
+        self.lock = threading.Lock()
+        self.send({'op': 'hello', 'worker': worker})
+
+    def send(self, message, fd=None):
+        # Safe to call from any thread. Raises ValueError if the message is too big to send
+        with self.lock:
+            send_message(self.sock, message, fd)
+
+    def start(self, handle):
+        # Calls handle(message, fd) for every message from the coordinator, on a thread
+        # of its own
+        def receive():
+            while True:
+                try:
+                    message, fd = receive_message(self.sock)
+                except ValueError:
+                    logger.exception('Bad message from the matchmaking coordinator')
+                    continue
+                except OSError:
+                    logger.exception('Lost the connection to the matchmaking coordinator')
+                    return
+                if message is None:
+                    logger.error('Lost the connection to the matchmaking coordinator')
+                    return
+                try:
+                    handle(message, fd)
+                except Exception:
+                    logger.exception('Error handling %r', message)
+        thread = threading.Thread(target=receive, name='coordinator-link')
+        thread.daemon = True
+        thread.start()
+
+
+class CoordinatedMatchmaker(object):
+    """
+    Stands in for a Matchmaker in a worker, with the methods the experiment uses
+    on one, passing everything on to the coordinator. Groups are formed by the
+    coordinator, so add() always returns None; the worker pairs them up when it
+    hears about them (see worker_server.py).
+
+    Args:
+        link(CoordinatorLink): The worker's connection to the coordinator.
+    """
+
+    def __init__(self, link):
+        self.link = link
+        self.waiting = set()
+        # clients the coordinator has released from the waiting room, not yet
+        # collected by expire()
+        self.expired = deque()
+
+    def add(self, client_id, worker_id=None, pool_key=None):
+        self.waiting.add(client_id)
+        self.link.send({'op': 'add', 'client_id': client_id, 'worker_id': worker_id, 'pool_key': pool_key})
+        return None
+
+    def remove(self, client_id):
+        if client_id not in self.waiting:
+            return False
+        self.waiting.discard(client_id)
+        self.link.send({'op': 'remove', 'client_id': client_id})
+        return True
+
+    def grouped(self, client_ids):
+        # the coordinator has put these clients in a group
+        for client_id in client_ids:
+            self.waiting.discard(client_id)
+
+    def expire(self):
+        expired = []
+        while self.expired:
+            client_id = self.expired.popleft()
+            # (unless they have left since)
+            if client_id in self.waiting:
+                self.waiting.discard(client_id)
+                expired.append(client_id)
+        return expired
+
+    def is_waiting(self, client_id):
+        return client_id in self.waiting
+
+    def waiting_count(self):
+        return len(self.waiting)
+
+    def wait_time_percentiles(self, percentiles=(50, 90, 99)):
+        # only the coordinator knows how long people waited
+        return {}
+
+    def stats(self):
+        return {'waiting': self.waiting_count()}
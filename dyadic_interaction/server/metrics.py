@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Metrics for monitoring the server, served over HTTP
+##############
+
+# The log (see experiment_logging.py) says what happened to each client, but not how the
+# server as a whole is doing - how many people are connected, how long the waiting room
+# is, whether messages are piling up. A MetricsRegistry keeps numbers like these, and a
+# MetricsServer serves them over plain HTTP in the text format Prometheus reads (so
+# Prometheus, or anything that understands its format, can collect them every few
+# seconds and graph them), e.g.
+#   curl http://localhost:9101/metrics
+#   # HELP dyadic_messages_received_total Messages received from clients
+#   # TYPE dyadic_messages_received_total counter
+#   dyadic_messages_received_total{response_type="CLIENT_INFO"} 1523
+#   ...
+
+# There are three kinds of metric:
+# - counters, which only go up (messages received, dropouts...): counter.inc()
+# - histograms, which count how many observations (e.g. the time handling a message) fell
+#   in each of a fixed set of ranges: histogram.observe(seconds)
+# - gauges, which go up and down (clients connected, waiting room size...). Rather than
+#   keeping these up to date as things change, a gauge is given a function which works
+#   out its value each time the metrics are collected.
+# Each can be split by one label, e.g. messages received by response_type.
+
+# Keeping the cost off the path of every message: inc() and observe() just add to a
+# dictionary entry, and anything that takes looking through all the clients is only
+# worked out when the metrics are collected. Counters and histograms aren't locked, so
+# should only be updated from one thread - in the experiment that is the state actor
+# (see participant_state.py), which also collects the metrics, so a collection always
+# sees everything in one consistent piece.
+
+import bisect
+import logging
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:  # python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from participant_state import CallTimeout
+
+logger = logging.getLogger(__name__)
+
+# Histogram ranges (upper bounds, in seconds) suiting times from well under a millisecond
+# to several seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Longest (seconds) to wait for the state actor to collect the metrics, so that a stuck
+# actor gets a 503 rather than a request that never returns (and, as MetricsServer
+# handles one request at a time, every request after it too)
+COLLECT_TIMEOUT = 5.0
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                                 .replace('\n', r'\n'))
+                             for name, value in labels)
+
+
+class Counter(object):
+
+    def __init__(self, label=None):
+        self.label = label
+        # (a counter without a label is there from the start, at 0)
+        self.values = {} if label else {None: 0}
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def samples(self, name):
+        for label_value, value in self.values.items():
+            yield name, [(self.label, label_value)] if self.label else [], value
+
+
+class Histogram(object):
+
+    def __init__(self, label=None, buckets=DEFAULT_BUCKETS):
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label value -> [count in each bucket (the last for anything bigger than the
+        # largest bound), sum of observations]
+        self.values = {}
+
+    def observe(self, value, label_value=None):
+        entry = self.values.get(label_value)
+        if entry is None:
+            entry = self.values[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self, name):
+        for label_value, (counts, total) in self.values.items():
+            labels = [(self.label, label_value)] if self.label else []
+            # Prometheus wants the count of observations up to and including each bound
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield name + '_bucket', labels + [('le', format_value(float(bound)))], cumulative
+            yield name + '_sum', labels, total
+            yield name + '_count', labels, cumulative
+
+
+class Gauge(object):
+
+    def __init__(self, fn, label=None):
+        self.fn = fn
+        self.label = label
+
+    def samples(self, name):
+        # fn returns the value, or if there is a label a dictionary from label value to value
+        value = self.fn()
+        if self.label is None:
+            if value is not None:
+                yield name, [], value
+        else:
+            for label_value, v in value.items():
+                yield name, [(self.label, label_value)], v
+
+
+class MetricsRegistry(object):
+    """
+    The metrics for one experiment (or server).
+
+    Args:
+        const_labels(dict): Labels added to every metric, e.g.
+            {'experiment': 'dyadic_interaction_server'} to tell apart
+            experiments collected together (see render()).
+
+    Typical use:
+        metrics = MetricsRegistry()
+        messages_received = metrics.counter('dyadic_messages_received_total',
+                                            'Messages received from clients', 'response_type')
+        metrics.gauge('dyadic_clients', 'Clients connected', lambda: len(global_participant_data))
+        ...
+        messages_received.inc(response['response_type'])
+    """
+
+    def __init__(self, const_labels=None):
+        self.const_labels = dict(const_labels or {})
+        self.metrics = []  # (name, kind, help, metric), in the order they were made
+
+    def add(self, name, kind, help, metric):
+        self.metrics.append((name, kind, help, metric))
+        return metric
+
+    def counter(self, name, help, label=None, fn=None):
+        # With fn, the counter's value is read from fn when the metrics are collected -
+        # for things already counted elsewhere (e.g. by the matchmaker)
+        if fn is not None:
+            return self.add(name, 'counter', help, Gauge(fn, label))
+        return self.add(name, 'counter', help, Counter(label))
+
+    def histogram(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        return self.add(name, 'histogram', help, Histogram(label, buckets))
+
+    def gauge(self, name, help, fn, label=None):
+        return self.add(name, 'gauge', help, Gauge(fn, label))
+
+    def collect(self):
+        # Yields (name, kind, help, samples), samples being (name, labels, value); a
+        # metric whose function fails is left out rather than losing all the others
+        const_labels = sorted(self.const_labels.items())
+        for name, kind, help, metric in self.metrics:
+            try:
+                samples = [(sample_name, const_labels + labels, value)
+                           for sample_name, labels, value in metric.samples(name)]
+            except Exception:
+                logger.exception('Error collecting metric %s', name)
+                continue
+            yield name, kind, help, samples
+
+
+def render(registries):
+    """
+    The metrics in all of registries, in Prometheus' text format. Metrics with
+    the same name in different registries (which should have different
+    const_labels) are listed together.
+    """
+    families = {}
+    order = []
+    for registry in registries:
+        for name, kind, help, samples in registry.collect():
+            if name not in families:
+                families[name] = (kind, help, [])
+                order.append(name)
+            families[name][2].extend(samples)
+    lines = []
+    for name in order:
+        kind, help, samples = families[name]
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for sample_name, labels, value in samples:
+            lines.append('%s%s %s' % (sample_name, format_labels(labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+######################
+##### Serving metrics over HTTP
+######################
+
+class MetricsServer(object):
+    """
+    Serves metrics at http://host:port/metrics on a thread of its own.
+
+    Args:
+        port(int): Port to listen on - a different one from the websocket server's.
+        collect: Function returning the metrics as text, e.g.
+            lambda: state_actor.call(render, [metrics], timeout=COLLECT_TIMEOUT)
+            to collect them on the state actor. If it raises CallTimeout
+            the request gets a 503.
+        host(str): Address to listen on.
+    """
+
+    def __init__(self, port, collect, host='0.0.0.0'):
+        self.collect = collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] not in ('/metrics', '/'):
+                    handler.send_error(404)
+                    return
+                try:
+                    body = self.collect().encode('utf-8')
+                except CallTimeout as e:
+                    logger.warning('Timed out collecting metrics: %s', e)
+                    handler.send_error(503)
+                    return
+                except Exception:
+                    logger.exception('Error collecting metrics')
+                    handler.send_error(500)
+                    return
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                # rather than printing every request
+                logger.debug(format, *args)
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-server')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_server_metrics(metrics, server):
+    """
+    Adds metrics on the websocket server itself to metrics: connections, data
+    waiting to be sent, pings and dead connections.
+    """
+    def send_queues():
+        return server.send_queue_stats()
+    metrics.gauge('websocket_connections', 'Open websocket connections',
+                  lambda: len(server.registry.by_id))
+    metrics.gauge('websocket_send_queue_bytes', 'Bytes waiting to be sent, over all connections',
+                  lambda: send_queues()['queued_bytes'])
+    metrics.gauge('websocket_send_queue_max_bytes', 'Bytes waiting to be sent to the furthest behind connection',
+                  lambda: send_queues()['max_queued_bytes'])
+    metrics.counter('websocket_backpressure_disconnects_total',
+                    'Connections closed for not keeping up with what was sent to them',
+                    fn=lambda: server.backpressure_disconnects)
+    if server.heartbeat is not None:
+        metrics.counter('websocket_pings_sent_total', 'Pings sent to idle connections',
+                        fn=lambda: server.heartbeat.pings_sent)
+        metrics.counter('websocket_dead_connections_total', 'Connections closed for not answering a ping',
+                        fn=lambda: server.heartbeat.dead_connections)
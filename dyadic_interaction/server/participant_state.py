@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Single-threaded access to participant state
+##############
+
+# The threaded websocket server calls new_client, client_left and message_received
+# from a different thread for every client. The dyadic interaction server keeps all
+# its state (global_participant_data, the matchmaker etc) in ordinary dictionaries
+# and lists, and most of what it does involves reading and changing the state of
+# *two* clients - pairing them, swapping their roles, noticing one has dropped out.
+# If two threads do this at the same moment they can both see the same
+# half-updated state, e.g. two clients entering PairParticipants together can both
+# see an even number of unpaired clients.
+
+# Rather than putting locks around every access to the state, we hand every event
+# to a StateActor: a single thread which runs the functions it is given one at a
+# time, in the order they arrived. Since only this thread ever touches the
+# participant state, each event handler sees and leaves the state in one
+# consistent piece, and the experiment code can stay exactly as simple as it was.
+# Handlers should be quick (they only update dictionaries and queue messages to
+# send), so one thread easily keeps up with thousands of clients.
+
+import threading
+import logging
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+
+class CallTimeout(Exception):
+    """Raised by StateActor.call when fn hasn't run within the timeout."""
+
+
+class StateActor(object):
+    """
+    Runs submitted functions one at a time on its own thread.
+
+    Typical use, with a websocket server:
+        state_actor = StateActor()
+        server.set_fn_new_client(state_actor.wrap(new_client))
+        server.set_fn_client_left(state_actor.wrap(client_left))
+        server.set_fn_message_received(state_actor.wrap(message_received))
+        state_actor.start()
+    """
+
+    def __init__(self, name='participant-state'):
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.timers = []
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.thread.start()
+        for timer in self.timers:
+            timer.start()
+
+    def stop(self):
+        # Everything submitted before stop() still runs
+        self.stopped.set()
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def wrap(self, fn):
+        # Returns a function that, instead of running fn, has the actor run it
+        def submit_fn(*args):
+            self.submit(fn, *args)
+        return submit_fn
+
+    def every(self, seconds, fn, *args):
+        # Has the actor run fn every so many seconds, e.g. to check for timeouts.
+        # A timer thread does the waiting and submits fn like any other event, so
+        # fn can use the state freely. Call before start().
+        def tick():
+            while not self.stopped.wait(seconds):
+                self.submit(fn, *args)
+        timer = threading.Thread(target=tick, name=self.thread.name + '-timer')
+        timer.daemon = True
+        self.timers.append(timer)
+
+    def call(self, fn, *args, **kwargs):
+        # Runs fn on the actor thread and waits for its result - useful for
+        # reading the state consistently from another thread. With timeout=seconds,
+        # raises CallTimeout if the actor hasn't got round to fn by then (fn still
+        # runs once it does, and its result is thrown away)
+        timeout = kwargs.pop('timeout', None)
+        done = threading.Event()
+        result = {}
+        def run_and_signal():
+            try:
+                result['value'] = fn(*args)
+            finally:
+                done.set()
+        self.submit(run_and_signal)
+        if not done.wait(timeout):
+            raise CallTimeout('%s took over %s seconds' % (getattr(fn, '__name__', fn), timeout))
+        return result.get('value')
+
+    def wait_until_idle(self):
+        # Blocks until everything submitted so far has run
+        self.queue.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                fn, args = item
+                fn(*args)
+            except Exception:
+                # One bad message shouldn't stop the experiment for everybody else
+                logger.exception('Error handling participant event')
+            finally:
+                self.queue.task_done()
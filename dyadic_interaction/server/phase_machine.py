@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Declarative phases and response handlers for an experiment
+##############
+
+# Each client works through a list of named phases (e.g. Start, PairParticipants,
+# Interaction, End), and their responses are handled according to the response_type
+# the client sends. Rather than a long if/elif chain comparing phase names and
+# response types, an experiment registers a function for each phase it needs to do
+# something on entering, and for each response type it handles:
+
+#   phases = PhaseMachine(['Start','PairParticipants','Interaction','End'], global_participant_data)
+#
+#   @phases.on_enter('End')
+#   def enter_end(client_id):
+#       send_message_by_id(client_id,{"command_type":"EndExperiment"})
+#
+#   @phases.on_response('RESPONSE', role='Director')
+#   def handle_director_response(client_id,full_response):
+#       ...
+
+# The machine keeps each client's current phase in their entry in the participant
+# dictionary (under 'phase', as before), works out which phase follows which once when
+# it is created, and finds handlers with a single dictionary lookup, so the cost of
+# moving clients on doesn't grow with the number of phases or response types.
+
+# It also times every transition: how long clients spend in each phase before moving
+# to the next, and how long the handler for entering a phase takes to run. stats()
+# reports these, along with the time taken handling each response type.
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TransitionTimer(object):
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max}
+
+
+class PhaseMachine(object):
+    """
+    Args:
+        phase_sequence(list): Names of the phases, in the order clients go
+            through them. Names must be unique.
+        participants(dict): The experiment's dictionary of per-client data,
+            indexed by client ID; each client's phase is kept in it.
+        clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, phase_sequence, participants, clock=time.time):
+        if len(set(phase_sequence)) != len(phase_sequence):
+            raise ValueError('phase names must be unique: %r' % (phase_sequence,))
+        self.phase_sequence = list(phase_sequence)
+        self.participants = participants
+        self.clock = clock
+        # phase -> the phase after it (None for the last phase)
+        self.next_phase = dict(zip(self.phase_sequence, self.phase_sequence[1:] + [None]))
+        self.enter_handlers = {}
+        # (response_type, role) -> handler; role None matches any role
+        self.response_handlers = {}
+        # (from phase, to phase) -> time spent in the from phase / entering the to phase
+        self.dwell_times = {}
+        self.enter_times = {}
+        self.response_times = {}
+
+    ######################
+    ##### Registering handlers
+    ######################
+
+    def on_enter(self, phase):
+        # Decorator registering fn(client_id) to run when a client enters phase
+        if phase not in self.next_phase:
+            raise ValueError('unknown phase %r' % (phase,))
+        def register(fn):
+            self.enter_handlers[phase] = fn
+            return fn
+        return register
+
+    def on_response(self, response_type, role=None):
+        # Decorator registering fn(client_id, full_response) for responses of this
+        # response_type. If role is given the handler only gets responses whose
+        # role key matches it, otherwise it gets them all.
+        def register(fn):
+            self.response_handlers[(response_type, role)] = fn
+            return fn
+        return register
+
+    ######################
+    ##### Moving clients through the phases
+    ######################
+
+    def enter_phase(self, client_id, phase):
+        participant = self.participants[client_id]
+        now = self.clock()
+        previous_phase = participant.get('phase')
+        if previous_phase is not None and 'phase_entered' in participant:
+            self.timer(self.dwell_times, (previous_phase, phase)).add(now - participant['phase_entered'])
+        participant['phase'] = phase
+        participant['phase_entered'] = now
+        handler = self.enter_handlers.get(phase)
+        if handler is not None:
+            handler(client_id)
+            # includes the time taken by any further phases entered from handler
+            self.timer(self.enter_times, (previous_phase, phase)).add(self.clock() - now)
+
+    def progress_phase(self, client_id):
+        current_phase = self.participants[client_id]['phase']
+        next_phase = self.next_phase[current_phase]
+        if next_phase is None:
+            raise ValueError('client %r is already in the last phase, %r' % (client_id, current_phase))
+        self.enter_phase(client_id, next_phase)
+
+    def handle_response(self, client_id, response_type, full_response):
+        handler = self.response_handlers.get((response_type, full_response.get('role')))
+        if handler is None:
+            handler = self.response_handlers.get((response_type, None))
+        if handler is None:
+            logger.warning('No handler for response type %r from client %r', response_type, client_id)
+            return
+        start = self.clock()
+        handler(client_id, full_response)
+        self.timer(self.response_times, response_type).add(self.clock() - start)
+
+    ######################
+    ##### Timing
+    ######################
+
+    def timer(self, timers, key):
+        timer = timers.get(key)
+        if timer is None:
+            timer = timers[key] = TransitionTimer()
+        return timer
+
+    def stats(self):
+        """
+        Returns a dictionary of timings (counts, mean and max seconds):
+        'dwell' - time spent in a phase, keyed by 'from->to' transition
+        'enter' - time running the handler on entering a phase, same keys
+        'response' - time running response handlers, keyed by response type
+        """
+        def summarise(timers):
+            return dict((key if isinstance(key, str) else '%s->%s' % key, timer.summary())
+                        for key, timer in timers.items())
+        return {'dwell': summarise(self.dwell_times),
+                'enter': summarise(self.enter_times),
+                'response': summarise(self.response_times)}
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Encoding and decoding messages to and from clients
+##############
+
+# Every command the server sends is a small dictionary, turned into JSON text and then
+# into websocket frames - and every response it receives is JSON text turned back into a
+# dictionary. With many clients this adds up, so a MessageEncoder speeds up both ends:
+# - most commands are just {"command_type": X} (WaitingRoom, WaitForPartner,
+#   PartnerDropout...), and these are only encoded once: the encoded message, and the
+#   frames made from it (see PreparedMessage in websocket_server.py), are kept and sent
+#   again as they are to every other client getting the same command
+# - JSON is encoded and decoded with orjson, which is several times faster than the
+#   json module, if it is installed (pip install orjson) - otherwise with json as before
+# - clients may ask for MessagePack instead of JSON (a binary format, smaller and
+#   quicker to decode than JSON), by offering the "msgpack" subprotocol when they connect,
+#   e.g. new WebSocket(url, ["msgpack"]) - if the msgpack package is installed (pip install
+#   msgpack). Clients that don't ask for it get JSON text as usual.
+# See benchmarks/serializer_benchmark.py for how these compare.
+
+import json
+
+from websocket_server import PreparedMessage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonSerializer(object):
+    name = 'json'
+    binary = False
+
+    def dumps(self, message):
+        return json.dumps(message).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonSerializer(object):
+    # Produces the same JSON as JsonSerializer, just without the spaces after , and :
+    name = 'json'
+    binary = False
+
+    def dumps(self, message):
+        return orjson.dumps(message)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackSerializer(object):
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# The fastest JSON serializer we have
+def json_serializer():
+    return OrjsonSerializer() if orjson is not None else JsonSerializer()
+
+# Serializers clients can ask for by subprotocol, for whichever of them are installed
+def available_subprotocols():
+    return [MsgpackSerializer()] if msgpack is not None else []
+
+
+class MessageEncoder(object):
+    """
+    Encodes messages for, and decodes messages from, each client in the
+    format they asked for when they connected.
+
+    Args:
+        default: Serializer for clients that didn't ask for a subprotocol, by
+            default the fastest JSON serializer installed.
+        subprotocols(list): Serializers clients can ask for by name as a
+            subprotocol, by default all of those installed. [] to only ever
+            use default.
+
+    Properties:
+        subprotocols(list): The names of the subprotocols, to give the server
+            as WebsocketServer(..., subprotocols=encoder.subprotocols).
+
+    Typical use:
+        encoder = MessageEncoder()
+        server.send_prepared_message(client, encoder.encode(message, client))
+        ...
+        response = encoder.decode(message, client)
+    """
+
+    def __init__(self, default=None, subprotocols=None):
+        self.default = default if default is not None else json_serializer()
+        if subprotocols is None:
+            subprotocols = available_subprotocols()
+        self.by_name = dict((serializer.name, serializer) for serializer in subprotocols)
+        self.subprotocols = [serializer.name for serializer in subprotocols]
+        # (serializer name, command_type) -> PreparedMessage, for commands with nothing else in them
+        self.constant_messages = {}
+
+    def serializer_for(self, client):
+        return self.by_name.get(client['handler'].subprotocol, self.default)
+
+    def encode(self, message, client):
+        serializer = self.serializer_for(client)
+        if len(message) == 1 and 'command_type' in message:
+            key = (serializer.name, message['command_type'])
+            prepared = self.constant_messages.get(key)
+            if prepared is None:
+                prepared = self.constant_messages[key] = PreparedMessage(serializer.dumps(message), serializer.binary)
+            return prepared
+        return PreparedMessage(serializer.dumps(message), serializer.binary)
+
+    def decode(self, message, client):
+        return self.serializer_for(client).loads(message)
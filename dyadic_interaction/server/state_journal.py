@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Journal of participant state, for recovering from a server restart
+##############
+
+# The server keeps everything it knows about participants in memory, so if it crashes
+# or is restarted every dyad part way through the experiment is lost. A StateJournal
+# keeps a copy of the important state on disk: every time a participant's state
+# changes the server records their new state, and the journal appends it to a file
+# (journal.jsonl) on a background thread. When the server starts up, restore() reads
+# it back.
+
+# Appending to the journal forever would make it (and restoring from it) ever slower,
+# so every snapshot_every entries the journal writes a snapshot - the current state of
+# everyone, in one file - and starts a fresh journal. Restoring then reads the snapshot
+# plus the (short) journal since, which takes milliseconds even with thousands of
+# participants.
+
+# Each entry is numbered, and the snapshot records the number of the last entry it
+# includes, so it doesn't matter if the server crashes between writing a snapshot and
+# starting the fresh journal: entries already in the snapshot are skipped. Entries are
+# written out as soon as the background thread gets to them, and flushed to disk with
+# fsync at least every fsync_interval seconds; a line cut short by a crash is ignored.
+
+import os
+import json
+import time
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = 'journal.jsonl'
+SNAPSHOT_FILE = 'snapshot.json'
+# Most entries to write out in one go
+MAX_BATCH = 1000
+
+
+class StateJournal(object):
+    """
+    Args:
+        directory(str): Where to keep the journal and snapshot, created if needed.
+        snapshot_every(int): Number of entries after which to write a snapshot.
+        fsync_interval(float): Maximum seconds between fsyncs of the journal.
+    """
+
+    def __init__(self, directory, snapshot_every=10000, fsync_interval=1.0):
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.fsync_interval = fsync_interval
+        self.queue = queue.Queue()
+        # The journal's own copy of the state (key -> value), kept up to date by the
+        # background thread so that snapshots never need to look at the server's state
+        self.state = {}
+        self.seq = 0
+        self.entries_since_snapshot = 0
+        self.journal = None
+        self.thread = None
+        self.restored = False
+        self.unsynced = False
+        # metrics
+        self.entries_written = 0
+        self.snapshots = 0
+        self.fsyncs = 0
+        self.restore_seconds = None
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.directory, JOURNAL_FILE)
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, SNAPSHOT_FILE)
+
+    ######################
+    ##### Restoring
+    ######################
+
+    def restore(self):
+        """
+        Reads back the state as it was when the journal was last written to.
+        Returns a dictionary from key to value (the server uses participant IDs
+        as keys). Call before start().
+        """
+        start = time.time()
+        self.state = {}
+        self.seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            self.state = snapshot['state']
+            self.seq = snapshot['seq']
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # a line cut short by a crash - it can only be the last one
+                        break
+                    if entry['seq'] <= self.seq:
+                        continue  # already in the snapshot
+                    self.apply(entry)
+        self.restore_seconds = time.time() - start
+        self.restored = True
+        return dict(self.state)
+
+    def apply(self, entry):
+        self.seq = entry['seq']
+        if entry.get('deleted'):
+            self.state.pop(entry['key'], None)
+        else:
+            self.state[entry['key']] = entry['value']
+
+    ######################
+    ##### Recording changes
+    ######################
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # (never start without restoring, or the snapshot below would wipe out the old state)
+        if not self.restored:
+            self.restore()
+        # Begin with a snapshot of whatever was restored, so that the journal starts
+        # empty rather than with (maybe) a partial line at the end
+        self.write_snapshot()
+        self.thread = threading.Thread(target=self.run, name='state-journal')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, key, value):
+        # Records key's new value - anything json can encode
+        self.queue.put((key, value, False))
+
+    def remove(self, key):
+        self.queue.put((key, None, True))
+
+    def close(self):
+        # Writes out everything recorded so far and stops the background thread
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        last_fsync = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                item = ()
+            # write out everything waiting (up to MAX_BATCH entries) in one go
+            lines = []
+            closing = False
+            while item != ():
+                if item is None:
+                    closing = True
+                    break
+                key, value, deleted = item
+                entry = {'seq': self.seq + 1, 'key': key}
+                if deleted:
+                    entry['deleted'] = True
+                else:
+                    entry['value'] = value
+                lines.append(json.dumps(entry))
+                self.apply(entry)
+                if len(lines) >= MAX_BATCH:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = ()
+            try:
+                if lines:
+                    self.journal.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                    self.journal.flush()
+                    self.entries_written += len(lines)
+                    self.entries_since_snapshot += len(lines)
+                    self.unsynced = True
+                if self.unsynced and (closing or time.time() - last_fsync >= self.fsync_interval):
+                    os.fsync(self.journal.fileno())
+                    self.unsynced = False
+                    self.fsyncs += 1
+                    last_fsync = time.time()
+                if self.entries_since_snapshot >= self.snapshot_every:
+                    self.write_snapshot()
+            except (IOError, OSError):
+                logger.exception('Could not write to the state journal in %s', self.directory)
+            if closing:
+                self.journal.close()
+                return
+
+    def write_snapshot(self):
+        # Written to a temporary file and renamed, so there is always a complete snapshot
+        temporary = self.snapshot_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'seq': self.seq, 'state': self.state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.snapshot_path)
+        # everything in the journal is now in the snapshot, so start a new one
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'wb')
+        self.entries_since_snapshot = 0
+        self.unsynced = False
+        self.snapshots += 1
+
+    def stats(self):
+        return {'entries_written': self.entries_written,
+                'entries_waiting': self.queue.qsize(),
+                'keys': len(self.state),
+                'snapshots': self.snapshots,
+                'fsyncs': self.fsyncs,
+                'restore_seconds': self.restore_seconds}
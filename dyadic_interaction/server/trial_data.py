@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Recording trial data on the server
+##############
+
+# The server already knows the outcome of every interaction trial (who was director
+# and matcher, the target, the director's label, the matcher's guess and the score),
+# so it can save it directly rather than relying on the clients to post it to
+# save_data.php one trial at a time.
+
+# A TrialDataSink collects trial records and writes them out on a background thread,
+# one file per dyad, in CSV or JSON-lines format. Records are held in memory and
+# written in batches - when a dyad has flush_records records waiting, or every
+# flush_interval seconds - so the server isn't opening and appending to a file for
+# every single trial, and the thread handling participant events never waits for the
+# disk. When a dyad is finished their file is flushed to disk with fsync, so the
+# data is safely stored once the experiment is over.
+
+# Several experiments hosted in one server (see experiment_host.py) share a single
+# sink, each recording through a TrialDataView, which writes the experiment's files
+# under its own prefix (so the files are named just as they would be if the
+# experiment ran on its own).
+
+# If the server crashes, at most the last flush_interval seconds of records are
+# lost. A batch is written with a single write, so a crash can at worst leave a
+# partial line at the end of a file; the next time the sink writes to that file it
+# removes the partial line before appending.
+
+import os
+import re
+import io
+import csv
+import json
+import time
+import atexit
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+logger = logging.getLogger(__name__)
+
+# How much of the end of an existing file to read when checking for a partial line
+TAIL_CHECK_BYTES = 65536
+
+
+def safe_filename(name):
+    # participant IDs come from the client, so keep only characters safe in a file name
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(name))
+
+
+class TrialDataSink(object):
+    """
+    Args:
+        directory(str): Where to write the files, created if needed.
+        fields(list): Names of the fields in each record, in column order.
+        file_format(str): 'csv' or 'jsonl'.
+        prefix(str): Start of each file name, followed by the dyad ID.
+        flush_records(int): Write a dyad's records once this many are waiting.
+        flush_interval(float): Write all waiting records at least this often (seconds).
+    """
+
+    def __init__(self, directory, fields, file_format='csv', prefix='trials',
+                 flush_records=50, flush_interval=5.0):
+        if file_format not in ('csv', 'jsonl'):
+            raise ValueError('file_format must be csv or jsonl, not %r' % (file_format,))
+        self.directory = directory
+        self.fields = list(fields)
+        self.file_format = file_format
+        self.prefix = prefix
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.buffers = {}  # dyad ID -> list of records waiting to be written
+        self.checked_paths = set()
+        self.thread = None
+        # metrics
+        self.records_written = 0
+        self.writes = 0
+        self.fsyncs = 0
+
+    def start(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.thread = threading.Thread(target=self.run, name='trial-data')
+        self.thread.daemon = True
+        self.thread.start()
+        # write out whatever is waiting if the server exits normally
+        atexit.register(self.close)
+
+    def record(self, dyad_id, record):
+        # Queues one trial record (a dictionary with the sink's fields) for dyad_id
+        self.queue.put(('record', dyad_id, record))
+
+    def finish(self, dyad_id):
+        # Writes out the dyad's records and fsyncs their file - call when the dyad
+        # is done, whether they finished the experiment or someone dropped out
+        self.queue.put(('finish', dyad_id, None))
+
+    def close(self):
+        # Writes out and fsyncs everything, then stops the background thread
+        if self.thread is None or not self.thread.is_alive():
+            return
+        self.queue.put(('close', None, None))
+        self.thread.join()
+
+    def path_for(self, dyad_id):
+        prefix = self.prefix
+        if isinstance(dyad_id, tuple):  # (prefix, dyad ID), from a TrialDataView
+            prefix, dyad_id = dyad_id
+        return os.path.join(self.directory, '%s_%s.%s' % (prefix, safe_filename(dyad_id), self.file_format))
+
+    ######################
+    ##### Background thread
+    ######################
+
+    def run(self):
+        next_flush = time.time() + self.flush_interval
+        while True:
+            try:
+                action, dyad_id, record = self.queue.get(timeout=max(0, next_flush - time.time()))
+            except queue.Empty:
+                action = None
+            if action == 'record':
+                buffer = self.buffers.setdefault(dyad_id, [])
+                buffer.append(record)
+                if len(buffer) >= self.flush_records:
+                    self.flush(dyad_id)
+            elif action == 'finish':
+                self.flush(dyad_id, sync=True)
+                # (unless the write failed, and their records are kept to try again)
+                if not self.buffers.get(dyad_id):
+                    self.buffers.pop(dyad_id, None)
+            elif action == 'close':
+                for dyad_id in list(self.buffers):
+                    self.flush(dyad_id, sync=True)
+                return
+            if time.time() >= next_flush:
+                for dyad_id in list(self.buffers):
+                    self.flush(dyad_id)
+                next_flush = time.time() + self.flush_interval
+
+    def flush(self, dyad_id, sync=False):
+        records = self.buffers.get(dyad_id)
+        if not records and not sync:
+            return
+        path = self.path_for(dyad_id)
+        if not records and not os.path.exists(path):
+            return
+        try:
+            if path not in self.checked_paths:
+                self.remove_partial_line(path)
+                self.checked_paths.add(path)
+            with open(path, 'ab') as f:
+                if records:
+                    f.write(self.encode(records, f.tell() == 0))
+                    self.writes += 1
+                    self.records_written += len(records)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.fsyncs += 1
+        except (IOError, OSError):
+            # keep the records, to try again at the next flush
+            logger.exception('Could not write trial data to %s', path)
+            return
+        if records:
+            self.buffers[dyad_id] = []
+
+    def encode(self, records, new_file):
+        if self.file_format == 'jsonl':
+            return ''.join(json.dumps(r) + '\n' for r in records).encode('utf-8')
+        out = io.StringIO()
+        writer = csv.DictWriter(out, fieldnames=self.fields, extrasaction='ignore', lineterminator='\n')
+        if new_file:
+            writer.writeheader()
+        writer.writerows(records)
+        return out.getvalue().encode('utf-8')
+
+    def remove_partial_line(self, path):
+        # Cuts off anything after the last newline, i.e. a line cut short by a crash
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            start = max(0, size - TAIL_CHECK_BYTES)
+            f.seek(start)
+            tail = f.read()
+            if tail.endswith(b'\n'):
+                return
+            last_newline = tail.rfind(b'\n')
+            if last_newline < 0 and start > 0:
+                # a line longer than we looked at - leave it alone
+                return
+            keep = start + last_newline + 1
+            logger.warning('Removing partial line at the end of %s', path)
+            f.truncate(keep)
+
+    def stats(self):
+        return {'records_written': self.records_written,
+                'writes': self.writes,
+                'fsyncs': self.fsyncs,
+                'records_waiting': sum(len(b) for b in self.buffers.values()) + self.queue.qsize()}
+
+
+class TrialDataView(object):
+    """
+    One experiment's share of a TrialDataSink used by several experiments, with
+    the methods the experiment uses on a sink of its own. Its files are named
+    with prefix rather than the shared sink's prefix.
+
+    Args:
+        sink(TrialDataSink): The shared sink.
+        prefix(str): Start of the experiment's file names.
+    """
+
+    def __init__(self, sink, prefix):
+        self.sink = sink
+        self.prefix = prefix
+        self.fields = sink.fields
+        self.file_format = sink.file_format
+
+    def record(self, dyad_id, record):
+        self.sink.record((self.prefix, dyad_id), record)
+
+    def finish(self, dyad_id):
+        self.sink.finish((self.prefix, dyad_id))
+
+    def path_for(self, dyad_id):
+        return self.sink.path_for((self.prefix, dyad_id))
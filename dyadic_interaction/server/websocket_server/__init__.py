@@ -1 +1,4 @@
 from .websocket_server import *
+
+if sys.version_info[0] >= 3:
+    from .async_websocket_server import AsyncWebsocketServer, AsyncWebSocketHandler
@@ -0,0 +1,434 @@
+# License: MIT
+
+# An alternative engine for the websocket server, built on asyncio. Rather than
+# giving every client its own thread blocking in WebSocketHandler.handle(), all
+# connections are served as coroutines on a single (selector-based) event loop
+# running in the thread that calls run_forever(). The API (set_fn_new_client,
+# set_fn_client_left, set_fn_message_received, send_message etc) is the same as
+# for the threaded WebsocketServer, so servers written for one run on the other.
+
+import os
+import socket
+import asyncio
+import threading
+import logging
+
+from .websocket_server import (
+    WebsocketServerBase, ClientRegistry, FrameHandlingMixin, WebSocketHandler,
+    FrameParser, FrameError, request_path, logger,
+    OPCODE_CLOSE_CONN, RECEIVE_BUFFER_SIZE, MAX_HANDSHAKE_SIZE, MAX_HANDSHAKE_LINES,
+    DEFAULT_MAX_MESSAGE_SIZE, DEFAULT_MAX_FRAME_SIZE, DEFAULT_MAX_QUEUED_BYTES,
+    DEFAULT_PING_TIMEOUT, Heartbeat
+)
+from .permessage_deflate import PerMessageDeflate, DeflateContext
+
+# Most bytes read from a connection and not yet taken by its handler; reading from the
+# socket pauses while there are more
+READ_BUFFER_LIMIT = 64 * 1024
+
+
+class ConnectionReader(asyncio.Protocol):
+    """
+    The protocol for one connection: keeps what arrives in a buffer of its own
+    until the handler takes it, so that whatever hasn't been handled yet can
+    be handed over along with the connection (see AsyncWebSocketHandler.detach).
+
+    Args:
+        loop: The event loop serving the connection.
+        serve: Coroutine function run, as serve(reader), once connected.
+    """
+
+    def __init__(self, loop, serve=None):
+        self.loop = loop
+        self.serve = serve
+        self.transport = None
+        self.task = None
+        self.buffer = bytearray()
+        self.eof = False
+        self.paused = False
+        self.waiter = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.serve is not None:
+            self.task = self.loop.create_task(self.serve(self))
+
+    def data_received(self, data):
+        self.buffer += data
+        if len(self.buffer) > READ_BUFFER_LIMIT and not self.paused:
+            self.transport.pause_reading()
+            self.paused = True
+        self.wake()
+
+    def eof_received(self):
+        self.eof = True
+        self.wake()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait_for_data(self):
+        # until more arrives, or the other end has closed
+        if self.eof:
+            return
+        self.waiter = self.loop.create_future()
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+
+    def take(self, n=None):
+        # Removes up to n bytes (all of them by default) from the buffer, and returns them
+        if n is None or n >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(self.buffer[:n])
+            del self.buffer[:n]
+        if self.paused and len(self.buffer) <= READ_BUFFER_LIMIT:
+            self.paused = False
+            self.transport.resume_reading()
+        return data
+
+    async def read(self, n):
+        # Up to n bytes, as soon as there are any; b'' once the other end has closed
+        while not self.buffer and not self.eof:
+            await self.wait_for_data()
+        return self.take(n)
+
+    async def read_until(self, delimiter, limit):
+        # Up to and including delimiter, or None if the other end closes first, or more
+        # than limit bytes arrive without it
+        while True:
+            end = self.buffer.find(delimiter)
+            if end >= 0:
+                end += len(delimiter)
+                return self.take(end) if end <= limit else None
+            if self.eof or len(self.buffer) > limit:
+                return None
+            await self.wait_for_data()
+
+
+class AsyncWebsocketServer(WebsocketServerBase):
+    """
+    A websocket server waiting for clients to connect, serving every client
+    from one asyncio event loop.
+
+    Args:
+        port(int): Port to bind to
+        host(str): Hostname or IP to listen for connections. By default 127.0.0.1
+            is being used. To accept connections from any client, you should use
+            0.0.0.0.
+        loglevel: Logging level from logging module to use for logging. By default
+            warnings and errors are being logged.
+        max_message_size(int): Largest message (in bytes, after reassembling
+            fragments) accepted from a client.
+        max_frame_size(int): Outgoing messages longer than this are fragmented
+            into frames of at most this many bytes. None to never fragment.
+        max_queued_bytes(int): Clients with more than this many bytes waiting
+            to be sent to them are disconnected.
+        compression: A PerMessageDeflate with the settings for compressing
+            messages to clients that support it, True to use the default
+            settings, or None (the default) to never compress.
+        backlog(int): Number of pending connections the OS queues for us. Bursts
+            of participants arriving at once need this to be fairly large.
+        ping_interval(float): Ping clients we haven't heard from for this many
+            seconds, and close the connection if they don't answer within
+            ping_timeout seconds, as for WebsocketServer.
+        ping_timeout(float): Seconds to wait for the answer to a ping.
+        reuse_port(bool): Let several processes listen on the same port, as for
+            WebsocketServer. Processes can also hand connections over to each
+            other, see AsyncWebSocketHandler.detach() and adopt().
+        subprotocols(list): Names of subprotocols the server can speak, most
+            preferred first, as for WebsocketServer.
+
+    Properties:
+        clients(list): A list of connected clients, exactly as for
+            WebsocketServer.
+        registry(ClientRegistry): Connected clients indexed by handler and id.
+        loop: The asyncio event loop all connections are served on.
+    """
+
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING,
+                 max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES, compression=None, backlog=1024,
+                 ping_interval=None, ping_timeout=DEFAULT_PING_TIMEOUT, reuse_port=False,
+                 subprotocols=None):
+        logger.setLevel(loglevel)
+        self.registry = ClientRegistry()
+        self.max_message_size = max_message_size
+        self.max_frame_size = max_frame_size
+        self.max_queued_bytes = max_queued_bytes
+        self.compression = PerMessageDeflate() if compression is True else compression
+        if ping_interval is not None:
+            self.heartbeat = Heartbeat(ping_interval, ping_timeout)
+        self.subprotocols = tuple(subprotocols or ())
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread_id = None
+        start = self.loop.create_server(lambda: ConnectionReader(self.loop, self._serve_client_), host, port,
+                                        reuse_address=True, reuse_port=reuse_port or None, backlog=backlog)
+        self.listener = self.loop.run_until_complete(start)
+        self.port = self.listener.sockets[0].getsockname()[1]
+
+    def serve_forever(self):
+        self.loop_thread_id = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def shutdown(self):
+        # Safe to call from any thread, like TCPServer.shutdown()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def server_close(self):
+        self.listener.close()
+        self.loop.run_until_complete(self.listener.wait_closed())
+        self.loop.close()
+
+    def in_loop_thread(self):
+        return threading.get_ident() == self.loop_thread_id
+
+    async def _serve_client_(self, reader):
+        handler = AsyncWebSocketHandler(reader, self)
+        await handler.handle()
+
+    def adopt(self, fd, client_id, state, on_adopted=None):
+        """
+        Takes over a connection handed over by another process: fd and state
+        are what AsyncWebSocketHandler.detach() returned there. The client keeps
+        its id, and isn't reported as a new client - instead on_adopted(client)
+        is called (on the event loop thread) before anything more is read from
+        it. Safe to call from any thread.
+        """
+        coroutine = self._adopt_client_(fd, client_id, state, on_adopted)
+        try:
+            asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        except RuntimeError:
+            # the server has stopped, so the connection has nowhere to go
+            coroutine.close()
+            os.close(fd)
+
+    async def _adopt_client_(self, fd, client_id, state, on_adopted):
+        sock = socket.socket(fileno=fd)
+        reader = ConnectionReader(self.loop)
+        # bytes the old process had already read, which come before anything still in the socket
+        reader.buffer += state['buffered']
+        await self.loop.connect_accepted_socket(lambda: reader, sock)
+        handler = AsyncWebSocketHandler(reader, self)
+        handler.handshake_done = True
+        handler.valid_client = True
+        handler.path = state['path']
+        handler.subprotocol = state['subprotocol']
+        handler.client_address = tuple(state['address'])
+        if state['deflate'] is not None:
+            # a fresh compressor is fine even with context takeover: the client just
+            # keeps a window we never refer back to
+            handler.deflate = DeflateContext(self.compression or PerMessageDeflate(), **state['deflate'])
+        client = self.registry.add(handler, client_id)
+        if self.heartbeat is not None:
+            self.heartbeat.add(handler)
+        if on_adopted is not None:
+            on_adopted(client)
+        await handler.handle()
+
+
+class AsyncWebSocketHandler(FrameHandlingMixin):
+    """
+    Counterpart of WebSocketHandler for the asyncio engine: one of these per
+    connection, reading frames with await rather than blocking a thread.
+    """
+
+    def __init__(self, reader, server):
+        self.reader = reader
+        self.transport = reader.transport
+        self.server = server
+        self.client_address = self.transport.get_extra_info('peername')
+        self.send_lock = threading.Lock()
+        self.keep_alive = True
+        self.handshake_done = False
+        self.valid_client = False
+        # the transport is this connection's outbound queue; we keep count of
+        # what goes into it for send_queue_stats()
+        self.frames_queued = 0
+        self.bytes_queued = 0
+        self.peak_queued_bytes = 0
+        # frames are parsed out of what the reader gives us, several at a time
+        # if they arrive together
+        self.parser = FrameParser(self.accept_frame)
+        # True while waiting for more data, rather than handling a frame
+        self.between_frames = False
+
+    async def handle(self):
+        try:
+            while self.keep_alive:
+                if not self.handshake_done:
+                    await self.handshake()
+                elif self.valid_client:
+                    await self.read_next_message()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info("Client closed connection.")
+        except Exception as e:
+            logger.error(str(e), exc_info=True)
+        finally:
+            self.keep_alive = False
+            self.finish()
+
+    async def read_next_message(self):
+        try:
+            frame = self.parser.next_frame()
+            while frame is None:
+                self.between_frames = True
+                data = await self.reader.read(RECEIVE_BUFFER_SIZE)
+                self.between_frames = False
+                if not data:
+                    raise asyncio.IncompleteReadError(b'', None)
+                self.parser.feed(data)
+                frame = self.parser.next_frame()
+        except FrameError:
+            self.keep_alive = 0
+            return
+
+        fin, rsv1, opcode, payload = frame
+        if opcode == OPCODE_CLOSE_CONN:
+            logger.info("Client asked to close connection.")
+            self.keep_alive = 0
+            return
+        self.handle_frame(fin, rsv1, opcode, payload)
+
+    def _write_frames_(self, frames):
+        # The transport is not thread-safe, so a message sent from some other
+        # thread (e.g. a timer) is handed over to the event loop to write.
+        # All frames of a message are written in one go, so fragments of
+        # different messages never interleave.
+        if self.server.in_loop_thread():
+            self._write_(frames)
+        else:
+            self.server.loop.call_soon_threadsafe(self._write_, frames)
+
+    def _write_(self, frames):
+        transport = self.transport
+        if transport.is_closing():
+            return
+        size = 0
+        for header, payload in frames:
+            size += len(header) + len(payload)
+        buffered = transport.get_write_buffer_size()
+        if buffered and buffered + size > self.server.max_queued_bytes:
+            logger.warning("Client not keeping up with messages sent to it, disconnecting.")
+            self.server.backpressure_disconnects += 1
+            transport.abort()
+            return
+        # headers and payloads are handed over as separate buffers, not joined
+        transport.writelines([buffer for frame in frames for buffer in frame])
+        self.frames_queued += len(frames)
+        self.bytes_queued += size
+        self.peak_queued_bytes = max(self.peak_queued_bytes, transport.get_write_buffer_size())
+
+    def close_connection(self):
+        # Safe to call from any thread, like WebSocketHandler.close_connection()
+        self.keep_alive = False
+        self.server.loop.call_soon_threadsafe(self.transport.abort)
+
+    def detach(self):
+        """
+        Stops serving this connection without closing it, so that it can be
+        handed over to another process, which carries on with it using
+        AsyncWebsocketServer.adopt(). Returns a duplicate of the socket's file
+        descriptor (to send to the other process, then close) and the state of
+        the connection it needs, or None if the connection can't be handed over
+        just now: it has closed, or we are part way through reading a message
+        or writing to it. Must be called on the event loop thread; the client is
+        not reported as having left.
+        """
+        transport = self.transport
+        if not self.keep_alive or transport.is_closing() or not self.between_frames or \
+                self.fragments is not None or transport.get_write_buffer_size():
+            return None
+        # what the client compressed can only be decompressed by the other process if
+        # every message is compressed on its own
+        if self.deflate is not None and not self.deflate.client_no_context_takeover:
+            return None
+        # what has arrived but not been handled yet goes too: part of a frame in the
+        # parser, and anything after it still in the reader's buffer
+        buffered = self.parser.pending() + self.reader.take()
+        fd = os.dup(transport.get_extra_info('socket').fileno())
+        state = {'path': self.path, 'subprotocol': self.subprotocol,
+                 'address': list(self.client_address), 'buffered': buffered,
+                 'deflate': None if self.deflate is None else self.deflate.params()}
+        # closing our copy of the socket leaves the connection open, as the duplicate is still open
+        self.valid_client = False
+        self.keep_alive = False
+        self.server.registry.remove(self)
+        transport.abort()
+        return fd, state
+
+    def send_queue_stats(self):
+        queued_bytes = self.transport.get_write_buffer_size()
+        return {'queued_bytes': queued_bytes,
+                'peak_queued_bytes': self.peak_queued_bytes,
+                'frames_queued': self.frames_queued,
+                'bytes_sent': self.bytes_queued - queued_bytes}
+
+    async def read_http_headers(self):
+        # Read as by WebSocketHandler, up to the blank line, and no more than
+        # MAX_HANDSHAKE_SIZE bytes of it
+        request = await self.reader.read_until(b'\r\n\r\n', MAX_HANDSHAKE_SIZE)
+        if request is None:
+            if not self.reader.eof:
+                logger.warning("Handshake longer than %d bytes refused." % MAX_HANDSHAKE_SIZE)
+            return {}
+        lines = request.decode().split('\r\n')
+        if len(lines) > MAX_HANDSHAKE_LINES:
+            logger.warning("Handshake of more than %d lines refused." % MAX_HANDSHAKE_LINES)
+            return {}
+        headers = {}
+        # first line should be HTTP GET
+        http_get = lines[0].strip()
+        assert http_get.upper().startswith('GET')
+        self.path = request_path(http_get)
+        # remaining should be headers
+        for header in lines[1:]:
+            header = header.strip()
+            if not header:
+                break
+            head, value = header.split(':', 1)
+            head = head.lower().strip()
+            # a header sent several times is equivalent to one comma-separated list
+            if head in headers:
+                headers[head] += ', ' + value.strip()
+            else:
+                headers[head] = value.strip()
+        return headers
+
+    async def handshake(self):
+        headers = await self.read_http_headers()
+
+        try:
+            assert headers['upgrade'].lower() == 'websocket'
+        except (AssertionError, KeyError):
+            self.keep_alive = False
+            return
+
+        try:
+            key = headers['sec-websocket-key']
+        except KeyError:
+            logger.warning("Client tried to connect but was missing a key")
+            self.keep_alive = False
+            return
+
+        response = WebSocketHandler.make_handshake_response(key, self.negotiate_extensions(headers),
+                                                            self.negotiate_subprotocol(headers))
+        self.transport.write(response.encode())
+        self.handshake_done = True
+        self.valid_client = True
+        self.server._new_client_(self)
+
+    def finish(self):
+        if self.valid_client:
+            self.server._client_left_(self)
+        self.transport.close()
@@ -0,0 +1,167 @@
+# License: MIT
+
+# Finding connections that have quietly died. If a client's network goes away
+# without the TCP connection being closed properly (a laptop lid shut, a phone
+# switching networks), the server never hears about it: the connection's thread
+# blocks reading forever and the client is never reported as having left. To
+# find these, the server pings any connection it hasn't heard from for
+# ping_interval seconds, and closes it if nothing (the pong, or anything else)
+# comes back within ping_timeout seconds.
+
+# Rather than a timer (and thread) per connection, one Heartbeat thread looks
+# after all of them, using a TimerWheel: a ring of slots, one per tick, where
+# each connection is filed under the tick at which it next needs looking at.
+# Every tick the thread takes out the entries in one slot, so scheduling and
+# expiring are constant time however many connections there are. Hearing from a
+# client costs nothing but noting the time (in FrameHandlingMixin.handle_frame) -
+# when its entry comes up, a connection that has been active since is simply
+# filed again for later.
+
+import math
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel(object):
+    """
+    Items scheduled to come due after a delay, to a resolution of one tick.
+
+    Entries can't be cancelled: whoever handles an item that has come due
+    should check it still applies (e.g. by scheduling a (key, token) pair and
+    comparing the token with the current one).
+
+    Args:
+        tick(float): Resolution, in seconds.
+        slots(int): Number of slots in the ring. Delays longer than slots
+            ticks still work, but their entries are looked at (and put back)
+            every time round the ring.
+        clock: Function returning the current time in seconds.
+    """
+
+    def __init__(self, tick=1.0, slots=512, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [[] for _ in range(slots)]
+        self.current_tick = int(clock() / tick)
+        self.count = 0
+
+    def schedule(self, delay, item):
+        # comes due at the first tick at least delay seconds from now
+        due_tick = int(math.ceil((self.clock() + delay) / self.tick))
+        if due_tick <= self.current_tick:
+            due_tick = self.current_tick + 1
+        self.slots[due_tick % len(self.slots)].append((due_tick, item))
+        self.count += 1
+
+    def advance(self, now=None):
+        """
+        Moves the wheel on to now (the clock's current time by default), and
+        returns the items that have come due, in order.
+        """
+        if now is None:
+            now = self.clock()
+        target = int(now / self.tick)
+        due = []
+        while self.current_tick < target:
+            self.current_tick += 1
+            index = self.current_tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            remaining = []
+            for entry in slot:
+                if entry[0] <= self.current_tick:
+                    due.append(entry[1])
+                else:
+                    remaining.append(entry)
+            self.slots[index] = remaining
+        self.count -= len(due)
+        return due
+
+    def __len__(self):
+        return self.count
+
+
+class Heartbeat(object):
+    """
+    Pings idle connections and closes the ones that don't answer.
+
+    Args:
+        interval(float): Seconds without hearing from a client before pinging it.
+        timeout(float): Seconds to wait for an answer to a ping.
+        tick(float): How often (in seconds) the heartbeat thread wakes up.
+    """
+
+    def __init__(self, interval=20.0, timeout=10.0, tick=1.0):
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick, slots=max(64, int(math.ceil((interval + timeout) / tick)) + 1))
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        # metrics
+        self.pings_sent = 0
+        self.dead_connections = 0
+
+    def add(self, handler):
+        # Called when a connection has completed the handshake
+        handler.last_activity = time.monotonic()
+        handler.ping_sent = None
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='heartbeat')
+                self.thread.daemon = True
+                self.thread.start()
+            self.wheel.schedule(self.interval, handler)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.wheel.tick):
+            with self.lock:
+                due = self.wheel.advance()
+            for handler in due:
+                try:
+                    delay = self.check(handler)
+                except Exception as e:
+                    logger.error(str(e), exc_info=True)
+                    continue
+                if delay is not None:
+                    with self.lock:
+                        self.wheel.schedule(delay, handler)
+
+    def check(self, handler):
+        """
+        Looks at a connection whose entry has come up. Returns how long until it
+        should be looked at again, or None once it has closed.
+        """
+        if not handler.keep_alive:
+            return None
+        now = time.monotonic()
+        if handler.ping_sent is not None:
+            if handler.last_activity >= handler.ping_sent:
+                # heard from them since the ping
+                handler.ping_sent = None
+            elif now - handler.ping_sent >= self.timeout:
+                logger.info("No answer to ping from %s, closing connection." % (handler.client_address,))
+                self.dead_connections += 1
+                handler.close_connection()
+                return None
+            else:
+                return self.timeout - (now - handler.ping_sent)
+        idle = now - handler.last_activity
+        if idle < self.interval:
+            return self.interval - idle
+        handler.ping_sent = now
+        self.pings_sent += 1
+        handler.send_ping()
+        return self.timeout
+
+    def stats(self):
+        return {'connections': len(self.wheel),
+                'pings_sent': self.pings_sent,
+                'dead_connections': self.dead_connections}
@@ -0,0 +1,207 @@
+# License: MIT
+
+# The permessage-deflate extension (RFC 7692): messages are compressed with
+# DEFLATE before being framed, and the RSV1 bit of their first frame is set to
+# say so. The client offers the extension in its handshake, with parameters
+# that say whether each side may keep its compression context (the LZ77
+# window) from one message to the next and how big that window may be; the
+# server picks an offer it can accept and echoes the agreed parameters back.
+
+import zlib
+
+# Every compressed message ends with this empty stored block, which is removed
+# by the sender and put back by the receiver
+DEFLATE_TAIL = b'\x00\x00\xff\xff'
+
+EXTENSION_NAME = 'permessage-deflate'
+
+# When the compressor starts afresh for every message (server_no_context_takeover),
+# messages shorter than this many bytes are sent uncompressed - there's too little
+# in a short JSON command for DEFLATE to find repeats in, so compressing costs
+# more than it saves. With context takeover even short commands repeat earlier
+# ones and shrink several-fold (see benchmarks/deflate_benchmark.py), so by
+# default everything is compressed.
+NO_CONTEXT_TAKEOVER_THRESHOLD = 128
+
+
+def parse_extensions(header):
+    """
+    Parses a Sec-WebSocket-Extensions header into a list of (name, params)
+    pairs, in the client's order of preference, e.g.
+    'permessage-deflate; client_max_window_bits, x-foo' gives
+    [('permessage-deflate', {'client_max_window_bits': None}), ('x-foo', {})]
+    """
+    extensions = []
+    for extension in header.split(','):
+        parts = [part.strip() for part in extension.split(';')]
+        if not parts[0]:
+            continue
+        params = {}
+        for param in parts[1:]:
+            if not param:
+                continue
+            if '=' in param:
+                name, value = param.split('=', 1)
+                params[name.strip().lower()] = value.strip().strip('"')
+            else:
+                params[param.lower()] = None
+        extensions.append((parts[0].lower(), params))
+    return extensions
+
+
+class PerMessageDeflate(object):
+    """
+    Server-side settings for permessage-deflate. Pass one of these to the
+    server as its compression argument (compression=True uses the defaults).
+
+    Args:
+        threshold(int): Messages shorter than this are sent uncompressed. By
+            default 0 with context takeover, NO_CONTEXT_TAKEOVER_THRESHOLD without.
+        level(int): zlib compression level, 1 (fastest) to 9 (smallest).
+        server_no_context_takeover(bool): Reset our compressor after every
+            message. Saves memory per client at the cost of worse compression.
+        client_no_context_takeover(bool): Ask clients to do the same.
+        server_max_window_bits(int): Size (as a power of 2, 9-15) of the
+            window we compress with.
+        client_max_window_bits(int): Largest window we let clients use, if
+            they allow us to limit it.
+    """
+
+    def __init__(self, threshold=None, level=6,
+                 server_no_context_takeover=False, client_no_context_takeover=False,
+                 server_max_window_bits=15, client_max_window_bits=15):
+        self.threshold = threshold
+        self.level = level
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+
+    def negotiate(self, header):
+        """
+        Picks the first permessage-deflate offer in the client's
+        Sec-WebSocket-Extensions header that we can accept. Returns a
+        DeflateContext for the connection and the value of our
+        Sec-WebSocket-Extensions response header, or (None, None) if the
+        client made no acceptable offer.
+        """
+        for name, params in parse_extensions(header):
+            if name == EXTENSION_NAME:
+                agreed = self.accept_offer(params)
+                if agreed is not None:
+                    return DeflateContext(self, **agreed), self.response_header(agreed)
+        return None, None
+
+    def accept_offer(self, params):
+        server_no_context_takeover = self.server_no_context_takeover
+        client_no_context_takeover = self.client_no_context_takeover
+        server_max_window_bits = self.server_max_window_bits
+        client_max_window_bits = 15
+        # this is the only way client_max_window_bits ends up in our response
+        limit_client_window = False
+        for param, value in params.items():
+            if param == 'server_no_context_takeover' and value is None:
+                server_no_context_takeover = True
+            elif param == 'client_no_context_takeover' and value is None:
+                client_no_context_takeover = True
+            elif param == 'server_max_window_bits':
+                bits = parse_window_bits(value)
+                # zlib can't compress raw deflate with an 8-bit window
+                if bits is None or bits < 9:
+                    return None
+                server_max_window_bits = min(server_max_window_bits, bits)
+            elif param == 'client_max_window_bits':
+                # with no value the client just tells us it supports the parameter
+                bits = 15 if value is None else parse_window_bits(value)
+                if bits is None:
+                    return None
+                client_max_window_bits = min(self.client_max_window_bits, bits)
+                limit_client_window = True
+            else:
+                # an unknown or malformed parameter means we must decline the offer
+                return None
+        return {'server_no_context_takeover': server_no_context_takeover,
+                'client_no_context_takeover': client_no_context_takeover,
+                'server_max_window_bits': server_max_window_bits,
+                'client_max_window_bits': client_max_window_bits if limit_client_window else None}
+
+    def response_header(self, agreed):
+        response = [EXTENSION_NAME]
+        if agreed['server_no_context_takeover']:
+            response.append('server_no_context_takeover')
+        if agreed['client_no_context_takeover']:
+            response.append('client_no_context_takeover')
+        if agreed['server_max_window_bits'] < 15:
+            response.append('server_max_window_bits=%d' % agreed['server_max_window_bits'])
+        if agreed['client_max_window_bits'] is not None:
+            response.append('client_max_window_bits=%d' % agreed['client_max_window_bits'])
+        return '; '.join(response)
+
+
+def parse_window_bits(value):
+    try:
+        bits = int(value)
+    except (TypeError, ValueError):
+        return None
+    if 8 <= bits <= 15:
+        return bits
+    return None
+
+
+class DeflateContext(object):
+    """
+    The compressor and decompressor for one connection, with the parameters
+    agreed in its handshake. Keeping the context from message to message is
+    what makes compressing our short, repetitive JSON messages worthwhile.
+    """
+
+    def __init__(self, settings, server_no_context_takeover, client_no_context_takeover,
+                 server_max_window_bits, client_max_window_bits):
+        self.level = settings.level
+        self.server_no_context_takeover = server_no_context_takeover
+        if settings.threshold is not None:
+            self.threshold = settings.threshold
+        elif server_no_context_takeover:
+            self.threshold = NO_CONTEXT_TAKEOVER_THRESHOLD
+        else:
+            self.threshold = 0
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        # if the client wasn't limited it may use the full 15-bit window; a
+        # 9-bit window decompresses anything compressed with an 8-bit one
+        self.client_max_window_bits = max(client_max_window_bits or 15, 9)
+        self.compressor = None
+        self.decompressor = None
+
+    def params(self):
+        # The agreed parameters, to set up the same context for a connection
+        # handed over to another process: DeflateContext(settings, **params)
+        return {'server_no_context_takeover': self.server_no_context_takeover,
+                'client_no_context_takeover': self.client_no_context_takeover,
+                'server_max_window_bits': self.server_max_window_bits,
+                'client_max_window_bits': self.client_max_window_bits}
+
+    def should_compress(self, payload):
+        return len(payload) >= self.threshold
+
+    def compress(self, payload):
+        if self.compressor is None or self.server_no_context_takeover:
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                               -self.server_max_window_bits)
+        data = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(DEFLATE_TAIL):
+            data = data[:-len(DEFLATE_TAIL)]
+        return data
+
+    def decompress(self, payload, max_size):
+        """
+        Returns the decompressed message, or None if it would be longer than
+        max_size bytes (so a small compressed message can't make us allocate
+        an enormous buffer).
+        """
+        if self.decompressor is None or self.client_no_context_takeover:
+            self.decompressor = zlib.decompressobj(-self.client_max_window_bits)
+        data = self.decompressor.decompress(bytes(payload) + DEFLATE_TAIL, max_size + 1)
+        if len(data) > max_size or self.decompressor.unconsumed_tail:
+            return None
+        return data
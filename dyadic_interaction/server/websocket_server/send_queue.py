@@ -0,0 +1,212 @@
+# License: MIT
+
+# Outbound queue for one connection of the threaded WebsocketServer. In the
+# dyadic server one client's handler thread often sends to its partner, so
+# several threads can be writing to the same socket at once - writing straight
+# to the socket lets their frames interleave, and a partial send() silently cuts
+# a frame short. Instead every frame goes through the connection's SendQueue:
+# any thread can put() frames, which never waits on the socket, and the
+# connection's own writer thread (write_forever) writes them out, in order and
+# in full. So a client that stops reading only ever holds up its own writer
+# thread - never the thread sending to it, which in the dyadic server is the
+# state actor sending to everyone.
+
+import select
+import socket
+import threading
+from collections import deque
+
+# sendmsg() takes at most IOV_MAX (1024 on Linux) buffers per call
+MAX_BUFFERS_PER_WRITE = 512
+# how often a writer waiting for room in the socket checks it hasn't been closed
+WRITABLE_POLL_INTERVAL = 1.0
+
+
+class SendQueue(object):
+    """
+    Frames waiting to be written to one socket.
+
+    Args:
+        sock: The connection's socket.
+        max_queued_bytes(int): Backpressure limit - if a client reads so slowly
+            that more than this many bytes are waiting for it, put() refuses any
+            more and the connection should be closed. A single message bigger
+            than this is still accepted when nothing else is waiting.
+    """
+
+    def __init__(self, sock, max_queued_bytes):
+        self.sock = sock
+        self.max_queued_bytes = max_queued_bytes
+        self.lock = threading.Lock()
+        self.buffers = deque()
+        self.queued_bytes = 0
+        self.writing = False
+        self.closed = False
+        # wakes the writer thread when there is something to write
+        self.ready = threading.Condition(self.lock)
+        # metrics
+        self.peak_queued_bytes = 0
+        self.frames_queued = 0
+        self.bytes_sent = 0
+        self.writes = 0
+
+    def put(self, frames):
+        """
+        Queues a list of (header, payload) frames for the writer thread. Doesn't
+        write anything, so never blocks. Returns False if this takes the queue
+        over its limit, in which case the queue closes itself. Frames put on a
+        closed queue are silently dropped.
+        """
+        size = 0
+        for header, payload in frames:
+            size += len(header) + len(payload)
+        with self.lock:
+            if self.closed:
+                return True
+            if self.queued_bytes and self.queued_bytes + size > self.max_queued_bytes:
+                self.close_locked()
+                return False
+            for header, payload in frames:
+                # header and payload stay separate buffers, handed to the kernel
+                # together by sendmsg() rather than concatenated here
+                self.buffers.append(header)
+                if len(payload):
+                    self.buffers.append(payload)
+            self.frames_queued += len(frames)
+            self.queued_bytes += size
+            self.peak_queued_bytes = max(self.peak_queued_bytes, self.queued_bytes)
+            self.ready.notify()
+        return True
+
+    def write_forever(self):
+        """
+        Writes frames out as they are queued, until the queue is closed. Runs
+        on the connection's writer thread.
+        """
+        while True:
+            with self.lock:
+                while not self.buffers and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+            if not self.drain():
+                self.wait_writable()
+
+    def drain(self):
+        """
+        Writes out as much of the queue as the socket has room for, without
+        blocking. Whatever doesn't fit stays queued - counting towards
+        max_queued_bytes, so a client that isn't reading soon goes over it.
+        Returns False if something was left, True if the queue is empty (or
+        closed, as it is if the socket fails).
+        """
+        with self.lock:
+            if self.writing:
+                return True
+            self.writing = True
+        while True:
+            with self.lock:
+                if not self.buffers or self.closed:
+                    self.writing = False
+                    return True
+                batch = []
+                while self.buffers and len(batch) < MAX_BUFFERS_PER_WRITE:
+                    batch.append(self.buffers.popleft())
+            try:
+                written, unsent = self.write_buffers(batch)
+            except (socket.error, OSError, ValueError):
+                with self.lock:
+                    self.close_locked()
+                    self.writing = False
+                return True
+            with self.lock:
+                self.bytes_sent += written
+                if self.closed:
+                    self.writing = False
+                    return True
+                self.queued_bytes -= written
+                if unsent:
+                    # back at the front, to go when the socket has room
+                    self.buffers.extendleft(reversed(unsent))
+                    self.writing = False
+                    return False
+
+    def wait_writable(self):
+        # Waits until the socket has room (or has failed, which the next write
+        # finds out), checking now and then whether the queue has been closed
+        while not self.closed:
+            try:
+                _, writable, _ = select.select([], [self.sock], [], WRITABLE_POLL_INTERVAL)
+            except (OSError, ValueError):
+                return
+            if writable:
+                return
+
+    def send_now(self, data):
+        """
+        Writes data (a small frame, e.g. a ping) straight to the socket if that
+        can be done without blocking and without getting in the way of anything
+        else: nothing queued or being written, and room in the socket. Returns
+        False if it wasn't written.
+        """
+        with self.lock:
+            if self.closed or self.writing or self.buffers:
+                return False
+            try:
+                sent = self.sock.send(data, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return False
+            except (socket.error, OSError):
+                self.close_locked()
+                return True
+            if sent < len(data):
+                # the rest is left to the writer thread
+                self.buffers.append(memoryview(data)[sent:])
+                self.queued_bytes += len(data) - sent
+                self.ready.notify()
+            self.frames_queued += 1
+            self.bytes_sent += sent
+            self.writes += 1
+            return True
+
+    def write_buffers(self, buffers):
+        # One sendmsg() call writes all the buffers if the socket has room for
+        # them; after a partial write carry on from where it stopped, until the
+        # socket is full. Returns the bytes written and what is left unsent
+        views = [memoryview(b) for b in buffers]
+        written = 0
+        while views:
+            self.writes += 1
+            try:
+                if hasattr(self.sock, 'sendmsg'):
+                    sent = self.sock.sendmsg(views, [], socket.MSG_DONTWAIT)
+                else:
+                    sent = self.sock.send(views[0], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            written += sent
+            while views and sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            if views and sent:
+                views[0] = views[0][sent:]
+        return written, views
+
+    def close(self):
+        with self.lock:
+            self.close_locked()
+
+    def close_locked(self):
+        self.closed = True
+        self.buffers.clear()
+        self.queued_bytes = 0
+        self.ready.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {'queued_buffers': len(self.buffers),
+                    'queued_bytes': self.queued_bytes,
+                    'peak_queued_bytes': self.peak_queued_bytes,
+                    'frames_queued': self.frames_queued,
+                    'bytes_sent': self.bytes_sent,
+                    'writes': self.writes}
@@ -0,0 +1,132 @@
+# License: MIT
+
+# Running a websocket server as several processes. However fast the engine, one
+# Python process only ever runs Python code on one core at a time (the GIL), so
+# beyond a certain number of clients a single process can't keep up. A
+# Supervisor forks a number of worker processes which each run a server of their
+# own, all listening on the same port: created with reuse_port=True, every
+# worker's server sets SO_REUSEPORT on its listening socket, and the kernel then
+# shares out new connections between them. The supervisor itself just waits,
+# starting a replacement for any worker that dies, and stops them all when it is
+# stopped.
+
+# Workers share nothing but the port, so anything that needs to know about
+# clients on other workers (e.g. pairing up participants who landed on different
+# workers) has to be coordinated some other way - see worker_server.py in the
+# dyadic interaction server for an example. Forking needs a Unix-like system, and
+# SO_REUSEPORT only shares connections out evenly on Linux.
+
+import os
+import time
+import signal
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Workers dying faster than this (seconds after starting) aren't restarted, since
+# something is wrong with them rather than with a client
+MIN_WORKER_LIFETIME = 5
+
+
+def stop_worker(signum, frame):
+    # SIGTERM in a worker stops its server just as Ctrl-C would stop a server
+    # run on its own (run_forever() returns), so that it can finish up
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+class Supervisor(object):
+    """
+    Forks workers and keeps them running.
+
+    Args:
+        workers(int): Number of worker processes.
+        worker_main: Function run in each worker as worker_main(index,
+            generation), where index counts from 0 to workers - 1 and
+            generation is 0 at first, going up by one every time that worker is
+            restarted; the worker exits when it returns. It should create its
+            server with reuse_port=True, and a ClientRegistry giving out client
+            ids that don't clash with other workers' (or its own previous
+            generations').
+        restart(bool): Start a replacement for a worker that dies.
+
+    Typical use:
+        def worker_main(index, generation):
+            server = AsyncWebsocketServer(PORT, '0.0.0.0', reuse_port=True)
+            server.registry = ClientRegistry(id_start=index + WORKERS * 10**6 * generation,
+                                             id_step=WORKERS)
+            ...
+            server.run_forever()
+        Supervisor(WORKERS, worker_main).run()
+    """
+
+    def __init__(self, workers, worker_main, restart=True):
+        self.workers = workers
+        self.worker_main = worker_main
+        self.restart = restart
+        self.pids = {}  # pid -> (index, time started)
+        self.generations = {}  # index -> generation of the worker last started
+        self.stopping = False
+
+    def start(self):
+        # Forks the workers, then returns (in the supervisor)
+        for index in range(self.workers):
+            self.start_worker(index)
+
+    def start_worker(self, index):
+        generation = self.generations[index] = self.generations.get(index, -1) + 1
+        pid = os.fork()
+        if pid == 0:
+            # in the worker: run worker_main, and never return into the supervisor's code
+            code = 0
+            try:
+                # Ctrl-C reaches the workers too, but they leave it to the supervisor
+                # to stop them, so that they are stopped once, in an orderly way
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, stop_worker)
+                self.worker_main(index, generation)
+            except BaseException:
+                logger.exception('Worker %d failed', index)
+                code = 1
+            finally:
+                os._exit(code)
+        self.pids[pid] = (index, time.time())
+        logger.info('Started worker %d (pid %d)', index, pid)
+
+    def wait(self):
+        # Waits for the workers, restarting any that die, until they have all
+        # exited or stop() is called
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            if pid not in self.pids:
+                continue
+            index, started = self.pids.pop(pid)
+            if self.stopping:
+                continue
+            logger.warning('Worker %d (pid %d) exited with status %d', index, pid, status)
+            if self.restart and time.time() - started >= MIN_WORKER_LIFETIME:
+                self.start_worker(index)
+
+    def stop(self):
+        # Asks the workers to finish (SIGTERM); safe to call from a signal handler
+        self.stopping = True
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        # Starts the workers and waits for them, stopping them on Ctrl-C or SIGTERM
+        self.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        try:
+            self.wait()
+        except KeyboardInterrupt:
+            self.stop()
+            self.wait()
@@ -2,10 +2,13 @@
 # License: MIT
 
 import sys
+import time
 import struct
 from base64 import b64encode
 from hashlib import sha1
 import logging
+import threading
+import socket
 from socket import error as SocketError
 import errno
 
@@ -14,6 +17,16 @@ if sys.version_info[0] < 3:
 else:
     from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
 
+from .permessage_deflate import PerMessageDeflate
+from .send_queue import SendQueue
+from .heartbeat import Heartbeat
+
+# NumPy is optional - if it is installed, large payloads are unmasked with it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 
@@ -34,6 +47,7 @@ logging.basicConfig()
 '''
 
 FIN    = 0x80
+RSV1   = 0x40
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
@@ -47,6 +61,26 @@ OPCODE_CLOSE_CONN   = 0x8
 OPCODE_PING         = 0x9
 OPCODE_PONG         = 0xA
 
+CONTROL_OPCODES = (OPCODE_CLOSE_CONN, OPCODE_PING, OPCODE_PONG)
+DATA_OPCODES    = (OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY)
+
+# Incoming messages (after reassembling fragments) longer than this are refused
+# and the connection closed
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# Outgoing messages longer than this are sent as several fragments of at most
+# this size; None sends every message as a single frame
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024
+# A client that falls this far behind reading what we send it is disconnected
+DEFAULT_MAX_QUEUED_BYTES = 4 * 1024 * 1024
+# Seconds to wait for the answer to a ping before closing the connection
+DEFAULT_PING_TIMEOUT = 10
+# Size of each connection's receive buffer (see FrameParser). It grows to fit a
+# larger frame while that frame arrives, then goes back to this size
+RECEIVE_BUFFER_SIZE = 16 * 1024
+# A client whose handshake is longer than this, or has more lines than this, is disconnected
+MAX_HANDSHAKE_SIZE = 16 * 1024
+MAX_HANDSHAKE_LINES = 100
+
 
 # -------------------------------- API ---------------------------------
 
@@ -72,6 +106,9 @@ class API():
     def message_received(self, client, server, message):
         pass
 
+    def binary_message_received(self, client, server, message):
+        pass
+
     def set_fn_new_client(self, fn):
         self.new_client = fn
 
@@ -81,51 +118,59 @@ class API():
     def set_fn_message_received(self, fn):
         self.message_received = fn
 
+    def set_fn_binary_message_received(self, fn):
+        self.binary_message_received = fn
+
     def send_message(self, client, msg):
         self._unicast_(client, msg)
 
+    def send_binary_message(self, client, msg):
+        client['handler'].send_binary(msg)
+
+    def send_prepared_message(self, client, prepared):
+        client['handler'].send_prepared(prepared)
+
     def send_message_to_all(self, msg):
         self._multicast_(msg)
 
 
 # ------------------------- Implementation -----------------------------
 
-class WebsocketServer(ThreadingMixIn, TCPServer, API):
+class WebsocketServerBase(API):
     """
-	A websocket server waiting for clients to connect.
-
-    Args:
-        port(int): Port to bind to
-        host(str): Hostname or IP to listen for connections. By default 127.0.0.1
-            is being used. To accept connections from any client, you should use
-            0.0.0.0.
-        loglevel: Logging level from logging module to use for logging. By default
-            warnings and errors are being logged.
-
-    Properties:
-        clients(list): A list of connected clients. A client is a dictionary
-            like below.
-                {
-                 'id'      : id,
-                 'handler' : handler,
-                 'address' : (addr, port)
-                }
+    Client bookkeeping shared by the threaded WebsocketServer and the asyncio
+    AsyncWebsocketServer: handlers call the _underscore_ methods below when
+    something happens on their connection, and these pass the event on to the
+    functions registered through the API.
     """
 
-    allow_reuse_address = True
-    daemon_threads = True  # comment to keep threads alive until finished
-
-    clients = []
-    id_counter = 0
-
-    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING):
-        logger.setLevel(loglevel)
-        TCPServer.__init__(self, (host, port), WebSocketHandler)
-        self.port = self.socket.getsockname()[1]
+    max_message_size = DEFAULT_MAX_MESSAGE_SIZE
+    max_frame_size = DEFAULT_MAX_FRAME_SIZE
+    max_queued_bytes = DEFAULT_MAX_QUEUED_BYTES
+    compression = None
+    # pings idle connections and closes dead ones, if a ping_interval was given
+    heartbeat = None
+    # number of clients disconnected for not keeping up with what we send them
+    backpressure_disconnects = 0
+    # subprotocols we can speak, most preferred first (see negotiate_subprotocol)
+    subprotocols = ()
+
+    @property
+    def clients(self):
+        # A snapshot, kept for backwards compatibility - look clients up through
+        # the registry rather than searching this list
+        return self.registry.clients()
+
+    @property
+    def id_counter(self):
+        return self.registry.id_counter
 
     def _message_received_(self, handler, msg):
         self.message_received(self.handler_to_client(handler), self, msg)
 
+    def _binary_message_received_(self, handler, msg):
+        self.binary_message_received(self.handler_to_client(handler), self, msg)
+
     def _ping_received_(self, handler, msg):
         handler.send_pong(msg)
 
@@ -133,20 +178,17 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         pass
 
     def _new_client_(self, handler):
-        self.id_counter += 1
-        client = {
-            'id': self.id_counter,
-            'handler': handler,
-            'address': handler.client_address
-        }
-        self.clients.append(client)
+        client = self.registry.add(handler)
+        if self.heartbeat is not None:
+            self.heartbeat.add(handler)
         self.new_client(client, self)
 
     def _client_left_(self, handler):
         client = self.handler_to_client(handler)
+        if client is None:  # never completed the handshake
+            return
         self.client_left(client, self)
-        if client in self.clients:
-            self.clients.remove(client)
+        self.registry.remove(handler)
 
     def _unicast_(self, to_client, msg):
         to_client['handler'].send_message(msg)
@@ -156,91 +198,275 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             self._unicast_(client, msg)
 
     def handler_to_client(self, handler):
+        return self.registry.by_handler.get(handler)
+
+    def send_queue_stats(self):
+        """
+        Summary of the outbound queues of all connected clients: how much is
+        waiting to be sent now (in total and for the worst client), and the
+        deepest any one queue has been.
+        """
+        stats = {'connections': 0, 'queued_bytes': 0, 'max_queued_bytes': 0,
+                 'peak_queued_bytes': 0, 'bytes_sent': 0,
+                 'backpressure_disconnects': self.backpressure_disconnects}
         for client in self.clients:
-            if client['handler'] == handler:
-                return client
+            queue_stats = client.handler.send_queue_stats()
+            stats['connections'] += 1
+            stats['queued_bytes'] += queue_stats['queued_bytes']
+            stats['max_queued_bytes'] = max(stats['max_queued_bytes'], queue_stats['queued_bytes'])
+            stats['peak_queued_bytes'] = max(stats['peak_queued_bytes'], queue_stats['peak_queued_bytes'])
+            stats['bytes_sent'] += queue_stats['bytes_sent']
+        return stats
 
+    def client_by_id(self, client_id):
+        return self.registry.by_id.get(client_id)
 
-class WebSocketHandler(StreamRequestHandler):
 
-    def __init__(self, socket, addr, server):
-        self.server = server
-        StreamRequestHandler.__init__(self, socket, addr, server)
+class Client(object):
+    """
+    A connected client. Clients used to be plain dictionaries, so for backwards
+    compatibility the fields can still be read as client['id'], client['handler']
+    etc as well as client.id etc. __slots__ keeps each record small when there
+    are thousands of them.
+    """
 
-    def setup(self):
-        StreamRequestHandler.setup(self)
-        self.keep_alive = True
-        self.handshake_done = False
-        self.valid_client = False
+    __slots__ = ('id', 'handler', 'address', 'path')
 
-    def handle(self):
-        while self.keep_alive:
-            if not self.handshake_done:
-                self.handshake()
-            elif self.valid_client:
-                self.read_next_message()
+    def __init__(self, id, handler, address, path='/'):
+        self.id = id
+        self.handler = handler
+        self.address = address
+        self.path = path
 
-    def read_bytes(self, num):
-        # python3 gives ordinal of byte directly
-        bytes = self.rfile.read(num)
-        if sys.version_info[0] < 3:
-            return map(ord, bytes)
-        else:
-            return bytes
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
 
-    def read_next_message(self):
-        try:
-            b1, b2 = self.read_bytes(2)
-        except SocketError as e:  # to be replaced with ConnectionResetError for py3
-            if e.errno == errno.ECONNRESET:
-                logger.info("Client closed connection.")
-                self.keep_alive = 0
-                return
-            b1, b2 = 0, 0
-        except ValueError as e:
-            b1, b2 = 0, 0
+    def __contains__(self, key):
+        return key in self.__slots__
 
-        fin    = b1 & FIN
-        opcode = b1 & OPCODE
-        masked = b2 & MASKED
-        payload_length = b2 & PAYLOAD_LEN
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
 
-        if opcode == OPCODE_CLOSE_CONN:
-            logger.info("Client asked to close connection.")
-            self.keep_alive = 0
-            return
+    def keys(self):
+        return list(self.__slots__)
+
+    def __repr__(self):
+        return 'Client(id=%d, address=%r)' % (self.id, self.address)
+
+
+class ClientRegistry(object):
+    """
+    Index of connected clients by handler and by id, so that finding the client
+    a message came from and removing a client that disconnects take constant
+    time however many clients are connected. Handler threads add and remove
+    clients concurrently, so changes are made under a lock.
+
+    Ids count up from id_start + id_step in steps of id_step, so that several
+    server processes (see supervisor.py) can give out ids that never clash:
+    worker i of n uses id_start=i, id_step=n.
+    """
+
+    def __init__(self, id_start=0, id_step=1):
+        self.lock = threading.Lock()
+        self.id_counter = id_start
+        self.id_step = id_step
+        self.by_id = {}
+        self.by_handler = {}
+
+    def add(self, handler, client_id=None):
+        # client_id is given for a client handed over by another process, which
+        # keeps the id it was given there
+        with self.lock:
+            if client_id is None:
+                self.id_counter += self.id_step
+                client_id = self.id_counter
+            client = Client(client_id, handler, handler.client_address, handler.path)
+            self.by_id[client.id] = client
+            self.by_handler[handler] = client
+        return client
+
+    def remove(self, handler):
+        with self.lock:
+            client = self.by_handler.pop(handler, None)
+            if client is not None:
+                del self.by_id[client.id]
+        return client
+
+    def clients(self):
+        # dicts keep insertion order, so this lists clients in order of arrival
+        with self.lock:
+            return list(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class WebsocketServer(ThreadingMixIn, TCPServer, WebsocketServerBase):
+    """
+	A websocket server waiting for clients to connect.
+
+    Args:
+        port(int): Port to bind to
+        host(str): Hostname or IP to listen for connections. By default 127.0.0.1
+            is being used. To accept connections from any client, you should use
+            0.0.0.0.
+        loglevel: Logging level from logging module to use for logging. By default
+            warnings and errors are being logged.
+        max_message_size(int): Largest message (in bytes, after reassembling
+            fragments) accepted from a client.
+        max_frame_size(int): Outgoing messages longer than this are fragmented
+            into frames of at most this many bytes. None to never fragment.
+        max_queued_bytes(int): Clients with more than this many bytes waiting
+            to be sent to them are disconnected.
+        compression: A PerMessageDeflate with the settings for compressing
+            messages to clients that support it, True to use the default
+            settings, or None (the default) to never compress.
+        ping_interval(float): Ping clients we haven't heard from for this many
+            seconds, and close the connection if they don't answer within
+            ping_timeout seconds (see heartbeat.py). None (the default) never
+            pings.
+        ping_timeout(float): Seconds to wait for the answer to a ping.
+        reuse_port(bool): Let several processes listen on the same port
+            (SO_REUSEPORT), with the kernel sharing out new connections
+            between them - see supervisor.py.
+        subprotocols(list): Names of subprotocols (Sec-WebSocket-Protocol)
+            the server can speak, most preferred first. Each client gets the
+            first one it offers, if any, as handler.subprotocol.
+
+    Properties:
+        clients(list): A list of connected clients. A client is a Client
+            record which can be read like the dictionary below.
+                {
+                 'id'      : id,
+                 'handler' : handler,
+                 'address' : (addr, port),
+                 'path'    : path the client connected to, e.g. '/'
+                }
+        registry(ClientRegistry): Connected clients indexed by handler and id.
+        heartbeat(Heartbeat): Pings idle clients, if ping_interval was given.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True  # comment to keep threads alive until finished
+
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING,
+                 max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE,
+                 max_queued_bytes=DEFAULT_MAX_QUEUED_BYTES, compression=None,
+                 ping_interval=None, ping_timeout=DEFAULT_PING_TIMEOUT, reuse_port=False,
+                 subprotocols=None):
+        logger.setLevel(loglevel)
+        self.registry = ClientRegistry()
+        self.max_message_size = max_message_size
+        self.max_frame_size = max_frame_size
+        self.max_queued_bytes = max_queued_bytes
+        self.compression = PerMessageDeflate() if compression is True else compression
+        if ping_interval is not None:
+            self.heartbeat = Heartbeat(ping_interval, ping_timeout)
+        self.subprotocols = tuple(subprotocols or ())
+        self.allow_reuse_port = reuse_port
+        TCPServer.__init__(self, (host, port), WebSocketHandler)
+        self.port = self.socket.getsockname()[1]
+
+
+class FrameHandlingMixin(object):
+    """
+    The parts of a websocket connection that don't depend on how bytes get to
+    and from the socket, shared by WebSocketHandler and AsyncWebSocketHandler:
+    checking incoming frames, reassembling fragmented messages, and splitting
+    outgoing messages into frames. Handlers using this need server and
+    send_lock attributes and a _write_frames_ method, which must not block;
+    _flush_ is called after it, outside the lock, and may.
+    """
+
+    # opcode of the fragmented message being reassembled, its data so far, and
+    # whether it is compressed
+    fragment_opcode = None
+    fragments = None
+    fragments_compressed = False
+    # compression context, if permessage-deflate was negotiated in the handshake
+    deflate = None
+    # when we last heard from the client, and when we pinged them if we are
+    # waiting for an answer (time.monotonic() times, see heartbeat.py)
+    last_activity = 0.0
+    ping_sent = None
+    # the path the client asked for in the handshake, e.g. /ws1/
+    path = '/'
+    # the subprotocol agreed in the handshake, if any
+    subprotocol = None
+
+    def accept_frame(self, fin, rsv1, opcode, masked, payload_length):
+        """
+        Called (by FrameParser) once a frame header has been read, before its
+        payload. Returns False if the frame breaks the protocol or would make
+        the message too long, in which case the connection should be closed.
+        """
         if not masked:
-            logger.warn("Client must always be masked.")
-            self.keep_alive = 0
-            return
+            logger.warning("Client must always be masked.")
+            return False
+        if opcode not in DATA_OPCODES and opcode not in CONTROL_OPCODES:
+            logger.warning("Unknown opcode %#x." % opcode)
+            return False
+        # RSV1 marks a compressed message, so is only allowed on the first frame
+        # of a data message and only if compression was agreed
+        if rsv1 and (self.deflate is None or opcode in CONTROL_OPCODES or opcode == OPCODE_CONTINUATION):
+            logger.warning("Unexpected RSV1 bit.")
+            return False
+        if opcode in CONTROL_OPCODES:
+            if not fin or payload_length > 125:
+                logger.warning("Control frames must be unfragmented and at most 125 bytes.")
+                return False
+            return True
         if opcode == OPCODE_CONTINUATION:
-            logger.warn("Continuation frames are not supported.")
-            return
-        elif opcode == OPCODE_BINARY:
-            logger.warn("Binary frames are not supported.")
-            return
-        elif opcode == OPCODE_TEXT:
-            opcode_handler = self.server._message_received_
-        elif opcode == OPCODE_PING:
-            opcode_handler = self.server._ping_received_
-        elif opcode == OPCODE_PONG:
-            opcode_handler = self.server._pong_received_
+            if self.fragment_opcode is None:
+                logger.warning("Continuation frame received with no message to continue.")
+                return False
+            message_length = len(self.fragments) + payload_length
         else:
-            logger.warn("Unknown opcode %#x." % opcode)
-            self.keep_alive = 0
-            return
-
-        if payload_length == 126:
-            payload_length = struct.unpack(">H", self.rfile.read(2))[0]
-        elif payload_length == 127:
-            payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
+            if self.fragment_opcode is not None:
+                logger.warning("New message started before the previous one was finished.")
+                return False
+            message_length = payload_length
+        if message_length > self.server.max_message_size:
+            logger.warning("Message longer than %d bytes refused." % self.server.max_message_size)
+            return False
+        return True
 
-        masks = self.read_bytes(4)
-        message_bytes = bytearray()
-        for message_byte in self.read_bytes(payload_length):
-            message_byte ^= masks[len(message_bytes) % 4]
-            message_bytes.append(message_byte)
-        opcode_handler(self, message_bytes.decode('utf8'))
+    def handle_frame(self, fin, rsv1, opcode, payload):
+        self.last_activity = time.monotonic()
+        # Control frames may arrive in the middle of a fragmented message
+        if opcode == OPCODE_PING:
+            self.server._ping_received_(self, payload.decode('utf8'))
+        elif opcode == OPCODE_PONG:
+            self.server._pong_received_(self, payload.decode('utf8'))
+        elif opcode == OPCODE_CONTINUATION:
+            self.fragments.extend(payload)
+            if fin:
+                opcode, message_bytes = self.fragment_opcode, self.fragments
+                self.fragment_opcode, self.fragments = None, None
+                self.handle_message(opcode, message_bytes, self.fragments_compressed)
+        elif fin:
+            self.handle_message(opcode, payload, rsv1)
+        else:
+            # First fragment of a message, the rest follow as continuation frames
+            self.fragment_opcode, self.fragments = opcode, bytearray(payload)
+            self.fragments_compressed = rsv1
+
+    def handle_message(self, opcode, message_bytes, compressed=False):
+        if compressed:
+            message_bytes = self.deflate.decompress(message_bytes, self.server.max_message_size)
+            if message_bytes is None:
+                logger.warning("Message longer than %d bytes refused." % self.server.max_message_size)
+                self.keep_alive = 0
+                return
+        if opcode == OPCODE_TEXT:
+            self.server._message_received_(self, message_bytes.decode('utf8'))
+        else:
+            self.server._binary_message_received_(self, bytes(message_bytes))
 
     def send_message(self, message):
         self.send_text(message)
@@ -248,10 +474,14 @@ class WebSocketHandler(StreamRequestHandler):
     def send_pong(self, message):
         self.send_text(message, OPCODE_PONG)
 
+    def send_ping(self):
+        # Called from the heartbeat thread, so mustn't block
+        self.send_payload(OPCODE_PING, b'')
+
     def send_text(self, message, opcode=OPCODE_TEXT):
         """
-        Important: Fragmented(=continuation) messages are not supported since
-        their usage cases are limited - when we don't know the payload length.
+        Messages longer than the server's max_frame_size are sent fragmented,
+        as a sequence of frames of at most that size.
         """
 
         # Validate message
@@ -268,45 +498,214 @@ class WebSocketHandler(StreamRequestHandler):
             logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
             return False
 
-        header  = bytearray()
-        payload = encode_to_UTF8(message)
+        self.send_payload(opcode, encode_to_UTF8(message))
+
+    def send_binary(self, data):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            logger.warning('Can\'t send binary message, data has to be bytes-like. Given type is %s' % type(data))
+            return False
+        self.send_payload(OPCODE_BINARY, data)
+
+    def send_prepared(self, prepared):
+        # A PreparedMessage is only framed once for all the clients who get it
+        # uncompressed; it still has to be compressed for each client who
+        # agreed to compression, as their compressors are all in different states
+        with self.send_lock:
+            if self.deflate is not None and self.deflate.should_compress(prepared.payload):
+                frames = self.make_frames(prepared.opcode, self.deflate.compress(prepared.payload), True)
+            else:
+                frames = prepared.frames_for(self)
+            self._write_frames_(frames)
+        self._flush_()
+
+    def send_payload(self, opcode, payload):
+        # With context takeover, messages have to reach the socket in the order
+        # they went through the compressor, so compressing and writing happen
+        # together under the lock
+        with self.send_lock:
+            compressed = (self.deflate is not None and opcode not in CONTROL_OPCODES
+                          and self.deflate.should_compress(payload))
+            if compressed:
+                payload = self.deflate.compress(payload)
+            self._write_frames_(self.make_frames(opcode, payload, compressed))
+        self._flush_()
+
+    def _flush_(self):
+        pass
+
+    def make_frames(self, opcode, payload, compressed=False):
+        """
+        Returns a list of (header, payload chunk) pairs. Chunks are memoryview
+        slices of payload, so fragmenting a large message never copies it.
+        """
         payload_length = len(payload)
+        frame_size = self.server.max_frame_size
+        if not frame_size or payload_length <= frame_size or opcode in CONTROL_OPCODES:
+            return [(make_frame_header(opcode, payload_length, rsv1=compressed), payload)]
+        view = memoryview(payload)
+        frames = []
+        for start in range(0, payload_length, frame_size):
+            chunk = view[start:start + frame_size]
+            fin = start + frame_size >= payload_length
+            if start == 0:
+                header = make_frame_header(opcode, len(chunk), fin, rsv1=compressed)
+            else:
+                header = make_frame_header(OPCODE_CONTINUATION, len(chunk), fin)
+            frames.append((header, chunk))
+        return frames
+
+    def negotiate_extensions(self, headers):
+        """
+        Sets up permessage-deflate if both the server and the client want it.
+        Returns the value for our Sec-WebSocket-Extensions header, or None.
+        """
+        if self.server.compression is None or 'sec-websocket-extensions' not in headers:
+            return None
+        self.deflate, response = self.server.compression.negotiate(headers['sec-websocket-extensions'])
+        return response
+
+    def negotiate_subprotocol(self, headers):
+        """
+        Picks the first of the server's subprotocols that the client offered,
+        if any. Returns the value for our Sec-WebSocket-Protocol header, or
+        None, in which case the client gets plain messages as usual.
+        """
+        if not self.server.subprotocols or 'sec-websocket-protocol' not in headers:
+            return None
+        offered = [p.strip() for p in headers['sec-websocket-protocol'].split(',')]
+        for subprotocol in self.server.subprotocols:
+            if subprotocol in offered:
+                self.subprotocol = subprotocol
+                return subprotocol
+        return None
 
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
 
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
+class WebSocketHandler(FrameHandlingMixin, StreamRequestHandler):
 
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
+    def __init__(self, socket, addr, server):
+        self.server = server
+        StreamRequestHandler.__init__(self, socket, addr, server)
 
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
+    def setup(self):
+        StreamRequestHandler.setup(self)
+        self.send_lock = threading.Lock()
+        self.send_queue = SendQueue(self.request, self.server.max_queued_bytes)
+        # frames are written by this connection's own thread, so sending to a
+        # client that has stopped reading never holds up the thread sending
+        self.writer = threading.Thread(target=self.send_queue.write_forever, daemon=True)
+        self.writer.start()
+        self.parser = FrameParser(self.accept_frame)
+        self.keep_alive = True
+        self.handshake_done = False
+        self.valid_client = False
+
+    def handle(self):
+        while self.keep_alive:
+            if not self.handshake_done:
+                self.handshake()
+            elif self.valid_client:
+                self.read_next_message()
+
+    def receive(self):
+        # Reads whatever the client has sent (at least a byte) into the receive
+        # buffer. Returns False if the connection has closed (or close_connection
+        # shut it)
+        try:
+            received = self.request.recv_into(self.parser.receive_buffer())
+        except SocketError as e:  # to be replaced with ConnectionResetError for py3
+            if e.errno == errno.ECONNRESET:
+                logger.info("Client closed connection.")
+            else:
+                logger.info("Connection closed: %s" % e)
+            self.keep_alive = 0
+            return False
+        if not received:
+            # the connection has closed (or close_connection shut it)
+            logger.info("Connection closed.")
+            self.keep_alive = 0
+            return False
+        self.parser.received(received)
+        return True
+
+    def read_next_message(self):
+        # Handles the next frame, reading from the socket only if it hasn't all
+        # arrived yet - several small frames often come in one read
+        try:
+            frame = self.parser.next_frame()
+            while frame is None:
+                if not self.receive():
+                    return
+                frame = self.parser.next_frame()
+        except FrameError:
+            self.keep_alive = 0
             return
 
-        self.request.send(header + payload)
+        fin, rsv1, opcode, payload = frame
+        if opcode == OPCODE_CLOSE_CONN:
+            logger.info("Client asked to close connection.")
+            self.keep_alive = 0
+            return
+        self.handle_frame(fin, rsv1, opcode, payload)
+
+    def _write_frames_(self, frames):
+        if not self.send_queue.put(frames):
+            logger.warning("Client not keeping up with messages sent to it, disconnecting.")
+            self.server.backpressure_disconnects += 1
+            self.close_connection()
+
+    def send_ping(self):
+        # The ping is written straight away if the socket has room for it and
+        # nothing else is waiting, otherwise left to the writer thread - if that
+        # takes too long, the ping times out and the connection is closed, which
+        # is what we want for a client that has stuck
+        frame = bytes(make_frame_header(OPCODE_PING, 0))
+        if not self.send_queue.send_now(frame):
+            self.send_queue.put([(frame, b'')])
+
+    def close_connection(self):
+        # Called from other threads: shutting the socket down makes the read
+        # this connection's thread is blocked in fail, and it then finishes up
+        self.keep_alive = 0
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except (SocketError, OSError):
+            pass
+
+    def send_queue_stats(self):
+        return self.send_queue.stats()
 
     def read_http_headers(self):
+        # The handshake is read into the same buffer as the frames after it, so
+        # any frames the client sends straight after it aren't lost
+        request = self.parser.take_until(b'\r\n\r\n')
+        while request is None:
+            if len(self.parser) > MAX_HANDSHAKE_SIZE:
+                logger.warning("Handshake longer than %d bytes refused." % MAX_HANDSHAKE_SIZE)
+                return {}
+            if not self.receive():
+                return {}
+            request = self.parser.take_until(b'\r\n\r\n')
+        lines = request.decode().split('\r\n')
+        if len(lines) > MAX_HANDSHAKE_LINES:
+            logger.warning("Handshake of more than %d lines refused." % MAX_HANDSHAKE_LINES)
+            return {}
         headers = {}
         # first line should be HTTP GET
-        http_get = self.rfile.readline().decode().strip()
+        http_get = lines[0].strip()
         assert http_get.upper().startswith('GET')
+        self.path = request_path(http_get)
         # remaining should be headers
-        while True:
-            header = self.rfile.readline().decode().strip()
+        for header in lines[1:]:
+            header = header.strip()
             if not header:
                 break
             head, value = header.split(':', 1)
-            headers[head.lower().strip()] = value.strip()
+            head = head.lower().strip()
+            # a header sent several times is equivalent to one comma-separated list
+            if head in headers:
+                headers[head] += ', ' + value.strip()
+            else:
+                headers[head] = value.strip()
         return headers
 
     def handshake(self):
@@ -314,7 +713,7 @@ class WebSocketHandler(StreamRequestHandler):
 
         try:
             assert headers['upgrade'].lower() == 'websocket'
-        except AssertionError:
+        except (AssertionError, KeyError):
             self.keep_alive = False
             return
 
@@ -325,19 +724,24 @@ class WebSocketHandler(StreamRequestHandler):
             self.keep_alive = False
             return
 
-        response = self.make_handshake_response(key)
+        response = self.make_handshake_response(key, self.negotiate_extensions(headers),
+                                                self.negotiate_subprotocol(headers))
         self.handshake_done = self.request.send(response.encode())
         self.valid_client = True
         self.server._new_client_(self)
 
     @classmethod
-    def make_handshake_response(cls, key):
-        return \
+    def make_handshake_response(cls, key, extensions=None, subprotocol=None):
+        response = \
           'HTTP/1.1 101 Switching Protocols\r\n'\
           'Upgrade: websocket\r\n'              \
           'Connection: Upgrade\r\n'             \
-          'Sec-WebSocket-Accept: %s\r\n'        \
-          '\r\n' % cls.calculate_response_key(key)
+          'Sec-WebSocket-Accept: %s\r\n' % cls.calculate_response_key(key)
+        if extensions:
+            response += 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+        if subprotocol:
+            response += 'Sec-WebSocket-Protocol: %s\r\n' % subprotocol
+        return response + '\r\n'
 
     @classmethod
     def calculate_response_key(cls, key):
@@ -347,9 +751,282 @@ class WebSocketHandler(StreamRequestHandler):
         return response_key.decode('ASCII')
 
     def finish(self):
+        self.send_queue.close()
+        self.writer.join(1.0)
         self.server._client_left_(self)
 
 
+class PreparedMessage(object):
+    """
+    A message encoded once, to be sent to many clients (or one client many
+    times) with server.send_prepared_message(): for every client that gets it
+    uncompressed, it is also only split into frames once. message is text
+    (str, or bytes already encoded as UTF-8, which isn't checked) or, if
+    binary is True, bytes.
+    """
+
+    __slots__ = ('opcode', 'payload', 'frames', 'max_frame_size')
+
+    def __init__(self, message, binary=False):
+        self.opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+        if not binary and not isinstance(message, bytes):
+            message = message.encode('utf-8')
+        self.payload = message
+        self.frames = None
+        self.max_frame_size = None
+
+    def frames_for(self, handler):
+        # The frames are never changed once made, so the same list can be queued
+        # for any number of connections at once
+        max_frame_size = handler.server.max_frame_size
+        if self.frames is None or self.max_frame_size != max_frame_size:
+            self.frames = handler.make_frames(self.opcode, self.payload)
+            self.max_frame_size = max_frame_size
+        return self.frames
+
+
+def request_path(request_line):
+    # 'GET /ws1/?x=1 HTTP/1.1' -> '/ws1/?x=1'
+    parts = request_line.split()
+    return parts[1] if len(parts) > 1 else '/'
+
+
+def make_frame_header(opcode, payload_length, fin=True, rsv1=False):
+    """
+    Builds the header of an unmasked (server to client) frame carrying
+    payload_length bytes. fin is False for all but the last frame of a
+    fragmented message, rsv1 is True for the first frame of a compressed one.
+    """
+    header = bytearray()
+    first_byte = (FIN if fin else 0) | (RSV1 if rsv1 else 0) | opcode
+
+    # Normal payload
+    if payload_length <= 125:
+        header.append(first_byte)
+        header.append(payload_length)
+
+    # Extended payload
+    elif payload_length >= 126 and payload_length <= 65535:
+        header.append(first_byte)
+        header.append(PAYLOAD_LEN_EXT16)
+        header.extend(struct.pack(">H", payload_length))
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        header.append(first_byte)
+        header.append(PAYLOAD_LEN_EXT64)
+        header.extend(struct.pack(">Q", payload_length))
+
+    else:
+        raise Exception("Message is too big. Consider breaking it into chunks.")
+
+    return header
+
+
+class FrameError(Exception):
+    """
+    Raised by FrameParser for a frame the handler refused.
+    """
+
+
+class FrameParser(object):
+    """
+    Splits the bytes received on a connection into frames, however they are
+    divided up as they arrive. Bytes go into one buffer, kept for the life of
+    the connection: either received straight into it
+
+        received = sock.recv_into(parser.receive_buffer())
+        parser.received(received)
+
+    or, for an engine given the data (e.g. by asyncio), copied into it with
+    parser.feed(data). parser.next_frame() then returns the next complete
+    frame, if there is one, as (fin, rsv1, opcode, payload) - so several
+    frames arriving together are handled without reading again. Headers are
+    read in place and payloads unmasked straight out of the buffer, so the
+    unmasked payload (a bytearray) is the only copy made of a frame.
+
+    Args:
+        accept_frame: Function called as accept_frame(fin, rsv1, opcode,
+            masked, payload_length) once each frame's header has arrived, before
+            its payload; if it returns False, next_frame() raises FrameError.
+            Frames larger than the buffer only make it grow once accepted.
+        buffer_size(int): Usual size of the buffer.
+    """
+
+    # the most header (2 bytes, then up to 8 of length and 4 of mask) there can be
+    MAX_HEADER_SIZE = 14
+
+    def __init__(self, accept_frame, buffer_size=RECEIVE_BUFFER_SIZE):
+        self.accept_frame = accept_frame
+        self.buffer_size = buffer_size
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # received data not yet taken out of the buffer is buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # (fin, rsv1, opcode, masked, payload length, header length) of the frame at
+        # start, once its header has arrived and been accepted
+        self.header = None
+
+    def __len__(self):
+        return self.end - self.start
+
+    def pending(self):
+        # A copy of what has been received but not yet taken out as frames
+        return bytes(self.view[self.start:self.end])
+
+    def make_room(self, size):
+        # Makes sure there is room for size more bytes after end, and for the
+        # whole of the frame being received
+        pending = self.end - self.start
+        if not pending:
+            self.start = self.end = 0
+            if len(self.buffer) > self.buffer_size:
+                # back to the usual size after a large frame
+                self.buffer = bytearray(self.buffer_size)
+                self.view = memoryview(self.buffer)
+        needed = pending + size
+        if self.header is not None:
+            needed = max(needed, self.header[5] + self.header[4])
+        if needed > len(self.buffer):
+            buffer = bytearray(max(needed, self.buffer_size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer, self.view = buffer, memoryview(buffer)
+            self.start, self.end = 0, pending
+        elif self.start + needed > len(self.buffer):
+            self.compact()
+
+    def compact(self):
+        # Moves what is left to the front (typically part of one small frame)
+        pending = self.end - self.start
+        self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start, self.end = 0, pending
+
+    def receive_buffer(self):
+        """
+        Space to receive data into, at least MAX_HEADER_SIZE bytes; call
+        received() with how many bytes were put there.
+        """
+        self.make_room(self.MAX_HEADER_SIZE)
+        if self.start and len(self.buffer) - self.end < len(self.buffer) // 4:
+            # not much room left, so make some to read more at once
+            self.compact()
+        return self.view[self.end:]
+
+    def received(self, size):
+        self.end += size
+
+    def feed(self, data):
+        size = len(data)
+        self.make_room(size)
+        self.buffer[self.end:self.end + size] = data
+        self.end += size
+
+    def take_until(self, delimiter):
+        """
+        Returns everything received up to and including delimiter, taking it
+        out of the buffer, or None if delimiter hasn't arrived yet - for the
+        HTTP handshake, which comes before any frames.
+        """
+        index = self.buffer.find(delimiter, self.start, self.end)
+        if index < 0:
+            return None
+        index += len(delimiter)
+        data = bytes(self.view[self.start:index])
+        self.start = index
+        return data
+
+    def next_frame(self):
+        """
+        Returns the next frame as (fin, rsv1, opcode, payload), or None if it
+        hasn't all arrived yet.
+        """
+        buffer, start = self.buffer, self.start
+        available = self.end - start
+        if self.header is not None:
+            # the header arrived earlier, and was accepted then
+            fin, rsv1, opcode, masked, payload_length, header_length = self.header
+        else:
+            if available < 2:
+                return None
+            b1 = buffer[start]
+            b2 = buffer[start + 1]
+            payload_length = b2 & PAYLOAD_LEN
+            header_length = 2
+            if payload_length == 126:
+                header_length = 4
+                if available < header_length:
+                    return None
+                payload_length = struct.unpack_from(">H", buffer, start + 2)[0]
+            elif payload_length == 127:
+                header_length = 10
+                if available < header_length:
+                    return None
+                payload_length = struct.unpack_from(">Q", buffer, start + 2)[0]
+            masked = b2 & MASKED
+            if masked:
+                header_length += 4
+                if available < header_length:
+                    return None
+            fin, rsv1, opcode = b1 & FIN, b1 & RSV1, b1 & OPCODE
+            if not self.accept_frame(fin, rsv1, opcode, masked, payload_length):
+                raise FrameError()
+        payload_start = start + header_length
+        payload_end = payload_start + payload_length
+        if payload_end > self.end:
+            # still arriving - the header is kept so it is only checked once
+            self.header = (fin, rsv1, opcode, masked, payload_length, header_length)
+            return None
+        self.header = None
+        self.start = payload_end
+        if masked:
+            return fin, rsv1, opcode, unmask(self.view[payload_start:payload_end], buffer[payload_start - 4:payload_start])
+        return fin, rsv1, opcode, buffer[payload_start:payload_end]
+
+
+# Payloads at least this long are unmasked with NumPy, when it is available;
+# below this the fixed cost of setting up the arrays outweighs the gain
+NUMPY_UNMASK_THRESHOLD = 4096
+
+
+def unmask(payload, masks):
+    """
+    Undoes the client-to-server masking of a frame payload, i.e. XORs byte i
+    of the payload with byte i % 4 of the mask. Rather than looping over the
+    payload byte by byte in python this XORs the whole buffer in one go.
+    """
+    if sys.version_info[0] < 3:
+        return unmask_bytewise(payload, masks)
+    if numpy is not None and len(payload) >= NUMPY_UNMASK_THRESHOLD:
+        return unmask_numpy(payload, masks)
+    return unmask_int(payload, masks)
+
+
+def unmask_int(payload, masks):
+    # Repeat the 4-byte mask to the length of the payload, then treat payload
+    # and mask as two (very) big integers so a single XOR does all the work
+    length = len(payload)
+    mask_bytes = (bytes(masks) * (length // 4 + 1))[:length]
+    unmasked = int.from_bytes(payload, 'little') ^ int.from_bytes(mask_bytes, 'little')
+    return bytearray(unmasked.to_bytes(length, 'little'))
+
+
+def unmask_numpy(payload, masks):
+    length = len(payload)
+    data = numpy.frombuffer(payload, dtype=numpy.uint8)
+    mask_bytes = numpy.resize(numpy.frombuffer(bytes(masks), dtype=numpy.uint8), length)
+    return bytearray(numpy.bitwise_xor(data, mask_bytes).tobytes())
+
+
+def unmask_bytewise(payload, masks):
+    # The original implementation, kept as a fallback (and for comparison)
+    message_bytes = bytearray()
+    for message_byte in payload:
+        message_byte ^= masks[len(message_bytes) % 4]
+        message_bytes.append(message_byte)
+    return message_bytes
+
+
 def encode_to_UTF8(data):
     try:
         return data.encode('UTF-8')
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Running an experiment as several worker processes
+##############
+
+# However fast the websocket server, one Python process can only run Python code on
+# one core at a time. This runs an experiment (dyadic_interaction_server.py, unchanged)
+# as WORKERS processes instead, all accepting connections on the same port: the
+# Supervisor (see websocket_server/supervisor.py) forks the workers, and the kernel
+# shares new connections out between them.
+
+# Participants who land on different workers still need to be paired, so the workers
+# share one waiting room, kept by a MatchmakingCoordinator in a process of its own (see
+# matchmaking_coordinator.py). When it pairs two participants on different workers, one
+# of them is handed over to the other's worker - the connection itself is passed to the
+# other process, along with their entry in global_participant_data - so each dyad is
+# looked after by a single worker from then on, just as if it were the only process.
+# Likewise a participant who reconnects (see "Reconnecting" in the experiment) but
+# lands on a different worker from the one with their saved state is handed over to
+# that one.
+
+# Handing a connection over only works with AsyncWebsocketServer, and only if every
+# message the client compresses is compressed on its own (client_no_context_takeover),
+# which we ask clients for below. Forking and passing connections between processes
+# need Linux.
+
+
+##############
+##### Libraries
+##############
+
+from websocket_server import AsyncWebsocketServer, ClientRegistry, PerMessageDeflate
+from websocket_server.supervisor import Supervisor
+from matchmaking_coordinator import MatchmakingCoordinator, CoordinatorLink, CoordinatedMatchmaker
+from experiment_logging import setup_logging
+from state_journal import StateJournal
+from metrics import MetricsServer, add_server_metrics, render, COLLECT_TIMEOUT
+import importlib.util
+import tempfile
+import logging
+import os
+
+
+
+######################
+##### Globals
+######################
+
+# The experiment module, loaded before the workers are forked, so each worker has its
+# own copy
+experiment = None
+# This worker's index (0 to WORKERS-1), its server and its connection to the coordinator
+worker_index = None
+server = None
+link = None
+
+# Participant ID -> index of the worker looking after them, for every participant in a
+# dyad, kept up to date by the coordinator
+homes = {}
+
+# Clients being handed over to another worker: client ID -> where they are going, whether
+# they are joining a group there, and any messages from them that arrive in the meantime,
+# which are passed on with them
+handing_over = {}
+
+# Groups formed by the coordinator that this worker is to look after, while members are
+# handed over from other workers: client ID -> the group, for every member. A group is
+# {'clients':[client IDs], 'awaiting':set of clients still to arrive, 'lost':set of
+# clients who never will}
+pending_groups = {}
+
+# Clients handed over to other workers - counted in the experiment's metrics (see
+# worker_main), which each worker serves on a port of its own
+handovers = None
+
+logger = logging.getLogger('dyadic')
+
+
+
+######################
+##### Loading the experiment
+######################
+
+def load_experiment(filename):
+    name = os.path.splitext(os.path.basename(filename))[0]
+    spec = importlib.util.spec_from_file_location(name,filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# A StateJournal that also lets the coordinator know which participants this worker is
+# looking after: the journal holds the state of every participant in a dyad here, from
+# their first entry until it is removed
+class WorkerJournal(StateJournal):
+
+    def __init__(self, directory, link):
+        StateJournal.__init__(self, directory)
+        self.link = link
+        self.announced = set()
+
+    def restore(self):
+        state = StateJournal.restore(self)
+        for key in state:
+            self.announce(key)
+        return state
+
+    def record(self, key, value):
+        self.announce(key)
+        StateJournal.record(self, key, value)
+
+    def remove(self, key):
+        if key in self.announced:
+            self.announced.discard(key)
+            self.link.send({'op':'home','participant':key,'worker':None})
+        StateJournal.remove(self, key)
+
+    def announce(self, key):
+        if key not in self.announced:
+            self.announced.add(key)
+            self.link.send({'op':'home','participant':key,'worker':worker_index})
+
+
+
+######################
+##### Handling clients
+######################
+
+# Messages from clients go to the experiment as usual, except that a participant
+# reconnecting to this worker when another worker has their saved state is handed over
+# to that one, and messages from clients being handed over are kept to pass on
+def message_received(client, server, message):
+    client_id = client['id']
+    if client_id in handing_over:
+        handing_over[client_id]['messages'].append(message)
+        return
+    if (b'CLIENT_INFO' if isinstance(message,bytes) else 'CLIENT_INFO') in message:
+        response = experiment.encoder.decode(message,client)
+        home = homes.get(response.get('client_info'))
+        if response['response_type']=='CLIENT_INFO' and home is not None and home!=worker_index:
+            hand_over(client_id,home,[message])
+            return
+    experiment.message_received(client, server, message)
+
+def client_left(client, server):
+    handover_failed(client['id'])
+    experiment.client_left(client, server)
+
+
+
+######################
+##### Handing clients over to another worker
+######################
+
+# The steps alternate between the state actor (which looks after the experiment's state)
+# and the event loop (which looks after the connection):
+# 1. hand_over (state actor) notes that the client is going, then
+# 2. detach_client (event loop) stops serving the connection, once it is between
+#    messages, then
+# 3. send_client (state actor) takes the client out of the experiment and sends their
+#    connection and state to the other worker, via the coordinator
+# If the client can't be handed over (they left, or their connection never came free)
+# handover_failed puts things back as they were. (If they have too much to go in one
+# message to the coordinator, send_client takes their connection back first, and
+# handover_returned puts them back in the experiment.)
+def hand_over(client_id,to_worker,messages=(),group=False):
+    handing_over[client_id] = {'to':to_worker,'group':group,'messages':list(messages)}
+    server.loop.call_soon_threadsafe(detach_client,client_id,0)
+
+def detach_client(client_id,attempts):
+    client = server.client_by_id(client_id)
+    if client is None:
+        return  # they have left, and client_left will deal with it
+    detached = client['handler'].detach()
+    if detached is not None:
+        experiment.state_actor.submit(send_client,client_id,*detached)
+    elif client['handler'].keep_alive and attempts<DETACH_ATTEMPTS:
+        # part way through a message - try again shortly
+        server.loop.call_later(DETACH_RETRY_INTERVAL,detach_client,client_id,attempts+1)
+    else:
+        experiment.state_actor.submit(handover_failed,client_id)
+
+def send_client(client_id,fd,connection):
+    handover = handing_over[client_id]
+    state = experiment.export_client(client_id)
+    # binary messages (from clients using MessagePack) can't go in JSON as they are
+    messages = [{'binary':m.decode('latin-1')} if isinstance(m,bytes) else m for m in handover['messages']]
+    try:
+        link.send({'op':'hand_over','client_id':client_id,'to':handover['to'],
+                   'group':handover['group'],'state':state,'messages':messages,
+                   'connection':dict(connection,buffered=connection['buffered'].decode('latin-1'))},fd)
+    except ValueError:
+        # too much to hand over in one message: the client stays here after all, picking
+        # up their connection again as the other worker would have
+        logger.exception("Could not hand client %d over to worker %d", client_id, handover['to'],
+                         extra={'client_id':client_id})
+        server.adopt(fd,client_id,connection,
+                     lambda client: experiment.state_actor.submit(handover_returned,client,state))
+        return
+    except OSError:
+        os.close(fd)
+        raise
+    os.close(fd)
+    del handing_over[client_id]
+    logger.info("Handed client %d over to worker %d", client_id, handover['to'], extra={'client_id':client_id})
+    handovers.inc()
+
+# Called (on the state actor) when a client send_client couldn't hand over has their
+# connection back
+def handover_returned(client,state):
+    experiment.import_client(client,state)
+    handover = handing_over.get(client['id'])
+    handover_failed(client['id'])
+    if handover is not None and handover['group']:
+        # back into the waiting room, as the rest of their group will be
+        experiment.matchmaker.add(client['id'],worker_id=state.get('participantID'))
+
+def handover_failed(client_id):
+    handover = handing_over.pop(client_id,None)
+    if handover is None:
+        return
+    if handover['group']:
+        link.send({'op':'hand_over_failed','client_id':client_id,'to':handover['to']})
+    # whatever they sent in the meantime is dealt with here after all
+    client = server.client_by_id(client_id)
+    if client is not None:
+        for message in handover['messages']:
+            experiment.message_received(client, server, message)
+
+# Called (on the state actor) when a client handed over by another worker arrives
+def client_arrived(client,state,messages,group):
+    experiment.import_client(client,state)
+    logger.info("Client %d handed over from another worker", client['id'], extra={'client_id':client['id']})
+    for message in messages:
+        message_received(client, server, message)
+    if group:
+        member_arrived(client['id'],lost=False)
+
+
+
+######################
+##### Pairing
+######################
+
+# A group from the coordinator: if everyone is here, pair them straight away, otherwise
+# wait for the others to be handed over
+def start_group(client_ids):
+    experiment.matchmaker.grouped(client_ids)
+    group = {'clients':client_ids,'lost':set(),
+             'awaiting':set(c for c in client_ids if c not in experiment.global_participant_data)}
+    if not group['awaiting']:
+        pair_group(group)
+    else:
+        for client_id in client_ids:
+            pending_groups[client_id] = group
+
+def member_arrived(client_id,lost):
+    group = pending_groups.get(client_id)
+    if group is None:
+        return
+    group['awaiting'].discard(client_id)
+    if lost:
+        group['lost'].add(client_id)
+    if not group['awaiting']:
+        for c in group['clients']:
+            pending_groups.pop(c,None)
+        pair_group(group)
+
+# Pairs the group if they are all still waiting; anyone left when someone has gone goes
+# back into the waiting room
+def pair_group(group):
+    waiting = [c for c in group['clients'] if c not in group['lost'] and
+               experiment.global_participant_data.get(c,{}).get('phase')=='PairParticipants']
+    if len(waiting)==len(group['clients']):
+        experiment.pair_participants(*waiting)
+    else:
+        for client_id in waiting:
+            experiment.matchmaker.add(client_id,
+                                      worker_id=experiment.global_participant_data[client_id]['participantID'])
+
+# Asked by the coordinator to hand a client in the waiting room over to another worker
+def hand_over_waiting_client(client_id,to_worker):
+    data = experiment.global_participant_data.get(client_id)
+    if data is None or data.get('phase')!='PairParticipants':
+        link.send({'op':'hand_over_failed','client_id':client_id,'to':to_worker})
+    else:
+        hand_over(client_id,to_worker,group=True)
+
+
+
+######################
+##### Messages from the coordinator
+######################
+
+# Called on the coordinator link's own thread: anything touching the experiment's state is
+# passed to the state actor, and connections being handed over to us to the event loop
+def coordinator_message(message,fd):
+    op = message['op']
+    if op=='group':
+        experiment.state_actor.submit(start_group,message['clients'])
+    elif op=='hand_over':
+        experiment.state_actor.submit(hand_over_waiting_client,message['client_id'],message['to'])
+    elif op=='adopt':
+        connection = message['connection']
+        connection['buffered'] = connection['buffered'].encode('latin-1')
+        messages = [m['binary'].encode('latin-1') if isinstance(m,dict) else m for m in message['messages']]
+        def adopted(client):
+            experiment.state_actor.submit(client_arrived,client,message['state'],
+                                          messages,message['group'])
+        server.adopt(fd,message['client_id'],connection,adopted)
+    elif op=='hand_over_failed':
+        experiment.state_actor.submit(member_arrived,message['client_id'],True)
+    elif op=='expired':
+        experiment.matchmaker.expired.append(message['client_id'])
+    elif op=='home':
+        if message['worker'] is None:
+            homes.pop(message['participant'],None)
+        else:
+            homes[message['participant']] = message['worker']
+    elif op=='homes':
+        homes.update(message['homes'])
+
+
+
+#######################
+### Start up server
+#######################
+
+EXPERIMENT='dyadic_interaction_server.py' #relative to this folder
+PORT=9001
+WORKERS=os.cpu_count() or 1
+
+# Each worker's journal (see state_journal.py) goes in a folder of its own in here - run
+# with the same number of workers after a restart, so every worker finds its own again
+STATE_DIRECTORY='server_state'
+COORDINATOR_SOCKET=os.path.join(tempfile.gettempdir(),'dyadic_coordinator_%d.sock' % PORT)
+
+# A client part way through a message can't be handed over - try again this often (seconds),
+# up to this many times
+DETACH_RETRY_INTERVAL=0.02
+DETACH_ATTEMPTS=100
+
+PING_INTERVAL=20
+PING_TIMEOUT=10
+
+LOG_FILE=None #None logs to the terminal, or give a file name e.g. 'server_log.jsonl'
+MESSAGE_LOG_SAMPLE=10
+
+# Each worker serves its metrics (see metrics.py) on a port of its own, METRICS_PORT+index -
+# None turns this off
+METRICS_PORT=9101
+
+# Run in each worker - generation counts how many times it has been restarted
+def worker_main(index,generation):
+    global worker_index, server, link, handovers
+    worker_index = index
+    log_listener = setup_logging(LOG_FILE,levels={'dyadic.messages':logging.DEBUG},
+                                 sample_every={'dyadic.messages':MESSAGE_LOG_SAMPLE})
+    link = CoordinatorLink(COORDINATOR_SOCKET,index)
+    server = AsyncWebsocketServer(PORT,'0.0.0.0',compression=PerMessageDeflate(client_no_context_takeover=True),
+                                  ping_interval=PING_INTERVAL,ping_timeout=PING_TIMEOUT,reuse_port=True,
+                                  subprotocols=experiment.encoder.subprotocols)
+    # client IDs must be unique across all the workers (and a restarted worker's previous
+    # generations, whose clients may have been handed over to other workers)
+    server.registry = ClientRegistry(id_start=index+WORKERS*10**6*generation,id_step=WORKERS)
+    experiment.server = server
+    experiment.matchmaker = CoordinatedMatchmaker(link)
+    experiment.journal = WorkerJournal(os.path.join(STATE_DIRECTORY,'worker_%d' % index),link)
+    metrics = experiment.metrics
+    metrics.const_labels['worker'] = str(index)
+    handovers = metrics.counter('dyadic_handovers_total','Clients handed over to another worker')
+    state_actor = experiment.state_actor
+    server.set_fn_new_client(state_actor.wrap(experiment.new_client))
+    server.set_fn_client_left(state_actor.wrap(client_left))
+    server.set_fn_message_received(state_actor.wrap(message_received))
+    server.set_fn_binary_message_received(state_actor.wrap(message_received))
+    experiment.start_experiment()
+    state_actor.start()
+    experiment.trial_data.start()
+    link.start(coordinator_message)
+    if METRICS_PORT is not None:
+        add_server_metrics(metrics,server)
+        MetricsServer(METRICS_PORT+index,lambda: state_actor.call(render,[metrics],timeout=COLLECT_TIMEOUT)).start()
+    logger.info('worker %d starting up', index)
+    try:
+        server.run_forever()
+    finally:
+        experiment.trial_data.close() #writes out any trial data still waiting to be saved
+        experiment.stop_experiment() #and any changes to participants' state
+        log_listener.stop() #writes out anything still waiting to be logged
+
+def run():
+    global experiment
+    here = os.path.dirname(os.path.abspath(__file__))
+    experiment = load_experiment(os.path.normpath(os.path.join(here,EXPERIMENT)))
+    # the coordinator uses the experiment's own matchmaker (and so its settings)
+    coordinator = MatchmakingCoordinator(COORDINATOR_SOCKET,experiment.matchmaker)
+    coordinator.start_process()
+    try:
+        Supervisor(WORKERS,worker_main).run()
+    finally:
+        coordinator.stop_process()
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Benchmark for mturk_answers.py
+################################################################################
+
+## This script times getting the fields out of assignments' Answer XML (made up by
+## FakeMTurk, fake_mturk.py, with a trialData field per trial and a comments field)
+## - as create_tasks.py used to: parse the whole document into a tree (with xmltodict,
+##   if it is installed, and with ElementTree), then go through the answers again for
+##   each field wanted
+## - with answer_fields: parse once with ElementTree, and pick out every field in one
+##   pass
+## - as expat parses the document, without building a tree (which mturk_answers.py
+##   doesn't do, as it turns out no quicker)
+## and then downloads a batch of HITs' data from FakeMTurk, writing it out with
+## BatchWriter, one HIT at a time and several at once, parsing the answers here and
+## in several processes.
+
+## How to use:
+	# python answer_parsing_benchmark.py --assignments 2000 --trials 60
+
+import os
+import time
+import argparse
+import tempfile
+import xml.parsers.expat
+import xml.etree.ElementTree as ElementTree
+
+try:
+    import xmltodict
+except ImportError:
+    xmltodict = None
+
+from bulk_approval import ThrottledClient
+from fake_mturk import FakeMTurk
+from mturk_answers import answer_fields, iter_records, BatchWriter
+from mturk_assignments import iter_assignments, iter_assignments_for_hits
+
+## Fields create_tasks.py asked for one at a time
+FIELDS = ['comments']
+
+
+def extract_data(data_dict):
+    if data_dict['FreeText']:
+        return data_dict['QuestionIdentifier'], data_dict['FreeText'].split(',')
+    else:
+        return data_dict['QuestionIdentifier'], None
+
+## field_from_assignment as it was, for each field and the trial data
+def fields_as_before(answer_list):
+    formatted_answer_list = [extract_data(answer) for answer in answer_list]
+    trials = [answer for answer in formatted_answer_list if 'trialData' in answer[0]]
+    other_question_answers = [answer for answer in formatted_answer_list if 'trialData' not in answer[0]]
+    return trials, [[a for a in other_question_answers if a[0] == field] for field in FIELDS]
+
+def with_xmltodict(answer_xml):
+    return fields_as_before(xmltodict.parse(answer_xml)['QuestionFormAnswers']['Answer'])
+
+def with_elementtree(answer_xml):
+    answer_list = [dict((field.tag.rsplit('}', 1)[-1], field.text) for field in answer)
+                   for answer in ElementTree.fromstring(answer_xml)]
+    return fields_as_before(answer_list)
+
+## The fields picked out as expat parses the document, in one pass
+def with_expat(answer_xml):
+    answers = []
+    text = []
+    question = [None]
+
+    def end(name):
+        if name == 'FreeText':
+            answers.append((question[0], ''.join(text) or None))
+        elif name == 'QuestionIdentifier':
+            question[0] = ''.join(text)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = lambda name, attributes: text.clear()
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = text.append
+    parser.Parse(answer_xml, True)
+    return answers
+
+
+def download(client, hit_ids, directory, workers, processes):
+    writers = dict((hit_id, BatchWriter(os.path.join(directory, hit_id), fields=FIELDS)) for hit_id in hit_ids)
+    if workers > 1:
+        assignments = (a for _, a in iter_assignments_for_hits(client, hit_ids, workers=workers))
+    else:
+        assignments = (a for hit_id in hit_ids for a in iter_assignments(client, hit_id))
+    for record in iter_records(assignments, processes=processes):
+        writers[record['HITId']].write(record)
+    for writer in writers.values():
+        writer.close()
+    return sum(writer.trials for writer in writers.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mturk_answers.py.')
+    parser.add_argument('--assignments', type=int, default=2000)
+    parser.add_argument('--trials', type=int, default=60, help='trials per assignment')
+    parser.add_argument('--hits', type=int, default=10, help='HITs to download')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds each request takes')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=2)
+    args = parser.parse_args()
+
+    mturk = FakeMTurk(args.latency, n_trials=args.trials)
+    mturk.add_hit('PARSING', args.assignments)
+    xmls = [a['Answer'] for a in mturk.assignments.values()]
+    print('%d answers with %d trials each (%.1f KB each)' % (len(xmls), args.trials,
+                                                             sum(len(x) for x in xmls) / 1024.0 / len(xmls)))
+    parsers = [('ElementTree, a pass per field (before)', with_elementtree),
+               ('ElementTree, answer_fields', answer_fields),
+               ('expat, no tree', with_expat)]
+    if xmltodict is not None:
+        parsers.insert(0, ('xmltodict, a pass per field (before)', with_xmltodict))
+    else:
+        print('(xmltodict not installed, leaving it out)')
+    baseline = None
+    for name, parse in parsers:
+        start = time.perf_counter()
+        for answer_xml in xmls:
+            parse(answer_xml)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print('%-40s %8.1f us/answer   (%.1fx)' % (name, 1e6 * elapsed / len(xmls), baseline / elapsed))
+    for processes in [0, args.processes]:
+        start = time.perf_counter()
+        n = sum(1 for _ in iter_records(iter(mturk.assignments.values()), processes=processes))
+        elapsed = time.perf_counter() - start
+        print('%-40s %8.1f us/answer' % ('iter_records, %d processes' % processes, 1e6 * elapsed / n))
+    print('')
+
+    mturk = FakeMTurk(args.latency, n_trials=args.trials)
+    hit_ids = ['HIT%03d' % i for i in range(args.hits)]
+    for hit_id in hit_ids:
+        mturk.add_hit(hit_id, args.assignments // args.hits)
+    print('Downloading %d HITs with %d assignments each' % (args.hits, args.assignments // args.hits))
+    for workers, processes in [(1, 0), (args.workers, 0), (args.workers, args.processes)]:
+        start = time.time()
+        client = ThrottledClient(mturk, rate=20, burst=workers)
+        trials = download(client, hit_ids, tempfile.mkdtemp(), workers, processes)
+        print('%d HITs at once, %d processes: %d trials written in %.1f seconds'
+              % (workers, processes, trials, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Benchmark for mturk_assignments.py, against a stand-in for MTurk
+################################################################################
+
+## This script makes a number of HITs with many assignments on FakeMTurk (fake_mturk.py)
+## and fetches their assignments
+## - with one call of list_assignments_for_hit per HIT, as create_tasks.py used to,
+##   which only gets the first page
+## - with iter_assignments, one HIT after another
+## - with iter_assignments_for_hits, several HITs at once
+## and prints how many assignments each got, how many requests it made, and the time
+## it took.
+
+## How to use:
+	# python assignment_listing_benchmark.py --hits 20 --assignments 250 --latency 0.1
+
+import time
+import argparse
+
+from bulk_approval import ThrottledClient
+from fake_mturk import FakeMTurk
+from mturk_assignments import iter_assignments, iter_assignments_for_hits
+
+
+## How create_tasks.py used to do it
+def first_page_only(mturk, hit_ids):
+    return sum(len(mturk.list_assignments_for_hit(HITId=hit_id)['Assignments']) for hit_id in hit_ids)
+
+def one_hit_at_a_time(mturk, hit_ids):
+    return sum(1 for hit_id in hit_ids for _ in iter_assignments(mturk, hit_id))
+
+def several_hits_at_once(workers, rate):
+    def fetch(mturk, hit_ids):
+        client = ThrottledClient(mturk, rate=rate, burst=workers)
+        return sum(1 for _ in iter_assignments_for_hits(client, hit_ids, workers=workers))
+    return fetch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mturk_assignments.py against a stand-in for MTurk.')
+    parser.add_argument('--hits', type=int, default=20)
+    parser.add_argument('--assignments', type=int, default=250, help='assignments per HIT')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds each request takes')
+    parser.add_argument('--max-rate', type=int, default=30, help='requests a second before MTurk throttles')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=20, help='requests a second to aim for')
+    args = parser.parse_args()
+
+    mturk = FakeMTurk(args.latency, args.max_rate, n_trials=2)
+    hit_ids = ['HIT%03d' % i for i in range(args.hits)]
+    for hit_id in hit_ids:
+        mturk.add_hit(hit_id, args.assignments)
+    print('%d HITs with %d assignments each' % (args.hits, args.assignments))
+
+    for name, fetch in [('first page only (before)', first_page_only),
+                        ('iter_assignments, one HIT at a time', one_hit_at_a_time),
+                        ('iter_assignments_for_hits, %d at once' % args.workers,
+                         several_hits_at_once(args.workers, args.rate))]:
+        requests_before = mturk.requests
+        start = time.time()
+        n = fetch(mturk, hit_ids)
+        print('%-40s %6d assignments %5d requests %6.1f seconds' % (name, n, mturk.requests - requests_before,
+                                                                     time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Approving and qualifying many assignments at once
+################################################################################
+
+## Approving a batch means, for every assignment, checking it hasn't been approved
+## already, approving it, and (when running live) giving the worker the qualification
+## that stops them taking the HIT again. Done one request at a time, each waiting for
+## the last, a large batch takes minutes - most of it waiting on the network.
+
+## BulkApprover sends these requests from several threads at once, while
+## - keeping to a maximum number of requests a second overall, so MTurk doesn't start
+##   refusing them
+## - retrying requests MTurk does refuse for going too fast (or because it is briefly
+##   unavailable), waiting twice as long each time
+## - recording each step as it is done in a progress file, so running it again after
+##   it was interrupted (or some requests failed) carries on where it stopped, rather
+##   than repeating what was done
+## and reports how many assignments were approved and qualified, and what failed.
+
+## It needs nothing but a client with the boto3 MTurk methods it calls (get_assignment,
+## approve_assignment, associate_qualification_with_worker), so it can be tried out
+## against a stand-in for MTurk - see bulk_approval_benchmark.py.
+
+## How to use (create_tasks.py --approve does this):
+	# approver = BulkApprover(mturk, qualification_id='XXX', progress_file='batch0_progress.jsonl')
+	# summary = approver.approve_all([(workerID, assignmentID), ...])
+	# print_summary(summary)
+
+import os
+import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+################################################################################
+############ Global parameters
+################################################################################
+
+## Requests being sent at once
+WORKERS = 8
+## Requests a second, over all the threads. MTurk doesn't say how fast is too fast, and
+## throttled requests are retried anyway, but going much faster than this tends to get
+## requests throttled
+RATE = 20.0
+## How many times a throttled request is tried again before giving up on it, and the
+## wait before the first retry (in seconds), which doubles each time
+MAX_RETRIES = 6
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
+
+## Error codes meaning "try again later" rather than "this request is wrong"
+RETRYABLE_ERRORS = ('ThrottlingException', 'Throttling', 'TooManyRequestsException',
+                    'ServiceUnavailable', 'ServiceFault', 'InternalFailure')
+
+################################################################################
+############ Keeping to the rate limit
+################################################################################
+
+## Lets through at most rate requests a second on average, and bursts of at most
+## burst at once (a token bucket): each request takes a token, and tokens are added
+## back at rate a second
+class RateLimiter(object):
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    ## Waits until a request can go
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+################################################################################
+############ Retrying
+################################################################################
+
+## The error code of an exception raised by a boto3 client (botocore's ClientError
+## keeps it in e.response), or None for anything else
+def error_code(e):
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code')
+    return None
+
+def is_retryable(e):
+    return error_code(e) in RETRYABLE_ERRORS
+
+## Wraps a boto3 MTurk client so that every request made through it keeps to the rate
+## limit, and is retried (after 1, 2, 4... times base_delay, with some randomness so
+## threads don't all retry together) if it is throttled, e.g.
+##   client = ThrottledClient(mturk, rate=20)
+##   client.get_assignment(AssignmentId=assignmentID)
+## Safe to use from several threads at once.
+class ThrottledClient(object):
+
+    def __init__(self, client, rate=RATE, burst=1, max_retries=MAX_RETRIES, base_delay=BASE_DELAY):
+        self.client = client
+        self.limiter = RateLimiter(rate, burst)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def call(self, method, **kwargs):
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            try:
+                return getattr(self.client, method)(**kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                delay = min(MAX_DELAY, self.base_delay * 2 ** attempt)
+                time.sleep(random.uniform(delay / 2, delay))
+                attempt += 1
+
+    def __getattr__(self, method):
+        return lambda **kwargs: self.call(method, **kwargs)
+
+################################################################################
+############ Recording progress
+################################################################################
+
+## One line of JSON per step done, e.g.
+##   {"assignment": "3X0H8...", "worker": "A1B2...", "step": "approved"}
+## appended and flushed to disk as soon as the step is done, so it survives the
+## script being interrupted at any point
+class ProgressFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+        self.file = None
+        if path is None:
+            return
+        cut_short = False
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    cut_short = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # the last line, cut short by the script being interrupted
+                    self.done.add((entry['assignment'], entry['step']))
+        self.file = open(path, 'a')
+        if cut_short:
+            self.file.write('\n')
+
+    def is_done(self, assignment_id, step):
+        return (assignment_id, step) in self.done
+
+    def record(self, assignment_id, worker_id, step):
+        with self.lock:
+            self.done.add((assignment_id, step))
+            if self.file is not None:
+                self.file.write(json.dumps({'assignment': assignment_id, 'worker': worker_id,
+                                            'step': step, 'time': time.time()}) + '\n')
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+################################################################################
+############ Approving
+################################################################################
+
+class BulkApprover(object):
+    """
+    Approves assignments, and qualifies their workers, several at a time.
+
+    Args:
+        client: boto3 MTurk client (or anything with the same methods), which
+            is wrapped in a ThrottledClient unless throttle is False.
+        qualification_id: Qualification to give each worker once their
+            assignment is approved, or None not to give one.
+        progress_file: File to record progress in, so a later run with the
+            same file skips what has been done. None not to record it.
+        workers, rate, max_retries, base_delay: See the global parameters.
+        throttle: False if client keeps to the rate limit already (e.g. a
+            CachedClient wrapping a ThrottledClient, so that requests answered
+            from the cache don't wait their turn).
+    """
+
+    def __init__(self, client, qualification_id=None, progress_file=None, workers=WORKERS,
+                 rate=RATE, max_retries=MAX_RETRIES, base_delay=BASE_DELAY, throttle=True):
+        if throttle:
+            client = ThrottledClient(client, rate, workers, max_retries, base_delay)
+        self.client = client
+        self.qualification_id = qualification_id
+        self.progress_file = progress_file
+        self.workers = workers
+
+    ## Approves one assignment and qualifies its worker, skipping whatever the progress
+    ## file says was done already. Returns what happened, e.g. ['approved', 'qualified']
+    def approve_one(self, progress, worker_id, assignment_id):
+        outcome = []
+        if progress.is_done(assignment_id, 'approved'):
+            outcome.append('resumed')
+        else:
+            status = self.client.get_assignment(AssignmentId=assignment_id)['Assignment']['AssignmentStatus']
+            if status != 'Approved':
+                self.client.approve_assignment(AssignmentId=assignment_id)
+                outcome.append('approved')
+            else:
+                outcome.append('already_approved')
+            progress.record(assignment_id, worker_id, 'approved')
+        if self.qualification_id is not None and not progress.is_done(assignment_id, 'qualified'):
+            self.client.associate_qualification_with_worker(QualificationTypeId=self.qualification_id,
+                                                            WorkerId=worker_id, IntegerValue=1, SendNotification=False)
+            progress.record(assignment_id, worker_id, 'qualified')
+            outcome.append('qualified')
+        return outcome
+
+    def approve_all(self, worker_assignment_list, report=None):
+        """
+        Approves every (workerID, assignmentID) in worker_assignment_list.
+        report(workerID, assignmentID, outcome, error) is called as each one
+        finishes. Returns a summary: counts of assignments approved,
+        already_approved (before this run), resumed (approved by an earlier
+        run), qualified and failed, the failures as (workerID, assignmentID,
+        error), retries made, and seconds taken.
+        """
+        start = time.time()
+        progress = ProgressFile(self.progress_file)
+        summary = {'approved': 0, 'already_approved': 0, 'resumed': 0, 'qualified': 0,
+                   'failed': 0, 'failures': []}
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [(worker_id, assignment_id,
+                            pool.submit(self.approve_one, progress, worker_id, assignment_id))
+                           for worker_id, assignment_id in worker_assignment_list]
+                try:
+                    for worker_id, assignment_id, future in futures:
+                        try:
+                            outcome, error = future.result(), None
+                        except Exception as e:
+                            outcome, error = ['failed'], e
+                            summary['failures'].append((worker_id, assignment_id, str(e)))
+                        for step in outcome:
+                            summary[step] += 1
+                        if report is not None:
+                            report(worker_id, assignment_id, outcome, error)
+                except BaseException:
+                    # e.g. Ctrl-C: don't start on any more, just let those under way finish
+                    # (and be recorded in the progress file)
+                    for _, _, future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            progress.close()
+        summary['retries'] = getattr(self.client, 'retries', 0)
+        summary['seconds'] = time.time() - start
+        return summary
+
+
+def print_summary(summary):
+    print('Approved: %d (plus %d approved already, and %d by an earlier run)'
+          % (summary['approved'], summary['already_approved'], summary['resumed']))
+    print('Qualified: %d' % summary['qualified'])
+    print('Failed: %d' % summary['failed'])
+    for worker_id, assignment_id, error in summary['failures']:
+        print('  assignment %s for worker %s: %s' % (assignment_id, worker_id, error))
+    if summary['failed']:
+        print('Run the same command again to retry the failed ones.')
+    print('(%.1f seconds, %d requests retried after being throttled)' % (summary['seconds'], summary['retries']))
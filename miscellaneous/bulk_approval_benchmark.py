@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Benchmark for bulk_approval.py, against a stand-in for MTurk
+################################################################################
+
+## FakeMTurk (in fake_mturk.py) answers the requests approving a batch makes the way
+## MTurk does, without going anywhere near MTurk: each request takes a while (latency),
+## requests beyond a certain number a second are refused with a ThrottlingException,
+## and approving an assignment twice is an error. It also counts what was done, so we
+## can check nobody was approved or qualified twice.
+
+## This script approves a batch of made-up assignments
+## - one request at a time, as create_tasks.py used to
+## - with BulkApprover
+## - with BulkApprover, interrupted part way through (as if by Ctrl-C), then run again
+##   with the same progress file, which should only do what was left
+## and prints the time each took and what was done.
+
+## How to use:
+	# python bulk_approval_benchmark.py --assignments 50 --latency 0.2
+
+import os
+import time
+import argparse
+import tempfile
+
+from bulk_approval import BulkApprover, print_summary
+from fake_mturk import FakeMTurk
+
+################################################################################
+############ The ways of approving
+################################################################################
+
+## How approve_hit in create_tasks.py used to do it
+def approve_one_at_a_time(mturk, worker_assignment_list):
+    for workerID, assignmentID in worker_assignment_list:
+        if mturk.get_assignment(AssignmentId=assignmentID)['Assignment']['AssignmentStatus'] != 'Approved':
+            _ = mturk.approve_assignment(AssignmentId=assignmentID)
+        _ = mturk.associate_qualification_with_worker(QualificationTypeId='QUALIFICATION', WorkerId=workerID,
+                                                      IntegerValue=1, SendNotification=False)
+
+
+def make_mturk(args):
+    mturk = FakeMTurk(args.latency, args.max_rate)
+    mturk.add_hit('HIT0', args.assignments)
+    return mturk
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark bulk_approval.py against a stand-in for MTurk.')
+    parser.add_argument('--assignments', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds each request takes')
+    parser.add_argument('--max-rate', type=int, default=15, help='requests a second before MTurk throttles')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=20, help='requests a second BulkApprover aims for')
+    args = parser.parse_args()
+
+    mturk = make_mturk(args)
+    start = time.time()
+    approve_one_at_a_time(mturk, mturk.worker_assignment_list('HIT0'))
+    print('One at a time: %.1f seconds; %s' % (time.time() - start, mturk.check()))
+    print('')
+
+    mturk = make_mturk(args)
+    approver = BulkApprover(mturk, 'QUALIFICATION', workers=args.workers, rate=args.rate)
+    summary = approver.approve_all(mturk.worker_assignment_list('HIT0'))
+    print('BulkApprover: %s; %d requests throttled' % (mturk.check(), mturk.throttled))
+    print_summary(summary)
+    print('')
+
+    progress_file = os.path.join(tempfile.mkdtemp(), 'progress.jsonl')
+    mturk = make_mturk(args)
+    mturk.interrupt_after = args.assignments
+    approver = BulkApprover(mturk, 'QUALIFICATION', progress_file, workers=args.workers, rate=args.rate)
+    try:
+        approver.approve_all(mturk.worker_assignment_list('HIT0'))
+    except KeyboardInterrupt:
+        pass
+    print('BulkApprover, interrupted after %d requests: %s' % (args.assignments, mturk.check()))
+    mturk.interrupt_after = None
+    requests_before = mturk.requests
+    approver = BulkApprover(mturk, 'QUALIFICATION', progress_file, workers=args.workers, rate=args.rate)
+    summary = approver.approve_all(mturk.worker_assignment_list('HIT0'))
+    print('Run again: %d more requests; %s' % (mturk.requests - requests_before, mturk.check()))
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@
 ## Attribution: original code by Kenny Smith, edited by Jenny Culbertson
 
 import boto3
-import xmltodict
 import datetime # or getting today's date
 import pytz # for timezone stuff
 import glob  # for listing files with wildcards in names
@@ -10,6 +9,10 @@ import argparse # for parsing command-line arguments
 import sys
 import unidecode # for dealing with accents in worker comments (or anywhere else)
 import codecs
+from bulk_approval import BulkApprover, ThrottledClient, print_summary # for approving lots of assignments at once
+from mturk_assignments import iter_assignments, iter_assignments_for_hits, count_assignments # for getting all of a HIT's assignments, a page at a time
+from mturk_cache import MTurkCache, CachedClient # for keeping a local copy of HITs and assignments
+from mturk_answers import BatchWriter, iter_records # for writing out data
 
 ## To run in a virtual environment in case of python verison conflicts:
 
@@ -28,11 +31,13 @@ import codecs
 
 	## To check whether all assignments are complete, make sure to update the HITID File
 	# python create_tasks.py --check --hitfile HITIDFiles/NPO_exp6HIT_12_12_2019_Batch0.txt
+	## (--check, --comments etc take several HIT files at once, e.g. all of today's batches)
+	# python create_tasks.py --check --hitfile HITIDFiles/NPO_exp6HIT_12_12_2019_Batch*.txt
 
 	## To approve the work once it's complete (will pay/give qualifications for a batch)
 	# python create_tasks.py --approve --hitfile HITIDFiles/NPO_exp6HIT_11_12_2019_Batch2.txt
 
-	## To download the data
+	## To download the data (written next to each HIT file, as <HIT file>.data.csv and .data.jsonl)
 	# create_tasks.py --data --hitfile HITIDFiles/NPO_exp6HIT_11_12_2019_Batch1.txt
 
 ################################################################################
@@ -67,6 +72,36 @@ mturkSandbox = boto3.client('mturk',
    endpoint_url = 'https://mturk-requester-sandbox.us-east-1.amazonaws.com'
 )
 
+## Qualification given to workers once their work is approved, so they can't take the
+## HIT again (only when running live - see approve_hit)
+completedQualification = 'XXX' # add your qualification
+
+## Approving a batch sends several requests to MTurk at once (see bulk_approval.py) -
+## how many at a time, and at most how many a second
+approvalWorkers = 8
+approvalRate = 20
+
+## Checking or getting comments from several HIT files fetches several HITs' assignments
+## at once (see mturk_assignments.py) - how many at a time, and at most how many
+## requests a second
+fetchWorkers = 4
+fetchRate = 20
+
+## HITs and assignments fetched from MTurk are kept in this file (see mturk_cache.py), and
+## used rather than asking MTurk again for cacheTTL seconds - or for good, once a HIT has
+## expired and all its assignments are approved. Delete the file to start afresh
+cacheFile = path+'mturk_cache_'+platform+'.sqlite'
+cacheTTL = 300
+
+## Downloading data writes a CSV file with a row per trial: workerId, assignmentId, the
+## trialData field's name, the comma-separated values in the trial's data (with these
+## names in the header, or field1, field2... if None), then these other answers
+trialDataHeaders = None
+questionnaireFields = ['comments']
+## Processes parsing answers at once when downloading data (0 to parse them as they
+## arrive - fetching them is usually what takes the time, unless there are thousands)
+dataProcesses = 0
+
 livePreviewURL = "https://worker.mturk.com/mturk/preview?groupId="
 sandboxPreviewURL = "https://workersandbox.mturk.com/mturk/preview?groupId="
 
@@ -79,11 +114,19 @@ elif (platform=='live'):
     mturk = mturkLive #set to mturkLive for live
     previewURL = liveURL #set to liveURL
 
+mturkCache = MTurkCache(cacheFile)
+mturk = CachedClient(mturk, mturkCache, cacheTTL)
+
 
 ################################################################################
 ############# Misc
 ################################################################################
 
+## mturk, keeping to rate requests a second between threads sending requests at once,
+## and still answering from the cache (kept for ttl seconds) what it can
+def throttled_mturk(rate, workers, ttl=cacheTTL):
+    return CachedClient(ThrottledClient(mturk.client, rate=rate, burst=workers), mturkCache, ttl)
+
 def getYNInput():
     keypress = raw_input()
     #keypress = input() #python 3 version
@@ -189,19 +232,16 @@ def data_from_assignment(assignment_dict):
 ## get trial answers
 def field_from_assignment(assignment_dict,field_to_return):
     workerId=assignment_dict['WorkerId']
-    #the list of answers produced by the participant is slightly buried in here
-    answerList = xmltodict.parse(assignment_dict['Answer'])['QuestionFormAnswers']['Answer']
-    formatted_answer_list = [extract_data(answer) for answer in answerList]
-    other_question_answers = [answer for answer in formatted_answer_list if 'trialData' not in answer[0]]
-    relevant_question_answers = [a for a in other_question_answers if a[0]==field_to_return]
+    #the list of answers produced by the participant is slightly buried in here (parsed once, then kept in the cache)
+    answerList = mturk.answers(assignment_dict)
+    relevant_question_answers = [extract_data(answer) for answer in answerList
+                                 if answer['QuestionIdentifier']==field_to_return and 'trialData' not in field_to_return]
     return workerId,relevant_question_answers
 
-## get comments
+## get comments, printing each worker's as their page of assignments arrives
 def get_comments(hitID):
-    result=mturk.list_assignments_for_hit(HITId=hitID)
-    assignments = result['Assignments']
-    comments = [field_from_assignment(a,'comments') for a in assignments]
-    print(comments)
+    for a in iter_assignments(mturk, hitID):
+        print(field_from_assignment(a,'comments'))
 
 ## approve the HIT, pay participants and give HIT qualifications (to prevent workers participating again)
 def approve_hit(filename,hitID):
@@ -209,31 +249,38 @@ def approve_hit(filename,hitID):
     check_balance()
     print('Approving and paying after ' + filename)
     print("If you haven't checked this HIT is complete, we suggest you don't proceed!")
-    ## find all the completed assignments for this HIT
-    result=mturk.list_assignments_for_hit(HITId=hitID)
-    assignments = result['Assignments']
-    worker_assignment_list = [data_from_assignment(a) for a in assignments]
+    ## find all the completed assignments for this HIT (every page of them, fresh from MTurk, though
+    ## assignments the cache knows are approved aren't checked with MTurk again)
+    client = throttled_mturk(approvalRate, approvalWorkers, ttl=0)
+    worker_assignment_list = [data_from_assignment(a) for a in iter_assignments(client, hitID)]
 
     ## calculate who gets paid and qualifications
-    print('Number of workers: ' + str(len(assignments)))
+    print('Number of workers: ' + str(len(worker_assignment_list)))
     print('Proceed to approve and qualify? (y/n)')
     ## if 'n', stop
     if (not(getYNInput())):
         print('CAUTION! workers have not been paid!')
         sys.exit()
-    ## if 'y', approve, pay, and give qualification to each worker
+    ## if 'y', approve, pay, and give qualification to each worker - several at a time.
+    ## What has been done is recorded in a progress file next to the HIT file, so if this
+    ## is interrupted (or some requests fail) running it again carries on where it stopped
     else:
-        for workerID,assignmentID in worker_assignment_list:
-            #they get their work approved
-            print('Approving assignment ',assignmentID,' for worker ',workerID)
-            if mturk.get_assignment(AssignmentId=assignmentID)['Assignment']['AssignmentStatus']!='Approved':
-                _ = mturk.approve_assignment(AssignmentId=assignmentID)
-            ## give qualification to indicate they have completed the HIT, which rules them out from taking it again
-            if (platform=='live'):
-                _ = mturk.associate_qualification_with_worker(QualificationTypeId='XXX', # add your qualification
-                                               WorkerId=workerID,
-                                               IntegerValue=1,
-                                               SendNotification=False)
+        ## give qualification to indicate they have completed the HIT, which rules them out from taking it again
+        if (platform=='live'):
+            qualification = completedQualification
+        else:
+            qualification = None
+        approver = BulkApprover(client, qualification_id=qualification,
+                                progress_file=filename + '.approval_progress.jsonl',
+                                workers=approvalWorkers, throttle=False)
+        def report(workerID, assignmentID, outcome, error):
+            print('Assignment ' + assignmentID + ' for worker ' + workerID + ': ' +
+                  (', '.join(outcome) if error is None else 'FAILED (' + str(error) + ')'))
+        summary = approver.approve_all(worker_assignment_list, report)
+        print_summary(summary)
+        if summary['failed']:
+            print('CAUTION! some workers have not been paid!')
+            return
     print('Completed tidy-up')
 
 
@@ -241,16 +288,20 @@ def approve_hit(filename,hitID):
 ############# Checking and expiring
 ################################################################################
 
-## reports on status of the HIT
-def check_hit(hitID):
+## reports on status of the HIT (nComplete is counted here unless it is given)
+def check_hit(hitID, nComplete=None):
     hit = mturk.get_hit(HITId=hitID)
     nAvailable = hit['HIT']['MaxAssignments']
-    nComplete = mturk.list_assignments_for_hit(HITId=hitID)['NumResults']
+    if nComplete is None:
+        nComplete = count_assignments(mturk, hitID)
+    nChanged = len([c for c in mturkCache.changes if c[0]==hitID])
     expiration = hit['HIT']['Expiration']
     if expiration<datetime.datetime.now(pytz.utc):
         print(str(nComplete)+'/'+str(nAvailable),' assignments completed, HIT expired at ',datetime.datetime.strftime(expiration,'%H:%M %d %b %Y'))
     else:
         print(str(nComplete)+'/'+str(nAvailable),' assignments completed, HIT is LIVE and will expire at ',datetime.datetime.strftime(expiration,'%H:%M %d %b %Y'))
+    if nChanged:
+        print(str(nChanged)+' assignments new or changed status since the last check')
 
 ## expires HIT
 def expire_hit(hitID):
@@ -262,25 +313,24 @@ def expire_hit(hitID):
 #     #return datastring.replace('-',',') # if dashes were used as separators, use this instead
 #     return tidy
 
-# ## get data in the right format and write to csv...this will need to be changed depending on what data you are returning
-# def format_worker_data(simple_answers):
-# 	## answers are lists, a[0] returns names/ids, a[1] is the entry, entry itself is a list, so to access it use [0][0]
-# 	## e.g., [u'noun', [u'feather']]
-# 	## XXXX
-# 	filename = dataDirectory + workerId + '.csv'
-# 	headers = ','.join(['condition','workerId','phase','trial','meaning','phrase','foil','response','noun_def','inner_mod1_def','inner_mod2_def','outer_mod1_def','outer_mod2_def','strategy','lang1','lang1_rating','lang2','lang2_rating','lang3','lang3_rating','lang4','lang4_rating'])
-# 	with open(filename, "w") as csv_file:
-# 		csv_file.write(headers+'\n')
-# 		for t in trialData:
-# 			csv_file.write(t.encode('utf-8') + ',' + questionnaire_data.encode('utf-8') + '\n'.encode('utf-8')) # python 2 version: encode as utf-8 to prevent any issues with accents or weird characters in comments
-# 			#csv_file.write(t + ',' + questionnaire_data + '\n') # python 3 version: encode as utf-8 to prevent any issues with accents or weird characters in comments
-
-# ## get data from a hit (calls format_worder_data() to write to csv)
-# def get_data(hitID):
-#     assignments = mturk.list_assignments_for_hit(HITId=hitID)['Assignments']
-#     for a in assignments:
-#         parsed_answers = xmltodict.parse(a['Answer'])['QuestionFormAnswers']['Answer']
-#         format_worker_data([extract_data(a) for a in parsed_answers])
+## get data from the HITs in HIT files filenames, fetching several HITs' assignments at
+## once, and write each HIT's to <HIT file>.data.csv and <HIT file>.data.jsonl
+def get_data(filenames):
+    hitIDs = [idFromFile(filename) for filename in filenames]
+    writers = dict((hitID, BatchWriter(filename + '.data', trialDataHeaders, questionnaireFields))
+                   for filename, hitID in zip(filenames, hitIDs))
+    client = throttled_mturk(fetchRate, fetchWorkers)
+    assignments = (a for hitID, a in iter_assignments_for_hits(client, hitIDs, workers=fetchWorkers))
+    try:
+        for record in iter_records(assignments, processes=dataProcesses):
+            writers[record['HITId']].write(record)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    for hitID in hitIDs:
+        writer = writers[hitID]
+        print(str(writer.assignments) + ' assignments (' + str(writer.trials) + ' trials) written to ' +
+              writer.csv_path + ' and ' + writer.jsonl_path)
 
 ################################################################################
 ############# Revoking out-of-date qualifications
@@ -308,14 +358,28 @@ def expire_from_file(filename):
     hitID=idFromFile(filename)
     expire_hit(hitID)
 
-def data_from_file(filename):
-    hitID=idFromFile(filename)
-    get_data(hitID)
-
 def comments_from_file(filename):
     hitID=idFromFile(filename)
     get_comments(hitID)
 
+## for several HIT files, fetch the HITs' assignments several at a time (keeping to
+## fetchRate requests a second between them)
+def check_from_files(filenames):
+    hitIDs = [idFromFile(filename) for filename in filenames]
+    nComplete = dict((hitID, 0) for hitID in hitIDs)
+    client = throttled_mturk(fetchRate, fetchWorkers)
+    for hitID, a in iter_assignments_for_hits(client, hitIDs, workers=fetchWorkers):
+        nComplete[hitID] += 1
+    for filename, hitID in zip(filenames, hitIDs):
+        print(filename + ':')
+        check_hit(hitID, nComplete[hitID])
+
+def comments_from_files(filenames):
+    hitIDs = [idFromFile(filename) for filename in filenames]
+    client = throttled_mturk(fetchRate, fetchWorkers)
+    for hitID, a in iter_assignments_for_hits(client, hitIDs, workers=fetchWorkers):
+        print(field_from_assignment(a,'comments'))
+
 
 ################################################################################
 ############# Main
@@ -346,8 +410,8 @@ def main():
     parser.add_argument("--expire",
                         action='store_true',
                         help="Set this flag to expire a HIT.")
-    parser.add_argument("--hitfile", "-f",\
-                        help="File containing HIT ID of HIT to be checked/paid")
+    parser.add_argument("--hitfile", "-f", nargs='+',\
+                        help="File(s) containing HIT ID of HIT to be checked/paid")
 
     parser.add_argument("--compensation",
                         action='store_true',
@@ -364,15 +428,23 @@ def main():
     if (args.balance):
         check_balance()
     elif (args.expire) & (args.hitfile is not None):
-        expire_from_file(args.hitfile)
+        for filename in args.hitfile:
+            expire_from_file(filename)
     elif (args.check) & (args.hitfile is not None):
-        check_from_file(args.hitfile)
+        if len(args.hitfile) == 1:
+            check_from_file(args.hitfile[0])
+        else:
+            check_from_files(args.hitfile)
     elif (args.approve) & (args.hitfile is not None):
-        approve_from_file(args.hitfile)
+        for filename in args.hitfile:
+            approve_from_file(filename)
     elif (args.data) & (args.hitfile is not None):
-        data_from_file(args.hitfile)
+        get_data(args.hitfile)
     elif (args.comments) & (args.hitfile is not None):
-        comments_from_file(args.hitfile)
+        if len(args.hitfile) == 1:
+            comments_from_file(args.hitfile[0])
+        else:
+            comments_from_files(args.hitfile)
     elif args.create:
         create_hit()
 
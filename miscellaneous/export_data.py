@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Exporting server_data to a columnar dataset for analysis
+################################################################################
+
+## The experiments save their data as lots of small csv files in server_data - one per
+## participant (or per dyad, for the dyadic interaction server), appended to a line at
+## a time. That's convenient while the experiment runs, but slow to analyse: reading one
+## column means opening and parsing every line of every file.
+
+## This script gathers all those csv files into a single dataset stored column by
+## column, compressed, and split into partitions by experiment and by date, e.g.
+##   server_data_export/experiment=di/date=2022-11-03/part-00001.parquet
+## Reading a couple of columns for one experiment then only reads those columns from
+## that experiment's partitions.
+
+## If pyarrow is installed (pip install pyarrow) the parts are Parquet files, which R
+## (arrow::open_dataset), pandas (pandas.read_parquet) etc can read directly. Without
+## pyarrow each part is a folder holding one gzipped JSON list per column, which
+## read_columns() below can read.
+
+## Everything in the csv files is text. Only the columns listed in COLUMN_TYPES below
+## (trial numbers, reaction times etc) are stored as numbers, so add any numeric columns
+## of your own experiment there.
+
+## Running the export again only processes what has changed since the last run: new
+## files, and new lines appended to files already exported. What has been exported is
+## recorded in manifest.json in the export folder, which also lists the parts - parts
+## not in the manifest (e.g. from an export that crashed part way through) are ignored.
+
+## How to use:
+	# python export_data.py --data ~/server_data --out ~/server_data_export
+	## then in python
+	# from export_data import read_columns
+	# columns = read_columns('server_data_export', ['participant_id','rt'], experiment='di')
+
+import os
+import re
+import csv
+import json
+import gzip
+import time
+import shutil
+import argparse
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+################################################################################
+############ Global parameters
+################################################################################
+
+## Which experiment a file belongs to is worked out from the start of its file name -
+## add your own experiments here. Files not matching any of these are grouped by their
+## file name (without .csv).
+EXPERIMENT_PREFIXES = [('di_server_', 'di_server'),
+                       ('di_extended_server_', 'di_extended_server'),
+                       ('di_', 'di'),
+                       ('cp_', 'cp'),
+                       ('il_', 'il')]
+
+## The columns holding numbers, from the trial data the experiments save (the dyadic
+## interaction server's, and jsPsych's own), and their types. Every other column is kept as
+## text - including identifiers like dyad_id, participant_id and partner, which can look
+## like numbers but aren't (e.g. '0042', or '12345_67890') - so every part of the dataset
+## has the same columns with the same types.
+COLUMN_TYPES = {'trial_n': 'int',
+                'score': 'int',
+                'time': 'float',
+                'trial_index': 'int',
+                'time_elapsed': 'float',
+                'rt': 'float'}
+
+MANIFEST = 'manifest.json'
+
+
+################################################################################
+############# Reading new data from the csv files
+################################################################################
+
+def experiment_for(relative_path):
+    filename = os.path.basename(relative_path)
+    for prefix, experiment in EXPERIMENT_PREFIXES:
+        if filename.startswith(prefix):
+            return experiment
+    return os.path.splitext(filename)[0]
+
+## column names from a header line - the jsPsych code writes some with stray spaces
+def clean_header(names):
+    header = []
+    for i, name in enumerate(names):
+        name = name.strip() or 'column_%d' % i
+        while name in header:
+            name = name + '_'
+        header.append(name)
+    return header
+
+## what a number looks like in the csv files - unlike int() and float(), no spaces,
+## underscores, 'nan' or 'inf'
+NUMBER_PATTERNS = {'int': (re.compile(r'-?[0-9]+'), int),
+                   'float': (re.compile(r'-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?'), float)}
+
+def column_type(name):
+    return COLUMN_TYPES.get(name, 'string')
+
+## converts a column of strings to its type in COLUMN_TYPES, with anything that isn't a
+## number ('', 'null'...) as missing
+def convert_column(name, values):
+    kind = column_type(name)
+    if kind == 'string':
+        return values
+    pattern, convert = NUMBER_PATTERNS[kind]
+    return [convert(v) if pattern.fullmatch(v) else None for v in values]
+
+## reads the lines of path from byte offset on (the whole file if offset is 0), stopping
+## at the last complete line in case the file is still being written to.
+## Returns the header, the rows and the offset to start from next time.
+def read_new_rows(path, offset, header):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end == 0:
+        return header, [], offset
+    lines = data[:end].decode('utf-8', 'replace').splitlines()
+    if offset == 0:
+        header = clean_header(next(csv.reader([lines[0]])))
+        lines = lines[1:]
+    rows = []
+    for values in csv.reader(lines):
+        if not values:
+            continue
+        row = dict(zip(header, values))
+        if len(values) > len(header):
+            # unquoted commas in a value - keep the leftovers rather than lose them
+            row['_extra'] = ','.join(values[len(header):])
+        rows.append(row)
+    return header, rows, offset + end
+
+def find_csv_files(data_directory):
+    for folder, _, filenames in os.walk(data_directory):
+        for filename in sorted(filenames):
+            if filename.endswith('.csv'):
+                path = os.path.join(folder, filename)
+                yield path, os.path.relpath(path, data_directory)
+
+
+################################################################################
+############# Writing parts
+################################################################################
+
+## each part holds a dictionary of columns, all the same length
+def rows_to_columns(rows):
+    names = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                names.append(name)
+    columns = {}
+    for name in names:
+        columns[name] = convert_column(name, [row.get(name, '') for row in rows])
+    return columns
+
+def write_part(path, columns):
+    # anything already here is left over from an export that didn't finish
+    for leftover in (path, path + '.parquet'):
+        if os.path.isdir(leftover):
+            shutil.rmtree(leftover)
+        elif os.path.exists(leftover):
+            os.remove(leftover)
+    if pyarrow is not None:
+        path += '.parquet'
+        types = {'int': pyarrow.int64(), 'float': pyarrow.float64(), 'string': pyarrow.string()}
+        schema = pyarrow.schema([(name, types[column_type(name)]) for name in columns])
+        pyarrow.parquet.write_table(pyarrow.table(columns, schema=schema), path, compression='zstd')
+    else:
+        os.makedirs(path)
+        names = list(columns)
+        n_rows = len(columns[names[0]]) if names else 0
+        for i, name in enumerate(names):
+            with gzip.open(os.path.join(path, '%d.json.gz' % i), 'wb', compresslevel=6) as f:
+                f.write(json.dumps(columns[name]).encode('utf-8'))
+        with open(os.path.join(path, '_meta.json'), 'w') as f:
+            json.dump({'rows': n_rows, 'columns': names}, f)
+    return path
+
+def load_manifest(export_directory):
+    path = os.path.join(export_directory, MANIFEST)
+    if not os.path.exists(path):
+        return {'files': {}, 'parts': [], 'next_part': 0}
+    with open(path) as f:
+        return json.load(f)
+
+## written to a temporary file and renamed, so the manifest is never half-written
+def save_manifest(export_directory, manifest):
+    path = os.path.join(export_directory, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+################################################################################
+############# The export
+################################################################################
+
+def export(data_directory, export_directory):
+    if not os.path.isdir(export_directory):
+        os.makedirs(export_directory)
+    manifest = load_manifest(export_directory)
+    partitions = {}  # (experiment, date) -> list of rows
+    n_files = 0
+    for path, relative_path in find_csv_files(data_directory):
+        stat = os.stat(path)
+        done = manifest['files'].get(relative_path, {'offset': 0, 'header': None})
+        if stat.st_size == done['offset']:
+            continue
+        if stat.st_size < done['offset']:
+            # the file has been replaced rather than appended to, so start again
+            # (rows already exported from it will appear twice)
+            print('WARNING: ' + relative_path + ' is shorter than when last exported, re-reading it all')
+            done = {'offset': 0, 'header': None}
+        header, rows, offset = read_new_rows(path, done['offset'], done['header'])
+        manifest['files'][relative_path] = {'offset': offset, 'header': header}
+        if not rows:
+            continue
+        n_files += 1
+        # rows are dated by when the file was last written to
+        date = time.strftime('%Y-%m-%d', time.gmtime(stat.st_mtime))
+        for row in rows:
+            row['source_file'] = relative_path
+        partitions.setdefault((experiment_for(relative_path), date), []).extend(rows)
+
+    n_rows = 0
+    for (experiment, date), rows in sorted(partitions.items()):
+        folder = os.path.join(export_directory, 'experiment=' + experiment, 'date=' + date)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        part = write_part(os.path.join(folder, 'part-%05d' % manifest['next_part']), rows_to_columns(rows))
+        manifest['next_part'] += 1
+        manifest['parts'].append({'path': os.path.relpath(part, export_directory),
+                                  'experiment': experiment, 'date': date, 'rows': len(rows)})
+        n_rows += len(rows)
+    save_manifest(export_directory, manifest)
+    return {'files': n_files, 'rows': n_rows, 'parts': len(partitions)}
+
+
+################################################################################
+############# Reading the exported data back
+################################################################################
+
+def read_part(path, columns):
+    if path.endswith('.parquet'):
+        table = pyarrow.parquet.read_table(path)
+        present = [c for c in columns if c in table.column_names]
+        table = table.select(present)
+        n_rows = table.num_rows
+        data = dict((c, table.column(c).to_pylist()) for c in present)
+    else:
+        with open(os.path.join(path, '_meta.json')) as f:
+            meta = json.load(f)
+        n_rows = meta['rows']
+        data = {}
+        for c in columns:
+            if c in meta['columns']:
+                with gzip.open(os.path.join(path, '%d.json.gz' % meta['columns'].index(c)), 'rt') as f:
+                    data[c] = json.load(f)
+    # columns this part doesn't have are missing values
+    return dict((c, data.get(c, [None] * n_rows)) for c in columns)
+
+## returns a dictionary from each column name to a list of its values, across all parts
+## (or only those for one experiment / a range of dates, given as 'YYYY-MM-DD' strings)
+def read_columns(export_directory, columns, experiment=None, start_date=None, end_date=None):
+    manifest = load_manifest(export_directory)
+    result = dict((c, []) for c in columns)
+    for part in manifest['parts']:
+        if experiment is not None and part['experiment'] != experiment:
+            continue
+        if (start_date is not None and part['date'] < start_date) or \
+           (end_date is not None and part['date'] > end_date):
+            continue
+        data = read_part(os.path.join(export_directory, part['path']), columns)
+        for c in columns:
+            result[c].extend(data[c])
+    return result
+
+
+################################################################################
+############# Main
+################################################################################
+
+def main():
+    description = "Exports the csv files in server_data to a partitioned columnar dataset."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--data", "-d", default='server_data',
+                        help="Folder containing the csv files.")
+    parser.add_argument("--out", "-o", default='server_data_export',
+                        help="Folder to export to - run again with the same folder to add new data.")
+    args = parser.parse_args()
+    start = time.time()
+    summary = export(args.data, args.out)
+    print('Exported %d new rows from %d files into %d parts in %.2fs (%s)' %
+          (summary['rows'], summary['files'], summary['parts'], time.time() - start,
+           'Parquet' if pyarrow is not None else 'gzipped JSON columns, install pyarrow for Parquet'))
+
+
+if __name__ == "__main__":
+    main()
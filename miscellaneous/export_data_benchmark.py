@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Benchmark for export_data.py
+################################################################################
+
+## Makes a fake server_data folder of per-participant csv files like the ones the
+## dyadic interaction experiment writes, exports it with export_data.py, and compares
+## the time taken to compute mean reaction time per partner from the raw csv files and
+## from the exported dataset. Also times re-running the export after a few files have
+## had lines appended, which should only process the new lines.
+
+## How to use:
+	# python export_data_benchmark.py --participants 2000 --trials 40
+
+import os
+import csv
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import export_data
+
+HEADER = 'participant_id,trial_index,trial_type,time_elapsed,partner_id,stimulus,observation_label,button1,button2,button_selected,rt\n'
+
+def make_line(participant_id, trial_index):
+    return ','.join([participant_id, str(trial_index), 'image-button-response', str(1000 * trial_index),
+                     'p%04d' % random.randint(0, 999), 'images/object4.jpg', random.choice(['wug', 'dax']),
+                     'object4', 'object5', str(random.randint(0, 1)), str(random.randint(300, 5000))]) + '\n'
+
+def make_data(directory, n_participants, n_trials):
+    for p in range(n_participants):
+        participant_id = 'p%04d' % p
+        with open(os.path.join(directory, 'di_%s.csv' % participant_id), 'w') as f:
+            f.write(HEADER)
+            for t in range(n_trials):
+                f.write(make_line(participant_id, t))
+
+def folder_size(directory):
+    return sum(os.path.getsize(os.path.join(folder, f)) for folder, _, files in os.walk(directory) for f in files)
+
+## the analysis: mean rt by partner, from the raw csv files
+def scan_csv(directory):
+    totals = {}
+    for path, _ in export_data.find_csv_files(directory):
+        with open(path) as f:
+            reader = csv.reader(f)
+            header = export_data.clean_header(next(reader))
+            partner_i, rt_i = header.index('partner_id'), header.index('rt')
+            for row in reader:
+                total = totals.setdefault(row[partner_i], [0, 0])
+                total[0] += int(row[rt_i])
+                total[1] += 1
+    return dict((k, float(s) / n) for k, (s, n) in totals.items())
+
+## the same analysis from the export, reading just the two columns needed
+def scan_export(directory):
+    columns = export_data.read_columns(directory, ['partner_id', 'rt'], experiment='di')
+    totals = {}
+    for partner, rt in zip(columns['partner_id'], columns['rt']):
+        total = totals.setdefault(partner, [0, 0])
+        total[0] += rt
+        total[1] += 1
+    return dict((k, float(s) / n) for k, (s, n) in totals.items())
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks export_data.py against reading the raw csv files.")
+    parser.add_argument("--participants", type=int, default=2000)
+    parser.add_argument("--trials", type=int, default=40)
+    args = parser.parse_args()
+    random.seed(1)
+    work = tempfile.mkdtemp()
+    try:
+        data, out = os.path.join(work, 'server_data'), os.path.join(work, 'export')
+        os.makedirs(data)
+        make_data(data, args.participants, args.trials)
+        print('%d csv files, %d rows, %.1f MB' % (args.participants, args.participants * args.trials,
+                                                  folder_size(data) / 1e6))
+        print('format: ' + ('Parquet' if export_data.pyarrow is not None else 'gzipped JSON columns (no pyarrow)'))
+
+        summary, t = timed(export_data.export, data, out)
+        print('first export: %d rows in %.2fs, %.1f MB' % (summary['rows'], t, folder_size(out) / 1e6))
+        summary, t = timed(export_data.export, data, out)
+        print('re-export with nothing new: %d rows in %.3fs' % (summary['rows'], t))
+        for p in range(10):
+            with open(os.path.join(data, 'di_p%04d.csv' % p), 'a') as f:
+                f.write(make_line('p%04d' % p, args.trials))
+        summary, t = timed(export_data.export, data, out)
+        print('re-export after appending to 10 files: %d rows in %.3fs' % (summary['rows'], t))
+
+        from_csv, csv_time = timed(scan_csv, data)
+        from_export, export_time = timed(scan_export, out)
+        assert from_csv == from_export
+        print('mean rt by partner from csv files: %.3fs' % csv_time)
+        print('mean rt by partner from export:    %.3fs (%.1fx faster)' % (export_time, csv_time / export_time))
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ A stand-in for MTurk, for trying scripts out without it
+################################################################################
+
+## FakeMTurk has the methods of a boto3 MTurk client that create_tasks.py and the
+## modules it uses call, and answers them the way MTurk does, without going anywhere
+## near MTurk (or needing boto3 installed):
+## - list_assignments_for_hit returns assignments a page at a time (10 by default,
+##   at most 100), with a NextToken for the next page
+## - each request takes a while (latency), and requests beyond a certain number a
+##   second are refused with a ThrottlingException
+## - approving an assignment that isn't waiting to be approved is an error
+## It also counts what was done, so we can check nobody was approved or qualified twice.
+## Assignments' answers look like the ones our HITs send back: a trialData field per
+## trial and a comments field.
+
+## How to use:
+	# mturk = FakeMTurk(latency=0.2)
+	# mturk.add_hit('HIT0', 250)
+	# ... then use mturk in place of a boto3 client
+
+import time
+import random
+import datetime
+import threading
+from collections import deque
+from xml.sax.saxutils import escape
+
+QUESTION_FORM_ANSWERS = ('<?xml version="1.0" encoding="ASCII"?>'
+                         '<QuestionFormAnswers xmlns="http://mechanicalturk.amazonaws.com/'
+                         'AWSMechanicalTurkDataSchemas/2005-10-01/QuestionFormAnswers.xsd">%s'
+                         '</QuestionFormAnswers>')
+
+## Raised like botocore's ClientError, with the error code in response
+class FakeMTurkError(Exception):
+
+    def __init__(self, code, message):
+        Exception.__init__(self, '%s: %s' % (code, message))
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+## An answer like the ones our HITs send back, with n_trials rows of trial data
+def make_answer(worker_id, n_trials):
+    fields = [('trialData%d' % t, ','.join([worker_id, str(t), 'image-button-response', str(1000 * t),
+                                            random.choice(['wug', 'dax']), str(random.randint(300, 5000))]))
+              for t in range(n_trials)]
+    fields.append(('comments', random.choice(['', 'Fun!', 'The images were small', u'Très bien'])))
+    return QUESTION_FORM_ANSWERS % ''.join(
+        '<Answer><QuestionIdentifier>%s</QuestionIdentifier><FreeText>%s</FreeText></Answer>'
+        % (name, escape(value).encode('ascii', 'xmlcharrefreplace').decode('ascii')) for name, value in fields)
+
+
+class FakeMTurk(object):
+    """
+    Args:
+        latency(float): Seconds each request takes.
+        max_rate(int): Requests a second beyond which requests are throttled,
+            or None never to throttle.
+        interrupt_after(int): Raise KeyboardInterrupt (as if Ctrl-C had been
+            pressed) for every request after this many.
+        n_trials(int): Trials in each assignment's answer.
+    """
+
+    def __init__(self, latency=0.0, max_rate=None, interrupt_after=None, n_trials=10):
+        self.latency = latency
+        self.max_rate = max_rate
+        self.interrupt_after = interrupt_after
+        self.n_trials = n_trials
+        self.hits = {}  # HIT id -> {'HIT': ..., 'assignments': [assignment ids]}
+        self.assignments = {}
+        self.approvals = {}
+        self.qualifications = {}
+        self.requests = 0
+        self.throttled = 0
+        self.recent = deque()  # times of the requests in the last second
+        self.lock = threading.Lock()
+
+    def add_hit(self, hit_id, n_assignments, max_assignments=None, hours_left=-1, assignment_duration=2700):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=hours_left)
+        assignment_ids = []
+        for i in range(n_assignments):
+            worker_id = 'WORKER_%s_%04d' % (hit_id, i)
+            assignment_id = 'ASSIGNMENT_%s_%04d' % (hit_id, i)
+            self.assignments[assignment_id] = {'AssignmentId': assignment_id, 'WorkerId': worker_id, 'HITId': hit_id,
+                                               'AssignmentStatus': 'Submitted',
+                                               'Answer': make_answer(worker_id, self.n_trials)}
+            self.approvals[assignment_id] = 0
+            assignment_ids.append(assignment_id)
+        self.hits[hit_id] = {'HIT': {'HITId': hit_id, 'HITGroupId': 'GROUP_' + hit_id,
+                                     'MaxAssignments': max_assignments or n_assignments,
+                                     'Expiration': expiration, 'AssignmentDurationInSeconds': assignment_duration},
+                             'assignments': assignment_ids}
+
+    def worker_assignment_list(self, hit_id):
+        return [(self.assignments[a]['WorkerId'], a) for a in self.hits[hit_id]['assignments']]
+
+    def request(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and self.recent[0] < now - 1:
+                self.recent.popleft()
+            if self.max_rate is not None and len(self.recent) >= self.max_rate:
+                self.throttled += 1
+                raise FakeMTurkError('ThrottlingException', 'Rate exceeded')
+            self.recent.append(now)
+            self.requests += 1
+            if self.interrupt_after is not None and self.requests > self.interrupt_after:
+                raise KeyboardInterrupt()
+        time.sleep(self.latency)
+
+    ############ The boto3 methods
+
+    def get_account_balance(self):
+        self.request()
+        return {'AvailableBalance': '10000.00'}
+
+    def get_hit(self, HITId):
+        self.request()
+        return {'HIT': dict(self.hits[HITId]['HIT'])}
+
+    def list_assignments_for_hit(self, HITId, NextToken=None, MaxResults=10, AssignmentStatuses=None):
+        self.request()
+        if not 1 <= MaxResults <= 100:
+            raise FakeMTurkError('ValidationException', 'MaxResults must be between 1 and 100')
+        assignments = [self.assignments[a] for a in self.hits[HITId]['assignments']]
+        if AssignmentStatuses is not None:
+            assignments = [a for a in assignments if a['AssignmentStatus'] in AssignmentStatuses]
+        start = int(NextToken.split(':')[1]) if NextToken else 0
+        page = [dict(a) for a in assignments[start:start + MaxResults]]
+        result = {'NumResults': len(page), 'Assignments': page}
+        if start + MaxResults < len(assignments):
+            result['NextToken'] = '%s:%d' % (HITId, start + MaxResults)
+        return result
+
+    def get_assignment(self, AssignmentId):
+        self.request()
+        assignment = self.assignments[AssignmentId]
+        return {'Assignment': dict(assignment), 'HIT': dict(self.hits[assignment['HITId']]['HIT'])}
+
+    def approve_assignment(self, AssignmentId):
+        self.request()
+        with self.lock:
+            assignment = self.assignments[AssignmentId]
+            if assignment['AssignmentStatus'] != 'Submitted':
+                raise FakeMTurkError('RequestError', 'This operation can be called with a status of: Submitted')
+            assignment['AssignmentStatus'] = 'Approved'
+            self.approvals[AssignmentId] += 1
+        return {}
+
+    def associate_qualification_with_worker(self, QualificationTypeId, WorkerId, IntegerValue, SendNotification):
+        self.request()
+        with self.lock:
+            self.qualifications[WorkerId] = self.qualifications.get(WorkerId, 0) + 1
+        return {}
+
+    def update_expiration_for_hit(self, HITId, ExpireAt):
+        self.request()
+        self.hits[HITId]['HIT']['Expiration'] = ExpireAt
+        return {}
+
+    ############ Checking what was done
+
+    def check(self):
+        approved = sum(1 for a in self.assignments.values() if a['AssignmentStatus'] == 'Approved')
+        twice = sum(1 for count in self.approvals.values() if count > 1)
+        qualified_twice = sum(1 for count in self.qualifications.values() if count > 1)
+        return 'approved %d/%d, qualified %d, approved twice %d, qualified twice %d' % (
+            approved, len(self.assignments), len(self.qualifications), twice, qualified_twice)
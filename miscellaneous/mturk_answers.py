@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Reading assignments' answers, and writing them out as data
+################################################################################
+
+## An assignment's answers come back from MTurk as a QuestionFormAnswers XML document,
+## with an Answer (QuestionIdentifier and FreeText) for each field our HIT submitted:
+## trialData0, trialData1... (one per trial, comma-separated) and the questionnaire
+## fields (comments etc).
+
+## read_answer parses the document once with ElementTree (whose parser and tree are
+## written in C, unlike xmltodict's) and picks out every field in one pass over the
+## answers, rather than going through them again for each field wanted. answer_fields
+## splits them into trial data and everything else in the same pass. (Picking the fields
+## out as expat parses, without building a tree, sounds quicker, but calling back into
+## Python for every element makes it no quicker for documents this size.)
+
+## For downloading a batch's data, iter_records turns assignments into records (the
+## assignment's ids and its answers), parsing their answers in batches, optionally
+## spread over several processes, and BatchWriter writes records to
+## - a CSV file, with a row per trial (the trial's data, plus the questionnaire
+##   fields asked for, as the old format_worker_data did)
+## - a JSON-lines file, with a line per assignment holding everything
+
+## How to use (create_tasks.py --data does this):
+	# writer = BatchWriter('batch0.data', fields=['comments'])
+	# for record in iter_records(iter_assignments(mturk, hit_id)):
+	#     writer.write(record)
+	# writer.close()
+
+import csv
+import json
+import datetime
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ProcessPoolExecutor
+
+################################################################################
+############ Global parameters
+################################################################################
+
+## Assignments parsed at a time by iter_records, and given to each process at once
+BATCH_SIZE = 500
+CHUNK_SIZE = 50
+## Answers whose QuestionIdentifier starts with this are trial data
+TRIAL_PREFIX = 'trialData'
+
+################################################################################
+############ Parsing
+################################################################################
+
+## [(QuestionIdentifier, FreeText), ...] from an assignment's Answer XML, in document
+## order. FreeText is None for an empty answer (as xmltodict gave it)
+def read_answer(answer_xml):
+    root = ElementTree.fromstring(answer_xml)
+    namespace = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+    question_tag = namespace + 'QuestionIdentifier'
+    text_tag = namespace + 'FreeText'
+    return [(answer.findtext(question_tag), answer.findtext(text_tag) or None) for answer in root]
+
+## [{'QuestionIdentifier': ..., 'FreeText': ...}, ...], as xmltodict gave each Answer
+def parse_answer(answer_xml):
+    return [{'QuestionIdentifier': question, 'FreeText': text} for question, text in read_answer(answer_xml)]
+
+## The trial data ({'trialData0': [values...], ...}) and other answers ({'comments': ...})
+## from an assignment's Answer XML, in one pass
+def answer_fields(answer_xml):
+    trials = {}
+    answers = {}
+    for question, text in read_answer(answer_xml):
+        if question and question.startswith(TRIAL_PREFIX):
+            trials[question] = text.split(',') if text else []
+        else:
+            answers[question] = text
+    return trials, answers
+
+################################################################################
+############ Records
+################################################################################
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _as_text(value):
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+## Yields a record for each assignment:
+##   {'WorkerId': ..., 'AssignmentId': ..., 'HITId': ..., 'AssignmentStatus': ...,
+##    'SubmitTime': ..., 'trials': {...}, 'answers': {...}}
+## as each batch of them is parsed - across processes processes (0 to parse them here)
+def iter_records(assignments, processes=0, batch_size=BATCH_SIZE):
+    pool = ProcessPoolExecutor(processes) if processes else None
+    try:
+        for batch in _batches(assignments, batch_size):
+            xmls = [a['Answer'] for a in batch]
+            parsed = pool.map(answer_fields, xmls, chunksize=CHUNK_SIZE) if pool else map(answer_fields, xmls)
+            for assignment, (trials, answers) in zip(batch, parsed):
+                record = dict((key, _as_text(assignment.get(key)))
+                              for key in ('WorkerId', 'AssignmentId', 'HITId', 'AssignmentStatus', 'SubmitTime'))
+                record['trials'] = trials
+                record['answers'] = answers
+                yield record
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+################################################################################
+############ Writing
+################################################################################
+
+class BatchWriter(object):
+    """
+    Writes records to path + '.csv' and path + '.jsonl'.
+
+    Args:
+        path(str): The files' path, without the extension.
+        trial_headers(list): Names of the comma-separated values in each trial's
+            data, for the CSV header; None to call them field1, field2...
+        fields(list): Other answers (e.g. 'comments') to add to each CSV row.
+    """
+
+    def __init__(self, path, trial_headers=None, fields=()):
+        self.csv_path = path + '.csv'
+        self.jsonl_path = path + '.jsonl'
+        self.trial_headers = trial_headers
+        self.fields = list(fields)
+        self.csv_file = open(self.csv_path, 'w', newline='', encoding='utf-8')
+        self.csv = csv.writer(self.csv_file)
+        self.jsonl_file = open(self.jsonl_path, 'w', encoding='utf-8')
+        self.assignments = 0
+        self.trials = 0
+
+    def write(self, record):
+        for question, values in record['trials'].items():
+            if self.trials == 0:
+                headers = self.trial_headers or ['field%d' % (i + 1) for i in range(len(values))]
+                self.csv.writerow(['workerId', 'assignmentId', 'question'] + headers + self.fields)
+            self.csv.writerow([record['WorkerId'], record['AssignmentId'], question] + values +
+                              [record['answers'].get(field) or '' for field in self.fields])
+            self.trials += 1
+        self.jsonl_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.assignments += 1
+
+    def close(self):
+        self.csv_file.close()
+        self.jsonl_file.close()
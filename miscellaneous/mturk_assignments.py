@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Fetching all of a HIT's assignments, a page at a time
+################################################################################
+
+## list_assignments_for_hit only returns one page of assignments - 10 unless asked for
+## more, and never more than 100 - along with a NextToken to ask for the next page with.
+## Code that only looks at what the first call returns silently misses the rest of a
+## large HIT.
+
+## iter_assignments follows the NextTokens, and hands back the assignments one at a
+## time as each page arrives, so nothing needs to hold a whole HIT's assignments (and
+## their answers) in memory at once, and work on the first page can start before the
+## last has been fetched.
+## iter_assignments_for_hits does the same for many HITs, fetching several HITs' pages
+## at once from threads.
+
+## Both need nothing but a client with the boto3 MTurk method list_assignments_for_hit,
+## so they work with FakeMTurk (fake_mturk.py), and with a ThrottledClient
+## (bulk_approval.py) to keep to MTurk's rate limit.
+
+## How to use:
+	# for assignment in iter_assignments(mturk, hit_id):
+	#     print(assignment['WorkerId'])
+	# for hit_id, assignment in iter_assignments_for_hits(mturk, hit_ids):
+	#     ...
+
+import queue
+import threading
+
+################################################################################
+############ Global parameters
+################################################################################
+
+## Assignments asked for per request (100 is the most MTurk returns)
+PAGE_SIZE = 100
+## HITs being fetched at once by iter_assignments_for_hits
+WORKERS = 4
+## Assignments fetched ahead of what has been handed back, before the threads wait
+QUEUE_SIZE = 1000
+
+################################################################################
+############ One HIT
+################################################################################
+
+## Yields each of HIT hit_id's assignments, fetching them page_size at a time.
+## statuses (e.g. ['Submitted']) only yields assignments with those statuses.
+def iter_assignments(client, hit_id, statuses=None, page_size=PAGE_SIZE):
+    kwargs = {'HITId': hit_id, 'MaxResults': page_size}
+    if statuses is not None:
+        kwargs['AssignmentStatuses'] = list(statuses)
+    while True:
+        page = client.list_assignments_for_hit(**kwargs)
+        for assignment in page['Assignments']:
+            yield assignment
+        if not page.get('NextToken') or not page['Assignments']:
+            return
+        kwargs['NextToken'] = page['NextToken']
+
+## The number of assignments HIT hit_id has (with one of statuses, if given)
+def count_assignments(client, hit_id, statuses=None, page_size=PAGE_SIZE):
+    return sum(1 for _ in iter_assignments(client, hit_id, statuses, page_size))
+
+################################################################################
+############ Many HITs
+################################################################################
+
+## Marks the end of a HIT's assignments on the queue
+_DONE = object()
+
+## Yields (hit_id, assignment) for every assignment of every HIT in hit_ids, fetching
+## up to workers HITs at once. Each HIT's assignments come in order, but assignments
+## from different HITs are mixed together as they arrive. If fetching a HIT fails the
+## error is raised here; stopping early (break, or an error) stops the threads too.
+def iter_assignments_for_hits(client, hit_ids, workers=WORKERS, statuses=None, page_size=PAGE_SIZE):
+    hit_ids = list(hit_ids)
+    results = queue.Queue(QUEUE_SIZE)
+    stop = threading.Event()
+    to_fetch = queue.Queue()
+    for hit_id in hit_ids:
+        to_fetch.put(hit_id)
+
+    def put(item):
+        # waits for room on the queue, unless the consumer has gone away
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        while not stop.is_set():
+            try:
+                hit_id = to_fetch.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                for assignment in iter_assignments(client, hit_id, statuses, page_size):
+                    if not put((hit_id, assignment)):
+                        return
+            except Exception as e:
+                put((hit_id, e))
+                return
+            if not put((hit_id, _DONE)):
+                return
+
+    threads = [threading.Thread(target=fetch, daemon=True) for _ in range(min(workers, len(hit_ids)))]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(hit_ids)
+        while remaining:
+            hit_id, item = results.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield hit_id, item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
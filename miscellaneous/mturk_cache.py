@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Keeping a local copy of what MTurk has told us
+################################################################################
+
+## Every --check, --comments and --approve asks MTurk again for the same HITs and
+## assignments, most of which haven't changed since the last time - and once a HIT has
+## expired and its assignments have all been approved (or rejected), never will.
+
+## MTurkCache keeps the HITs, assignments (with their statuses) and parsed answers
+## MTurk has sent back in an SQLite file, and CachedClient wraps a boto3 MTurk client so
+## that requests are answered from it where that is safe:
+## - get_hit and list_assignments_for_hit, if the HIT was fetched less than ttl seconds
+##   ago, or it has settled: it had expired (and the time allowed for an assignment had
+##   run out) by when it was fetched, and all its assignments were approved or rejected
+## - get_assignment, if the assignment was approved or rejected, as that is final
+## Everything else goes to MTurk, and what comes back is stored on the way (e.g. an
+## approve_assignment that succeeds marks the assignment approved).
+
+## When a HIT's assignments are fetched again, those that are new or whose status has
+## changed since they were last fetched are recorded in MTurkCache.changes, so a check
+## can say what happened since the last one.
+
+## How to use (create_tasks.py does this):
+	# cache = MTurkCache('mturk_cache.sqlite')
+	# mturk = CachedClient(mturk, cache, ttl=300)
+	# ... then use mturk as before
+
+import json
+import time
+import sqlite3
+import datetime
+import threading
+
+from mturk_answers import parse_answer
+
+################################################################################
+############ Global parameters
+################################################################################
+
+## Seconds before something fetched from MTurk is fetched again
+TTL = 300
+## Assignment statuses that never change again
+FINAL_STATUSES = ('Approved', 'Rejected')
+
+################################################################################
+############ Storing MTurk's responses as JSON
+################################################################################
+
+## boto3 gives times (HIT expiration, submit time etc) as datetimes, which JSON can't
+## hold, so they are stored as {"__datetime__": "2019-12-12T10:00:00+00:00"}
+def _to_json(o):
+    if isinstance(o, datetime.datetime):
+        return {'__datetime__': o.isoformat()}
+    raise TypeError('%r is not JSON serializable' % (o,))
+
+def _from_json(d):
+    if '__datetime__' in d:
+        return datetime.datetime.fromisoformat(d['__datetime__'])
+    return d
+
+def dumps(o):
+    return json.dumps(o, default=_to_json)
+
+def loads(s):
+    return json.loads(s, object_hook=_from_json)
+
+################################################################################
+############ The cache
+################################################################################
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hits (hit_id TEXT PRIMARY KEY, hit TEXT, fetched REAL);
+CREATE TABLE IF NOT EXISTS listings (hit_id TEXT PRIMARY KEY, fetched REAL, settled INTEGER);
+CREATE TABLE IF NOT EXISTS assignments (assignment_id TEXT PRIMARY KEY, hit_id TEXT, worker_id TEXT,
+                                        status TEXT, position INTEGER, assignment TEXT, answers TEXT,
+                                        fetched REAL);
+CREATE INDEX IF NOT EXISTS assignments_by_hit ON assignments (hit_id, position);
+'''
+
+class MTurkCache(object):
+    """
+    HITs, assignments and parsed answers, in an SQLite file. Safe to use from
+    several threads at once.
+
+    Args:
+        path(str): The SQLite file (created if it doesn't exist), or ':memory:'
+            to keep nothing between runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.changes = []  # (HIT id, assignment id, old status or None if new, new status)
+
+    def close(self):
+        self.db.close()
+
+    ############ HITs
+
+    def get_hit(self, hit_id):
+        with self.lock:
+            row = self.db.execute('SELECT hit, fetched FROM hits WHERE hit_id = ?', (hit_id,)).fetchone()
+        return (loads(row[0]), row[1]) if row else (None, None)
+
+    def put_hit(self, hit, fetched=None):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO hits VALUES (?, ?, ?)',
+                            (hit['HITId'], dumps(hit), fetched or time.time()))
+
+    def forget_hit(self, hit_id):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM hits WHERE hit_id = ?', (hit_id,))
+            self.db.execute('DELETE FROM listings WHERE hit_id = ?', (hit_id,))
+
+    ############ Assignments
+
+    def get_assignment(self, assignment_id):
+        with self.lock:
+            row = self.db.execute('SELECT assignment FROM assignments WHERE assignment_id = ?',
+                                  (assignment_id,)).fetchone()
+        return loads(row[0]) if row else None
+
+    ## Stores assignments (a page of them, all in one transaction); position is the first
+    ## one's place in its HIT's list of assignments, if they are part of it. Those new to
+    ## a HIT fetched before, or whose status has changed, are recorded in changes
+    def put_assignments(self, assignments, position=None, fetched=None):
+        fetched = fetched or time.time()
+        with self.lock, self.db:
+            for i, assignment in enumerate(assignments):
+                old = self.db.execute('SELECT status FROM assignments WHERE assignment_id = ?',
+                                      (assignment['AssignmentId'],)).fetchone()
+                if old is not None:
+                    if old[0] != assignment['AssignmentStatus']:
+                        self.changes.append((assignment['HITId'], assignment['AssignmentId'], old[0],
+                                             assignment['AssignmentStatus']))
+                elif self.db.execute('SELECT 1 FROM listings WHERE hit_id = ?', (assignment['HITId'],)).fetchone():
+                    self.changes.append((assignment['HITId'], assignment['AssignmentId'], None,
+                                         assignment['AssignmentStatus']))
+                self.db.execute('''INSERT INTO assignments (assignment_id, hit_id, worker_id, status, position,
+                                                            assignment, fetched)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                                   ON CONFLICT (assignment_id) DO UPDATE SET
+                                       status = excluded.status, assignment = excluded.assignment,
+                                       fetched = excluded.fetched,
+                                       position = COALESCE(excluded.position, position)''',
+                                (assignment['AssignmentId'], assignment['HITId'], assignment['WorkerId'],
+                                 assignment['AssignmentStatus'], None if position is None else position + i,
+                                 dumps(assignment), fetched))
+
+    def set_status(self, assignment_id, status):
+        assignment = self.get_assignment(assignment_id)
+        if assignment is not None:
+            assignment['AssignmentStatus'] = status
+            self.put_assignments([assignment])
+
+    ## Parsed answers of assignment, as parse_answer (mturk_answers.py) gives them
+    ## (parsed once, then kept)
+    def get_answers(self, assignment):
+        with self.lock:
+            row = self.db.execute('SELECT answers FROM assignments WHERE assignment_id = ?',
+                                  (assignment['AssignmentId'],)).fetchone()
+        if row and row[0] is not None:
+            return json.loads(row[0])
+        answers = parse_answer(assignment['Answer'])
+        if row:
+            with self.lock, self.db:
+                self.db.execute('UPDATE assignments SET answers = ? WHERE assignment_id = ?',
+                                (json.dumps(answers), assignment['AssignmentId']))
+        return answers
+
+    ############ A HIT's list of assignments
+
+    ## When the HIT's whole list of assignments was last fetched (or None if never), and
+    ## whether it had settled by then
+    def get_listing(self, hit_id):
+        with self.lock:
+            row = self.db.execute('SELECT fetched, settled FROM listings WHERE hit_id = ?', (hit_id,)).fetchone()
+        return (row[0], bool(row[1])) if row else (None, False)
+
+    ## Records that all of the HIT's assignments were fetched at time fetched
+    def put_listing(self, hit_id, fetched):
+        with self.lock:
+            statuses = [row[0] for row in self.db.execute('SELECT status FROM assignments WHERE hit_id = ?',
+                                                          (hit_id,))]
+            row = self.db.execute('SELECT hit FROM hits WHERE hit_id = ?', (hit_id,)).fetchone()
+        settled = False
+        if row is not None and all(status in FINAL_STATUSES for status in statuses):
+            hit = loads(row[0])
+            expiration = hit.get('Expiration')
+            if expiration is not None:
+                closed = expiration + datetime.timedelta(seconds=hit.get('AssignmentDurationInSeconds', 0))
+                settled = closed.timestamp() < fetched
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)', (hit_id, fetched, int(settled)))
+
+    def list_assignments(self, hit_id, statuses=None):
+        with self.lock:
+            rows = self.db.execute('SELECT assignment FROM assignments WHERE hit_id = ? ORDER BY position',
+                                   (hit_id,)).fetchall()
+        assignments = [loads(row[0]) for row in rows]
+        if statuses is not None:
+            assignments = [a for a in assignments if a['AssignmentStatus'] in statuses]
+        return assignments
+
+################################################################################
+############ The client
+################################################################################
+
+## Marks NextTokens for pages served from the cache
+CACHED_TOKEN = 'cached:'
+
+class CachedClient(object):
+    """
+    Wraps a boto3 MTurk client (or anything with the same methods, e.g. a
+    ThrottledClient) so that requests are answered from cache where that is
+    safe - see the top of this file.
+
+    Args:
+        client: The client to send everything else to.
+        cache(MTurkCache): Where to keep what comes back.
+        ttl(float): Seconds for which a fetched HIT or list of assignments is
+            used rather than fetched again (0 always to fetch them).
+    """
+
+    def __init__(self, client, cache, ttl=TTL):
+        self.client = client
+        self.cache = cache
+        self.ttl = ttl
+        self.listings = {}  # NextToken -> (position of the next page, when the listing started)
+        self.lock = threading.Lock()
+
+    def is_fresh(self, fetched, settled):
+        return fetched is not None and (settled or time.time() - fetched < self.ttl)
+
+    def get_hit(self, HITId):
+        hit, fetched = self.cache.get_hit(HITId)
+        if hit is not None and self.is_fresh(fetched, self.cache.get_listing(HITId)[1]):
+            return {'HIT': hit}
+        response = self.client.get_hit(HITId=HITId)
+        self.cache.put_hit(response['HIT'])
+        return response
+
+    def list_assignments_for_hit(self, HITId, NextToken=None, MaxResults=10, AssignmentStatuses=None):
+        if NextToken is not None and NextToken.startswith(CACHED_TOKEN):
+            return self.cached_page(HITId, int(NextToken[len(CACHED_TOKEN):]), MaxResults, AssignmentStatuses)
+        if NextToken is None and self.is_fresh(*self.cache.get_listing(HITId)):
+            return self.cached_page(HITId, 0, MaxResults, AssignmentStatuses)
+        kwargs = {'HITId': HITId, 'MaxResults': MaxResults}
+        if NextToken is not None:
+            kwargs['NextToken'] = NextToken
+        if AssignmentStatuses is not None:
+            kwargs['AssignmentStatuses'] = AssignmentStatuses
+        with self.lock:
+            position, started = self.listings.pop(NextToken, (0, time.time())) if NextToken else (0, time.time())
+        response = self.client.list_assignments_for_hit(**kwargs)
+        # (positions only mean something in the whole list)
+        self.cache.put_assignments(response['Assignments'], None if AssignmentStatuses else position)
+        if AssignmentStatuses is None:
+            if response.get('NextToken'):
+                with self.lock:
+                    self.listings[response['NextToken']] = (position + len(response['Assignments']), started)
+            else:
+                # the whole list has been fetched, from when it started
+                self.cache.put_listing(HITId, started)
+        return response
+
+    def cached_page(self, hit_id, start, page_size, statuses):
+        assignments = self.cache.list_assignments(hit_id, statuses)
+        page = assignments[start:start + page_size]
+        response = {'NumResults': len(page), 'Assignments': page}
+        if start + page_size < len(assignments):
+            response['NextToken'] = CACHED_TOKEN + str(start + page_size)
+        return response
+
+    def get_assignment(self, AssignmentId):
+        assignment = self.cache.get_assignment(AssignmentId)
+        if assignment is not None and assignment['AssignmentStatus'] in FINAL_STATUSES:
+            response = {'Assignment': assignment}
+            hit, _ = self.cache.get_hit(assignment['HITId'])
+            if hit is not None:
+                response['HIT'] = hit
+            return response
+        response = self.client.get_assignment(AssignmentId=AssignmentId)
+        self.cache.put_assignments([response['Assignment']])
+        return response
+
+    def approve_assignment(self, **kwargs):
+        response = self.client.approve_assignment(**kwargs)
+        self.cache.set_status(kwargs['AssignmentId'], 'Approved')
+        return response
+
+    def reject_assignment(self, **kwargs):
+        response = self.client.reject_assignment(**kwargs)
+        self.cache.set_status(kwargs['AssignmentId'], 'Rejected')
+        return response
+
+    def update_expiration_for_hit(self, **kwargs):
+        response = self.client.update_expiration_for_hit(**kwargs)
+        self.cache.forget_hit(kwargs['HITId'])
+        return response
+
+    ## Parsed answers of an assignment, as parse_answer gives them
+    def answers(self, assignment):
+        return self.cache.get_answers(assignment)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+################################################################################
+############ Benchmark for mturk_cache.py, against a stand-in for MTurk
+################################################################################
+
+## This script makes a number of expired HITs with many assignments on FakeMTurk
+## (fake_mturk.py), and checks them all (get_hit, and counting their assignments, as
+## create_tasks.py --check does)
+## - without the cache
+## - with the cache, when it is empty
+## - with the cache again, within the TTL
+## - after the TTL (as if it had run out), once some assignments have been approved
+##   behind its back (which it should notice, and report as changes)
+## - after the TTL, once all the assignments are approved, so the HITs have settled
+## then approves one HIT's assignments twice with BulkApprover, as after an interrupted
+## run, without and with the cache, and prints the requests and time each took.
+
+## How to use:
+	# python mturk_cache_benchmark.py --hits 30 --assignments 100 --latency 0.05
+
+import os
+import time
+import argparse
+import tempfile
+
+from bulk_approval import BulkApprover
+from fake_mturk import FakeMTurk
+from mturk_assignments import count_assignments
+from mturk_cache import MTurkCache, CachedClient
+
+
+def check_all(client, hit_ids):
+    return [(client.get_hit(HITId=hit_id)['HIT']['MaxAssignments'], count_assignments(client, hit_id))
+            for hit_id in hit_ids]
+
+def timed(mturk, name, fn):
+    requests_before = mturk.requests
+    start = time.time()
+    fn()
+    print('%-52s %5d requests %6.2f seconds' % (name, mturk.requests - requests_before, time.time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mturk_cache.py against a stand-in for MTurk.')
+    parser.add_argument('--hits', type=int, default=30)
+    parser.add_argument('--assignments', type=int, default=100, help='assignments per HIT')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each request takes')
+    args = parser.parse_args()
+
+    mturk = FakeMTurk(args.latency, n_trials=2)
+    hit_ids = ['HIT%03d' % i for i in range(args.hits)]
+    for hit_id in hit_ids:
+        mturk.add_hit(hit_id, args.assignments)
+    cache = MTurkCache(os.path.join(tempfile.mkdtemp(), 'cache.sqlite'))
+    print('%d HITs with %d assignments each' % (args.hits, args.assignments))
+
+    timed(mturk, 'check, without the cache', lambda: check_all(mturk, hit_ids))
+    timed(mturk, 'check, empty cache', lambda: check_all(CachedClient(mturk, cache), hit_ids))
+    timed(mturk, 'check again, within the TTL', lambda: check_all(CachedClient(mturk, cache), hit_ids))
+
+    ## (a TTL of 0 is as if the TTL had run out)
+    for hit_id in hit_ids:
+        mturk.assignments['ASSIGNMENT_%s_0000' % hit_id]['AssignmentStatus'] = 'Approved'
+    timed(mturk, 'check after the TTL, a few approved since',
+          lambda: check_all(CachedClient(mturk, cache, ttl=0), hit_ids))
+    print('  changes noticed: %d' % len(cache.changes))
+
+    for assignment in mturk.assignments.values():
+        assignment['AssignmentStatus'] = 'Approved'
+    timed(mturk, 'check after the TTL, all approved since',
+          lambda: check_all(CachedClient(mturk, cache, ttl=0), hit_ids))
+    timed(mturk, 'check after the TTL again, all settled',
+          lambda: check_all(CachedClient(mturk, cache, ttl=0), hit_ids))
+    print('')
+
+    mturk = FakeMTurk(args.latency)
+    mturk.add_hit('BATCH', args.assignments)
+    for client, name in [(mturk, 'without the cache'),
+                         (CachedClient(mturk, MTurkCache(':memory:')), 'with the cache')]:
+        for run in ['approve', 'approve again']:
+            approver = BulkApprover(client, rate=1000)
+            timed(mturk, '%s, %s' % (run, name),
+                  lambda: approver.approve_all(mturk.worker_assignment_list('BATCH')))
+        for assignment in mturk.assignments.values():
+            assignment['AssignmentStatus'] = 'Submitted'
+
+
+if __name__ == "__main__":
+    main()